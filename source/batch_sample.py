@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import torch
+import torchaudio
+from model import DiffWave
+from inference import InferenceEngine
+from profiler import Profiler
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, WITH_CONDITIONING, INFERENCE_SCHEDULE
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+#writes generated audio to disk on a background thread, so the next batch can be denoised meanwhile
+class AudioWriter:
+
+    def __init__(self, sample_rate=SAMPLE_RATE, max_pending=64) -> None:
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, waveform):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((path, waveform.detach().cpu()))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, waveform = item
+            try:
+                torchaudio.save(path, waveform, self.sample_rate)
+            except Exception as e:
+                self.error = e
+
+    #wait until all queued files are written
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+#load a model saved by train.py, or an int8 model written by quantize.py; returns the model and the device it runs on
+def load_model(path):
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    if 'quantization' in state:
+        #quantized kernels run on the cpu only
+        from quantize import load_quantized
+        return load_quantized(path), torch.device('cpu')
+    model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    return model, device
+
+#load spectrogram files as single channel tensors; channels, n_mels, frames -> 1, n_mels, frames
+def load_spectrograms(paths):
+    return torch.stack([torch.from_numpy(np.load(path))[0:1] for path in paths])
+
+#denoise n samples in batches of batch_size; yields (first index of batch, generated audio of shape batch, 1, length)
+def sample_batches(model, n, batch_size, spectrogram_paths=None, length=SAMPLE_RATE * SAMPLE_LENGTH_SECONDS, inference_schedule=None, profiler=None):
+    #int8 models of quantize.py sample by themselves (on the cpu); inputs go to the device the model is on
+    engine = InferenceEngine(model, profiler) if isinstance(model, DiffWave) else model
+    model_device = model.noise_schedule.beta.device
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        conditioning_var = None
+        if spectrogram_paths is not None:
+            conditioning_var = load_spectrograms(spectrogram_paths[start:start + size]).to(model_device)
+        noise = torch.randn(size, 1, length, device=model_device) # batch_size, n_channels, sample length
+        yield start, engine.sample(noise, conditioning_var=conditioning_var, inference_schedule=inference_schedule)
+
+#generate audio for all spectrograms (or n unconditional samples) and return the throughput in clips/sec
+def render(model, out_dir, batch_size, spectrogram_paths=None, n=None, inference_schedule=None, profiler=None):
+    if spectrogram_paths is not None:
+        n = len(spectrogram_paths)
+    os.makedirs(out_dir, exist_ok=True)
+    writer = AudioWriter()
+    start_time = time.perf_counter()
+    for start, y in sample_batches(model, n, batch_size, spectrogram_paths, inference_schedule=inference_schedule, profiler=profiler):
+        for i in range(y.shape[0]):
+            if spectrogram_paths is not None:
+                name = os.path.basename(spectrogram_paths[start + i]).replace('.spec.npy', '')
+                name = os.path.splitext(name)[0]
+            else:
+                name = f'sample{start + i}'
+            writer.write(os.path.join(out_dir, f'{name}.wav'), y[i])
+        elapsed = time.perf_counter() - start_time
+        print(f'{start + y.shape[0]}/{n} clips | {(start + y.shape[0]) / elapsed:.3f} clips/sec')
+    writer.close()
+    clips_per_second = n / (time.perf_counter() - start_time)
+    print(f'Generated {n} clips with batch size {batch_size}: {clips_per_second:.3f} clips/sec')
+    return clips_per_second
+
+#example: python source/batch_sample.py output/models/best_model.pt --spectrograms data/mel_spectrograms --batch-size 16
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate many clips with batched reverse diffusion')
+    parser.add_argument('model_path', nargs='?', default='output/models/best_model.pt')
+    parser.add_argument('--spectrograms', default=None, help='folder of .spec.npy files used as conditioning variables')
+    parser.add_argument('--unconditional', type=int, default=None, help='number of unconditional samples to generate')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--out-dir', default='output/samples')
+    parser.add_argument('--profile', action='store_true', help='print time and memory per sampling phase and module')
+    parser.add_argument('--fast', action='store_true', help='denoise only the steps of INFERENCE_SCHEDULE from config.py')
+    args = parser.parse_args()
+
+    if WITH_CONDITIONING and args.spectrograms is None:
+        parser.error('--spectrograms is required for a conditional model')
+    if not WITH_CONDITIONING and args.unconditional is None:
+        parser.error('--unconditional is required for an unconditional model')
+
+    model, device = load_model(args.model_path)
+
+    spectrogram_paths = None
+    if WITH_CONDITIONING:
+        spectrogram_paths = [os.path.join(args.spectrograms, f) for f in sorted(os.listdir(args.spectrograms)) if f.endswith('.npy')]
+    profiler = Profiler(enabled=args.profile, device=device)
+    if isinstance(model, DiffWave):
+        profiler.attach(model)
+    render(model, args.out_dir, args.batch_size, spectrogram_paths, args.unconditional, INFERENCE_SCHEDULE if args.fast else None, profiler)
+    if profiler.enabled:
+        print(profiler.summary())
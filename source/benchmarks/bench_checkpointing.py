@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import time
+import resource
+import multiprocessing
+import torch
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import print_table
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, LEARNING_RATE
+
+#train steps in a fresh process, so ru_maxrss is the peak memory of this segment size only
+def run_mode(args, checkpoint_blocks, results):
+    from model import DiffWave
+
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    model = DiffWave(args.res_channels, args.num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH,
+                     checkpoint_blocks=checkpoint_blocks).to(device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    waveform = torch.rand(args.batch_size, 1, SAMPLE_RATE * SAMPLE_LENGTH_SECONDS, device=device) * 2 - 1
+    spectrogram = torch.rand(args.batch_size, 1, N_MELS, 690, device=device)
+
+    def step():
+        t = torch.randint(0, TIME_STEPS, (args.batch_size,), device=device)
+        loss = torch.nn.functional.mse_loss(model(waveform, t, spectrogram), waveform)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    step() # warmup; allocates the optimizer state
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    row = {'checkpoint blocks': checkpoint_blocks if checkpoint_blocks > 0 else 'off', 'steps/sec': args.steps / elapsed,
+           'peak rss MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if device.type == 'cuda':
+        row['peak cuda MB'] = torch.cuda.max_memory_allocated(device) / 2**20
+    results.put(row)
+
+#example: python source/benchmarks/bench_checkpointing.py --res-channels 256 --batch-size 2 --segments 0 1 3 10
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='peak memory and training steps/sec for activation checkpointing segment sizes')
+    parser.add_argument('--segments', type=int, nargs='+', default=[0, 1, 2, 5, 10], help='blocks per checkpointed segment; 0 keeps all activations')
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=6)
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--res-channels', type=int, default=RES_CHANNELS)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    rows = []
+    for checkpoint_blocks in args.segments:
+        process = context.Process(target=run_mode, args=(args, checkpoint_blocks, results))
+        process.start()
+        rows.append(results.get())
+        process.join()
+    print_table(rows)
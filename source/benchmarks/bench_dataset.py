@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import torch
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import make_synthetic_chunks, print_table
+from dataset import ChunkedData, PackedData, StreamingCropData
+from pack_data import pack
+from feature_cache import FeatureCache
+
+#fetch items in random order, either directly or through a DataLoader, and return items/sec
+def items_per_second(dataset, n_items, batch_size=None, num_workers=0):
+    n_items = min(n_items, len(dataset))
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        #iterable datasets choose their order themselves; time the first n_items
+        start = time.perf_counter()
+        seen = 0
+        for batch in torch.utils.data.DataLoader(dataset, batch_size=batch_size or 1, num_workers=num_workers):
+            seen += batch[0].shape[0]
+            if seen >= n_items:
+                break
+        return seen / (time.perf_counter() - start)
+    indices = torch.randperm(len(dataset))[:n_items].tolist()
+    start = time.perf_counter()
+    if batch_size is None:
+        for index in indices:
+            dataset[index]
+    else:
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=batch_size, num_workers=num_workers)
+        for _ in loader:
+            pass
+    return n_items / (time.perf_counter() - start)
+
+#example: python source/benchmarks/bench_dataset.py --synthetic 256
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='items/sec of ChunkedData against PackedData (and StreamingCropData with --source-dir)')
+    parser.add_argument('--audio-dir', default='data/chunked_audio')
+    parser.add_argument('--conditional-dir', default='data/mel_spectrograms')
+    parser.add_argument('--packed-dir', default=None, help='existing packed store; built into a temporary directory if not given')
+    parser.add_argument('--source-dir', default=None, help='full length audio files (e.g. raw_samples); adds StreamingCropData rows')
+    parser.add_argument('--synthetic', type=int, default=0, help='benchmark on this many generated chunks instead of --audio-dir')
+    parser.add_argument('--items', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_dir, conditional_dir = args.audio_dir, args.conditional_dir
+        if args.synthetic > 0:
+            audio_dir, conditional_dir = os.path.join(tmp, 'audio'), os.path.join(tmp, 'mel')
+            make_synthetic_chunks(audio_dir, conditional_dir, args.synthetic)
+
+        packed_dir = args.packed_dir
+        if packed_dir is None:
+            packed_dir = os.path.join(tmp, 'packed')
+            start = time.perf_counter()
+            pack(audio_dir, conditional_dir, packed_dir)
+            print(f'pack build time: {time.perf_counter() - start:.2f}s')
+
+        #the cache is warmed with one pass over the items first, so its rows show fetches from the cache
+        cached = ChunkedData(audio_dir, conditional_dir, cache=FeatureCache(os.path.join(tmp, 'feature_cache')))
+        for index in range(min(args.items, len(cached))):
+            cached[index]
+        datasets = {
+            'ChunkedData': ChunkedData(audio_dir, conditional_dir),
+            'ChunkedData (feature cache)': cached,
+            'PackedData': PackedData(packed_dir),
+        }
+        if args.source_dir is not None:
+            #features of the sources are computed into the cache when the dataset is created, before timing
+            datasets['StreamingCropData'] = StreamingCropData(args.source_dir, cache=FeatureCache(os.path.join(tmp, 'feature_cache')))
+        rows = []
+        for name, dataset in datasets.items():
+            rows.append({'dataset': name, 'mode': 'getitem', 'items/sec': items_per_second(dataset, args.items)})
+            rows.append({'dataset': name, 'mode': f'loader bs={args.batch_size} workers={args.workers}',
+                         'items/sec': items_per_second(dataset, args.items, args.batch_size, args.workers)})
+        print_table(rows)
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+import time
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import print_table
+from benchmarks.bench_train import synthetic_dataset
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, N_MELS, LEARNING_RATE
+
+#one rank of a data parallel run over a synthetic dataset of the same global size for every world size
+def run_rank(rank, world_size, args, results):
+    from model import DiffWave
+    from train import train
+
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, args.threads // world_size))
+    torch.manual_seed(0)
+
+    dataset = synthetic_dataset(args.steps * args.batch_size * world_size)
+    sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=world_size, rank=rank)
+    trainloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, sampler=sampler)
+    model = torch.nn.parallel.DistributedDataParallel(DiffWave(args.res_channels, args.num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH))
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        dist.barrier()
+        start = time.perf_counter()
+        train(model, optimizer, trainloader, 1, TIME_STEPS, VARIANCE_SCHEDULE, out_dir=out_dir, device=torch.device('cpu'))
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put(elapsed)
+    dist.destroy_process_group()
+
+#example: python source/benchmarks/bench_ddp.py --nprocs 1 2 4 --threads 8
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='data parallel (gloo) training throughput for different numbers of processes')
+    parser.add_argument('--nprocs', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--steps', type=int, default=10, help='steps per process')
+    parser.add_argument('--batch-size', type=int, default=6, help='batch size per process')
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--res-channels', type=int, default=RES_CHANNELS)
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='cpu threads shared by all processes')
+    parser.add_argument('--master-port', default='29510')
+    args = parser.parse_args()
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', args.master_port)
+    results = mp.get_context('spawn').SimpleQueue()
+    rows = []
+    for world_size in args.nprocs:
+        mp.spawn(run_rank, args=(world_size, args, results), nprocs=world_size)
+        elapsed = results.get()
+        samples = args.steps * args.batch_size * world_size
+        rows.append({'processes': world_size, 'seconds': elapsed, 'samples/sec': samples / elapsed})
+    for row in rows:
+        row['scaling'] = row['samples/sec'] / rows[0]['samples/sec']
+    print_table(rows)
@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+import torchaudio
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import print_table
+from model import DiffWave
+from data_prep import get_mel_transform, compress_spectrogram
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, INFERENCE_SCHEDULE
+
+#quality proxy: L1 distance of normalized log mel spectrograms of two waveforms at SAMPLE_RATE
+def mel_l1(a, b):
+    mel_transform = get_mel_transform()
+    return torch.mean(torch.abs(compress_spectrogram(mel_transform(a)) - compress_spectrogram(mel_transform(b)))).item()
+
+#example: python source/benchmarks/bench_fast_sampling.py --model output/models/best_model.pt --spectrogram data/mel_spectrograms/0_0.wav.spec.npy --reference data/chunked_audio/0_0.wav
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='latency and mel L1 of fast sampling against the full schedule')
+    parser.add_argument('--model', default=None, help='trained model; a randomly initialized model is used if not given')
+    parser.add_argument('--spectrogram', default=None, help='conditioning .spec.npy file; random if not given')
+    parser.add_argument('--reference', default=None, help='audio the spectrogram was computed from; the full schedule output is the reference if not given')
+    parser.add_argument('--schedule', type=float, nargs='+', default=INFERENCE_SCHEDULE, help='betas of the fast inference schedule')
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--res-channels', type=int, default=RES_CHANNELS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    model = DiffWave(args.res_channels, args.num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    if args.model is not None:
+        model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    model.eval()
+
+    if args.spectrogram is not None:
+        conditioning_var = torch.from_numpy(np.load(args.spectrogram))[0:1].unsqueeze(0)
+    else:
+        conditioning_var = torch.rand(1, 1, N_MELS, 690)
+
+    outputs = {}
+    rows = []
+    for name, schedule in [('full', None), ('fast', args.schedule)]:
+        torch.manual_seed(args.seed) #same starting noise for both schedules
+        noise = torch.randn(1, 1, SAMPLE_RATE * SAMPLE_LENGTH_SECONDS)
+        start = time.perf_counter()
+        outputs[name] = model.sample(noise, conditioning_var=conditioning_var, inference_schedule=schedule)[0]
+        elapsed = time.perf_counter() - start
+        rows.append({'schedule': name, 'steps': TIME_STEPS if schedule is None else len(schedule), 'seconds': elapsed,
+                     'real-time factor': elapsed / SAMPLE_LENGTH_SECONDS})
+
+    if args.reference is not None:
+        reference, sample_rate = torchaudio.load(args.reference)
+        reference = torchaudio.functional.resample(reference, orig_freq=sample_rate, new_freq=SAMPLE_RATE)[0:1, :SAMPLE_RATE * SAMPLE_LENGTH_SECONDS]
+    else:
+        reference = outputs['full']
+    for row in rows:
+        row['mel L1'] = mel_l1(outputs[row['schedule']][:, :reference.shape[-1]], reference)
+    rows[1]['speedup'] = rows[0]['seconds'] / rows[1]['seconds']
+    print_table(rows, ['schedule', 'steps', 'seconds', 'real-time factor', 'mel L1', 'speedup'])
@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import torchaudio
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import make_synthetic_chunks, print_table
+from data_prep import transform_to_spectrogram, get_mel_transform, compress_spectrogram
+from features import MelFrontend
+from config import SOURCE_SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, MEL_BATCH_SIZE
+
+#files/sec of the current per file function: load, transform and save one file per call
+def reference_files_per_second(audio_paths, out_dir):
+    start = time.perf_counter()
+    for audio_path in audio_paths:
+        transform_to_spectrogram(audio_path, out_dir)
+    return len(audio_paths) / (time.perf_counter() - start)
+
+#files/sec of the frontend: load a batch of files, transform it in one call and save one file per chunk
+def frontend_files_per_second(audio_paths, out_dir, frontend, batch_size):
+    start = time.perf_counter()
+    for batch_start in range(0, len(audio_paths), batch_size):
+        batch_paths = audio_paths[batch_start:batch_start + batch_size]
+        mel_spectrograms = frontend(torch.stack([torchaudio.load(audio_path)[0] for audio_path in batch_paths])).numpy()
+        for audio_path, mel_spectrogram in zip(batch_paths, mel_spectrograms):
+            np.save(os.path.join(out_dir, f'{os.path.basename(audio_path)}.spec.npy'), mel_spectrogram)
+    return len(audio_paths) / (time.perf_counter() - start)
+
+#transforms/sec without file io, on random chunks held in memory
+def compute_per_second(fn, chunks, repeats=3):
+    fn(chunks[:1])
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(chunks)
+        times.append(time.perf_counter() - start)
+    return len(chunks) / min(times)
+
+#example: python source/benchmarks/bench_features.py --synthetic 128
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='files/sec of MelFrontend against transform_to_spectrogram of data_prep.py')
+    parser.add_argument('--audio-dir', default=None, help='chunked audio to transform; generated if --synthetic is given')
+    parser.add_argument('--synthetic', type=int, default=0, help='benchmark on this many generated chunks')
+    parser.add_argument('--files', type=int, default=128, help='maximum number of files of --audio-dir')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1, MEL_BATCH_SIZE])
+    parser.add_argument('--channels', type=int, default=2, help='channels of the in memory chunks')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    frontend = MelFrontend(device=args.device)
+    mel_transform = get_mel_transform()
+    chunks = torch.rand(args.files, args.channels, SOURCE_SAMPLE_RATE * SAMPLE_LENGTH_SECONDS) * 2 - 1
+    difference = (frontend(chunks[:4]).cpu() - compress_spectrogram(mel_transform(chunks[:4]))).abs().max().item()
+    print(f'max abs difference to the MelSpectrogram transform: {difference:.3g}')
+
+    rows = [{'mode': 'in memory', 'method': 'MelSpectrogram per chunk',
+             'items/sec': compute_per_second(lambda batch: [compress_spectrogram(mel_transform(chunk)) for chunk in batch], chunks)}]
+    for batch_size in args.batch_size:
+        rows.append({'mode': 'in memory', 'method': f'MelFrontend batch={batch_size}',
+                     'items/sec': compute_per_second(lambda batch: [frontend(batch[i:i + batch_size]) for i in range(0, len(batch), batch_size)], chunks)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_dir = args.audio_dir
+        if args.synthetic > 0:
+            audio_dir = os.path.join(tmp, 'audio')
+            make_synthetic_chunks(audio_dir, os.path.join(tmp, 'unused'), args.synthetic)
+        if audio_dir is not None:
+            audio_paths = sorted(os.path.join(audio_dir, file) for file in os.listdir(audio_dir))[:args.files]
+            out_dir = os.path.join(tmp, 'mel')
+            os.makedirs(out_dir)
+            rows.append({'mode': 'files', 'method': 'transform_to_spectrogram', 'items/sec': reference_files_per_second(audio_paths, out_dir)})
+            for batch_size in args.batch_size:
+                rows.append({'mode': 'files', 'method': f'MelFrontend batch={batch_size}',
+                             'items/sec': frontend_files_per_second(audio_paths, out_dir, frontend, batch_size)})
+    print_table(rows)
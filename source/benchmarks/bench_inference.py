@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+import time
+import torch
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import print_table
+from model import DiffWave
+from inference import InferenceEngine
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, INFERENCE_SCHEDULE
+
+#example: python source/benchmarks/bench_inference.py --threads 4
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU latency of DiffWave.sample against InferenceEngine.sample')
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--res-channels', type=int, default=RES_CHANNELS)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--fast', action='store_true', help='use INFERENCE_SCHEDULE instead of the full schedule')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = DiffWave(args.res_channels, args.num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    model.eval()
+    conditioning_var = torch.rand(args.batch_size, 1, N_MELS, 690)
+    schedule = INFERENCE_SCHEDULE if args.fast else None
+
+    outputs = {}
+    rows = []
+    for name, sampler in [('DiffWave.sample', model), ('InferenceEngine.sample', InferenceEngine(model))]:
+        torch.manual_seed(0)
+        noise = torch.randn(args.batch_size, 1, SAMPLE_RATE * SAMPLE_LENGTH_SECONDS)
+        start = time.perf_counter()
+        outputs[name] = sampler.sample(noise, conditioning_var=conditioning_var, inference_schedule=schedule)
+        rows.append({'sampler': name, 'seconds': time.perf_counter() - start})
+    rows[1]['speedup'] = rows[0]['seconds'] / rows[1]['seconds']
+    rows[1]['max abs diff'] = (outputs['DiffWave.sample'] - outputs['InferenceEngine.sample']).abs().max().item()
+    print_table(rows, ['sampler', 'seconds', 'speedup', 'max abs diff'])
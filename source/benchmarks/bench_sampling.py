@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+import time
+import torch
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import print_table
+from model import DiffWave
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS
+
+#example: python source/benchmarks/bench_sampling.py --batch-sizes 1 2 4 8
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='clips/sec of batched DiffWave.sample for different batch sizes')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--res-channels', type=int, default=RES_CHANNELS)
+    parser.add_argument('--frames', type=int, default=690, help='spectrogram frames; 690 frames are upsampled to 4 seconds at 8kHz')
+    parser.add_argument('--unconditional', action='store_true')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    with_conditioning = not args.unconditional
+    model = DiffWave(args.res_channels, args.num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, with_conditioning, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    model.eval()
+    length = SAMPLE_RATE * SAMPLE_LENGTH_SECONDS
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        conditioning_var = torch.rand(batch_size, 1, N_MELS, args.frames) if with_conditioning else None
+        noise = torch.randn(batch_size, 1, length)
+        start = time.perf_counter()
+        model.sample(noise, conditioning_var=conditioning_var)
+        elapsed = time.perf_counter() - start
+        rows.append({'batch size': batch_size, 'seconds': elapsed, 'clips/sec': batch_size / elapsed,
+                     'real-time factor': elapsed / (batch_size * SAMPLE_LENGTH_SECONDS)})
+    print_table(rows)
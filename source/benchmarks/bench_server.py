@@ -0,0 +1,124 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import http.client
+import concurrent.futures
+from urllib.parse import urlsplit
+import numpy as np
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+from benchmarks.common import print_table
+from config import N_MELS, SYNTHESIS_WINDOW_FRAMES
+
+def request(url, method, path, body=None):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=3600)
+    try:
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def wait_until_ready(url, process, timeout=300):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('server exited during startup')
+        try:
+            if request(url, 'GET', '/health')[0] == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f'server at {url} did not start within {timeout}s')
+
+def spectrogram_bytes(frames, seed):
+    buffer = io.BytesIO()
+    np.save(buffer, np.random.default_rng(seed).random((1, N_MELS, frames), dtype=np.float32))
+    return buffer.getvalue()
+
+#send n requests from a number of concurrent clients; returns requests/sec, client side latencies and status counts
+def load(url, n, clients, frames, fast):
+    path = '/synthesize?fast=1' if fast else '/synthesize'
+    bodies = [spectrogram_bytes(frames, i) for i in range(n)]
+
+    def send(body):
+        start = time.perf_counter()
+        status, _ = request(url, 'POST', path, body)
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(send, bodies))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds for status, seconds in results if status == 200]
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return len(latencies) / elapsed, latencies, statuses
+
+#seconds per clip of sample.py, which loads the model anew for every clip
+def single_shot(model_path, n, frames, fast):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'data', 'mel_spectrograms'))
+        os.makedirs(os.path.join(tmp, 'output', 'samples'))
+        name = 'request.spec.npy'
+        with open(os.path.join(tmp, 'data', 'mel_spectrograms', name), 'wb') as f:
+            f.write(spectrogram_bytes(frames, 0))
+        command = [sys.executable, os.path.join(SOURCE_DIR, 'sample.py'), os.path.abspath(model_path), name] + (['fast'] if fast else [])
+        start = time.perf_counter()
+        for _ in range(n):
+            process = subprocess.run(command, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if process.returncode != 0:
+                raise RuntimeError(f'sample.py failed: {process.stderr.decode()[-500:]}')
+        return (time.perf_counter() - start) / n
+
+#example: python source/benchmarks/bench_server.py --model output/models/best_model.pt --clients 8 --requests 32 --fast
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load generator for server.py; compares its throughput with one sample.py launch per clip')
+    parser.add_argument('--model', default='output/models/best_model.pt', help='model the server is started with (and sample.py uses)')
+    parser.add_argument('--url', default=None, help='url of a running server; a server is started on a free port if not given')
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8], help='concurrent clients; one load run per value')
+    parser.add_argument('--frames', type=int, default=SYNTHESIS_WINDOW_FRAMES)
+    parser.add_argument('--fast', action='store_true', help='use the fast inference schedule')
+    parser.add_argument('--single-shot', type=int, default=2, help='number of sample.py launches for the baseline; 0 to skip')
+    parser.add_argument('--server-args', default='', help='extra arguments for server.py, e.g. "--max-batch 16 --max-wait-ms 50"')
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if url is None:
+        port = 8000 + os.getpid() % 1000
+        url = f'http://127.0.0.1:{port}'
+        process = subprocess.Popen([sys.executable, os.path.join(SOURCE_DIR, 'server.py'), args.model, '--port', str(port)] + args.server_args.split(),
+                                   stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, process)
+        rows = []
+        for clients in args.clients:
+            requests_per_second, latencies, statuses = load(url, args.requests, clients, args.frames, args.fast)
+            row = {'mode': f'server, {clients} clients', 'clips/sec': requests_per_second}
+            if len(latencies) > 0:
+                row.update({'p50 ms': 1000 * np.percentile(latencies, 50), 'p99 ms': 1000 * np.percentile(latencies, 99)})
+            row['statuses'] = ' '.join(f'{status}:{count}' for status, count in sorted(statuses.items()))
+            rows.append(row)
+        if args.single_shot > 0:
+            try:
+                seconds = single_shot(args.model, args.single_shot, args.frames, args.fast)
+                rows.append({'mode': 'sample.py per clip', 'clips/sec': 1 / seconds, 'p50 ms': 1000 * seconds})
+            except RuntimeError as e:
+                print(e)
+        print_table(rows, ['mode', 'clips/sec', 'p50 ms', 'p99 ms', 'statuses'])
+        print(json.dumps(json.loads(request(url, 'GET', '/metrics')[1]), indent=2))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+import resource
+import tempfile
+import multiprocessing
+import torch
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import print_table
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, LEARNING_RATE
+
+#random (waveform, sample_rate, spectrogram) items with the shapes of the training data
+def synthetic_dataset(n, length=SAMPLE_RATE * SAMPLE_LENGTH_SECONDS, frames=690):
+    return torch.utils.data.TensorDataset(torch.rand(n, 1, length) * 2 - 1, torch.full((n,), SAMPLE_RATE), torch.rand(n, 1, N_MELS, frames))
+
+#train in a fresh process, so ru_maxrss is the peak memory of this mode only
+def run_mode(args, precision, grad_accum_steps, results):
+    from model import DiffWave
+    from train import train
+
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = DiffWave(args.res_channels, args.num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    #the effective batch size stays the same: accumulated micro batches are grad_accum_steps times smaller
+    trainloader = torch.utils.data.DataLoader(synthetic_dataset(args.steps * args.batch_size), batch_size=args.batch_size // grad_accum_steps)
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        train(model, optimizer, trainloader, 1, TIME_STEPS, VARIANCE_SCHEDULE, precision=precision, grad_accum_steps=grad_accum_steps, out_dir=out_dir)
+        elapsed = time.perf_counter() - start
+    results.put({'precision': precision, 'grad accum': grad_accum_steps, 'optimizer steps/sec': args.steps / elapsed,
+                 'samples/sec': args.steps * args.batch_size / elapsed, 'peak rss MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+#example: python source/benchmarks/bench_train.py --steps 20 --batch-size 6
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='training steps/sec and peak memory for precision and gradient accumulation modes')
+    parser.add_argument('--steps', type=int, default=10, help='optimizer steps per mode')
+    parser.add_argument('--batch-size', type=int, default=6, help='effective batch size per optimizer step')
+    parser.add_argument('--modes', nargs='+', default=['fp32:1', 'bf16:1', 'fp32:2', 'bf16:2'], help='precision:grad_accum_steps')
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--res-channels', type=int, default=RES_CHANNELS)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    rows = []
+    for mode in args.modes:
+        precision, grad_accum_steps = mode.split(':')
+        process = context.Process(target=run_mode, args=(args, precision, int(grad_accum_steps), results))
+        process.start()
+        rows.append(results.get())
+        process.join()
+    print_table(rows)
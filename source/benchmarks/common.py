@@ -0,0 +1,44 @@
+import time
+
+#run fn repeatedly and return the list of wall times (seconds) of the timed iterations
+def time_fn(fn, iters=10, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+#print rows (list of dicts) as a fixed width table
+def print_table(rows, columns=None):
+    if len(rows) == 0:
+        return
+    columns = columns or list(rows[0].keys())
+    cells = [[_format(row.get(column, '')) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(cell[i]) for cell in cells)) for i, column in enumerate(columns)]
+    print(' | '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    print('-+-'.join('-' * width for width in widths))
+    for cell in cells:
+        print(' | '.join(value.ljust(width) for value, width in zip(cell, widths)))
+
+def _format(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return str(value)
+
+#write n random audio chunks and matching spectrograms in the layout data_prep.py produces
+def make_synthetic_chunks(audio_dir, conditional_dir, n, sample_rate=44100, length_seconds=4, n_mels=80, frames=690):
+    import os
+    import numpy as np
+    import torch
+    import torchaudio
+
+    os.makedirs(audio_dir, exist_ok=True)
+    os.makedirs(conditional_dir, exist_ok=True)
+    for i in range(n):
+        name = f'synthetic_{i}.wav'
+        waveform = torch.rand(1, sample_rate * length_seconds) * 2 - 1
+        torchaudio.save(os.path.join(audio_dir, name), waveform, sample_rate)
+        np.save(os.path.join(conditional_dir, f'{name}.spec.npy'), np.random.rand(1, n_mels, frames).astype(np.float32))
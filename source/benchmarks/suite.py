@@ -0,0 +1,194 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import torch
+
+#make source/ importable when run as "python source/benchmarks/<script>.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.common import time_fn, print_table, make_synthetic_chunks
+from benchmarks.bench_train import synthetic_dataset
+from benchmarks.bench_dataset import items_per_second
+from model import DiffWave
+from dataset import ChunkedData
+from train import train
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, N_MELS, LEARNING_RATE, INFERENCE_SCHEDULE, SAMPLES_PER_FRAME
+
+#problem sizes of the default run and of --quick (a smoke run that finishes in well under a minute on one cpu core)
+PRESETS = {
+    'default': {
+        'forward_batch_sizes': [1, 4], 'forward_lengths': [SAMPLE_RATE, 4 * SAMPLE_RATE],
+        'forward_num_blocks': [NUM_BLOCKS // 3, NUM_BLOCKS], 'forward_res_channels': [RES_CHANNELS // 2, RES_CHANNELS],
+        'num_blocks': NUM_BLOCKS, 'res_channels': RES_CHANNELS, 'iters': 5,
+        'train_steps': 10, 'train_batch_size': 6, 'train_length': 4 * SAMPLE_RATE,
+        'sample_length': SAMPLE_RATE, 'dataset_items': 128,
+    },
+    'quick': {
+        'forward_batch_sizes': [1, 2], 'forward_lengths': [SAMPLE_RATE // 4, SAMPLE_RATE],
+        'forward_num_blocks': [2, 4], 'forward_res_channels': [8, 16],
+        'num_blocks': 4, 'res_channels': 16, 'iters': 3,
+        'train_steps': 4, 'train_batch_size': 2, 'train_length': SAMPLE_RATE,
+        'sample_length': SAMPLE_RATE // 4, 'dataset_items': 16,
+    },
+}
+
+def frames_for(length):
+    return max(1, round(length / SAMPLES_PER_FRAME))
+
+def make_model(num_blocks, res_channels):
+    return DiffWave(res_channels, num_blocks, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+
+#one result: value of a metric, whether larger values are better, and the problem size it was measured at
+def result(value, unit, higher_is_better, **params):
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better, 'params': params}
+
+#latency and throughput of a single DiffWave.forward (one denoising step) over the grid of batch size, length and model size
+def bench_forward(preset):
+    results = {}
+    grid = itertools.product(preset['forward_num_blocks'], preset['forward_res_channels'], preset['forward_batch_sizes'], preset['forward_lengths'])
+    for num_blocks, res_channels, batch_size, length in grid:
+        torch.manual_seed(0)
+        model = make_model(num_blocks, res_channels).eval()
+        x = torch.randn(batch_size, 1, length)
+        t = torch.randint(0, TIME_STEPS, (batch_size,))
+        conditioning_var = torch.rand(batch_size, 1, N_MELS, frames_for(length))
+        with torch.no_grad():
+            seconds = statistics.median(time_fn(lambda: model(x, t, conditioning_var), iters=preset['iters']))
+        params = {'num_blocks': num_blocks, 'res_channels': res_channels, 'batch_size': batch_size, 'length': length}
+        name = f'forward/blocks={num_blocks},channels={res_channels},batch={batch_size},length={length}'
+        results[f'{name}/latency_ms'] = result(1000 * seconds, 'ms', False, **params)
+        results[f'{name}/samples_per_sec'] = result(batch_size * length / seconds, 'waveform samples/sec', True, **params)
+    return results
+
+#optimizer steps/sec of train() on random data, including noising, backward and the optimizer
+def bench_train(preset):
+    num_blocks, res_channels, batch_size, steps = preset['num_blocks'], preset['res_channels'], preset['train_batch_size'], preset['train_steps']
+    length = preset['train_length']
+    torch.manual_seed(0)
+    model = make_model(num_blocks, res_channels)
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    with tempfile.TemporaryDirectory() as out_dir:
+        #one step first, so one-time setup (allocator, thread pools) is not measured
+        warmup = torch.utils.data.DataLoader(synthetic_dataset(batch_size, length, frames_for(length)), batch_size=batch_size)
+        train(model, optimizer, warmup, 1, TIME_STEPS, VARIANCE_SCHEDULE, out_dir=out_dir)
+        trainloader = torch.utils.data.DataLoader(synthetic_dataset(steps * batch_size, length, frames_for(length)), batch_size=batch_size)
+        start = time.perf_counter()
+        train(model, optimizer, trainloader, 1, TIME_STEPS, VARIANCE_SCHEDULE, out_dir=out_dir)
+        elapsed = time.perf_counter() - start
+    params = {'num_blocks': num_blocks, 'res_channels': res_channels, 'batch_size': batch_size, 'length': length, 'steps': steps}
+    return {'train/steps_per_sec': result(steps / elapsed, 'steps/sec', True, **params)}
+
+#real-time factor of DiffWave.sample: seconds of compute per second of generated audio, for the full and the fast schedule
+def bench_sample(preset):
+    num_blocks, res_channels, length = preset['num_blocks'], preset['res_channels'], preset['sample_length']
+    torch.manual_seed(0)
+    model = make_model(num_blocks, res_channels).eval()
+    conditioning_var = torch.rand(1, 1, N_MELS, frames_for(length))
+    results = {}
+    for schedule_name, schedule in (('full', None), ('fast', INFERENCE_SCHEDULE)):
+        noise = torch.randn(1, 1, length)
+        seconds = statistics.median(time_fn(lambda: model.sample(noise.clone(), conditioning_var, schedule), iters=1, warmup=0 if schedule is None else 1))
+        steps = TIME_STEPS if schedule is None else len(schedule)
+        results[f'sample/{schedule_name}/real_time_factor'] = result(seconds / (length / SAMPLE_RATE), 'sec/audio sec', False,
+                                                                      num_blocks=num_blocks, res_channels=res_channels, length=length, steps=steps)
+    return results
+
+#items/sec of ChunkedData on generated wav files and spectrograms, read directly and through a DataLoader
+def bench_dataset(preset):
+    n = preset['dataset_items']
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_dir, conditional_dir = os.path.join(tmp, 'audio'), os.path.join(tmp, 'mel')
+        make_synthetic_chunks(audio_dir, conditional_dir, n)
+        dataset = ChunkedData(audio_dir, conditional_dir)
+        return {
+            'dataset/chunked/getitem_items_per_sec': result(items_per_second(dataset, n), 'items/sec', True, items=n),
+            'dataset/chunked/loader_items_per_sec': result(items_per_second(dataset, n, batch_size=6), 'items/sec', True, items=n, batch_size=6),
+        }
+
+BENCHMARKS = {'forward': bench_forward, 'train': bench_train, 'sample': bench_sample, 'dataset': bench_dataset}
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'threads': torch.get_num_threads(),
+        'cuda': torch.cuda.is_available(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+#relative change of every metric that is in both runs; a metric regressed if it got worse by more than tolerance
+def compare(results, baseline, tolerance):
+    rows = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['value'], current['value']
+        change = (after - before) / before if before != 0 else 0.0
+        worse = -change if current['higher_is_better'] else change
+        rows.append({'metric': name, 'baseline': before, 'current': after, 'change %': 100 * change,
+                     'status': 'REGRESSION' if worse > tolerance else 'improved' if -worse > tolerance else 'ok'})
+    return rows
+
+#example: python source/benchmarks/suite.py --quick --out output/benchmarks/results.json --baseline output/benchmarks/baseline.json
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark suite on synthetic data: forward latency, train steps/sec, sampling real-time factor and dataset items/sec')
+    parser.add_argument('--only', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help='small problem sizes for a fast smoke run')
+    parser.add_argument('--out', default='output/benchmarks/results.json', help='json file the results are written to')
+    parser.add_argument('--baseline', default=None, help='json file of an earlier run to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change that counts as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 if a metric regressed')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    preset_name = 'quick' if args.quick else 'default'
+    preset = PRESETS[preset_name]
+
+    results = {}
+    errors = {}
+    for name in args.only:
+        start = time.perf_counter()
+        #a benchmark that cannot run here (e.g. no audio backend for torchaudio) is reported, the others still run
+        try:
+            results.update(BENCHMARKS[name](preset))
+        except Exception as e:
+            errors[name] = f'{type(e).__name__}: {e}'
+            print(f'{name}: failed with {errors[name]}')
+            continue
+        print(f'{name}: {time.perf_counter() - start:.1f}s')
+    print_table([{'metric': name, 'value': r['value'], 'unit': r['unit']} for name, r in results.items()])
+
+    run = {'preset': preset_name, 'environment': environment(), 'results': results, 'errors': errors}
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f'Saved results to {args.out}')
+
+    regressed = False
+    if args.baseline is not None:
+        if args.save_baseline:
+            os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+            with open(args.baseline, 'w') as f:
+                json.dump(run, f, indent=2)
+            print(f'Saved baseline to {args.baseline}')
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline['preset'] != preset_name:
+                print(f'warning: baseline was measured with preset {baseline["preset"]}, this run with {preset_name}')
+            rows = compare(results, baseline['results'], args.tolerance)
+            print_table(rows)
+            regressed = any(row['status'] == 'REGRESSION' for row in rows)
+    if (regressed or len(errors) > 0) and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,137 @@
+import os
+import re
+import queue
+import random
+import threading
+import numpy as np
+import torch
+from config import KEEP_CHECKPOINTS
+
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_(\d+)\.pt$')
+
+#copy all tensors of a (nested) state dict to the cpu, so the snapshot does not change while training continues
+def _to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+def rng_state():
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        'numpy': np.random.get_state(),
+        'python': random.getstate(),
+    }
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+#writes training checkpoints on a background thread; files are renamed into place when complete and only the newest keep_last are kept
+#(keep_last None or <= 0 keeps all checkpoints)
+class CheckpointManager:
+
+    def __init__(self, directory, keep_last=KEEP_CHECKPOINTS, max_pending=2) -> None:
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        #bounded, so at most max_pending snapshots are held in memory if the disk is slower than training
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    #model, optimizer, scheduler, EMA, noise schedule and rng state plus any training bookkeeping (epoch, step, best loss, ...) as a cpu copy
+    def snapshot(self, model, optimizer, scheduler=None, ema=None, **train_state):
+        return _to_cpu({
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'ema': ema.checkpoint_state() if ema is not None else None,
+            'noise_schedule': model.noise_schedule.state() if hasattr(model, 'noise_schedule') else None,
+            'rng': rng_state(),
+            'train_state': train_state,
+        })
+
+    #queue a full checkpoint for writing as checkpoint_<step>.pt
+    def save(self, step, model, optimizer, scheduler=None, ema=None, **train_state):
+        self._put(os.path.join(self.directory, f'checkpoint_{step:08d}.pt'), self.snapshot(model, optimizer, scheduler, ema, **train_state), rotate=True)
+
+    #queue a weights only file, e.g. best_model.pt, as loaded by sample.py; model can also be an EMA
+    def save_weights(self, model, path):
+        self.save_state_dict(model.state_dict(), path)
+
+    def save_state_dict(self, state_dict, path):
+        self._put(path, _to_cpu(state_dict), rotate=False)
+
+    def _put(self, path, state, rotate):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((path, state, rotate))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            path, state, rotate = item
+            try:
+                #write to a temporary file first, so a crash never leaves a truncated checkpoint behind
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                if rotate:
+                    self._rotate()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _rotate(self):
+        if self.keep_last is None or self.keep_last <= 0:
+            return
+        for path in self.checkpoints()[:-self.keep_last]:
+            os.remove(path)
+
+    #paths of all complete checkpoints, oldest first
+    def checkpoints(self):
+        names = [name for name in os.listdir(self.directory) if CHECKPOINT_PATTERN.match(name)]
+        names.sort(key=lambda name: int(CHECKPOINT_PATTERN.match(name).group(1)))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if len(checkpoints) > 0 else None
+
+    #restore model, optimizer, scheduler, EMA and rng state from a checkpoint; returns the training bookkeeping
+    def load(self, path, model, optimizer=None, scheduler=None, map_location='cpu', ema=None):
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        if state.get('noise_schedule') is not None and not model.noise_schedule.matches(state['noise_schedule']['variance_schedule']):
+            raise ValueError(f'{path} was trained with another noise schedule than the model (see NOISE_SCHEDULE and VARIANCE_SCHEDULE in config.py)')
+        model.load_state_dict(state['model'])
+        if optimizer is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None and state['scheduler'] is not None:
+            scheduler.load_state_dict(state['scheduler'])
+        if ema is not None and state.get('ema') is not None:
+            ema.load_checkpoint_state(state['ema'])
+        set_rng_state(state['rng'])
+        return state['train_state']
+
+    #block until all queued files are written
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
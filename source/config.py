@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from diffusion import variance_schedule
 
 EPOCHS = 10000
 BATCH_SIZE = 6 #16
@@ -8,7 +9,8 @@ NUM_BLOCKS = 30 #36
 RES_CHANNELS = 64 #256
 TIMESTEP_LAYER_WIDTH = 512 #512
 TIME_STEPS = 50
-VARIANCE_SCHEDULE = torch.linspace(1e-4, 0.05, TIME_STEPS) #torch.linspace(10e-4, 0.05, TIME_STEPS)
+NOISE_SCHEDULE = 'linear' #'linear' (1e-4 to 0.05, as in the paper) or 'cosine'; set VARIANCE_SCHEDULE explicitly for a custom schedule
+VARIANCE_SCHEDULE = variance_schedule(NOISE_SCHEDULE, TIME_STEPS) #torch.linspace(10e-4, 0.05, TIME_STEPS)
 SAMPLE_RATE = 8000 #16000 #22050 #44100
 SAMPLE_LENGTH_SECONDS = 4
 MAX_SAMPLES = 9000 #9000 # Use "None" for all samples in data input folder; 1000 = ~1h 6min
@@ -22,4 +24,65 @@ N_MELS=80
 FMIN=20.0
 FMAX=SAMPLE_RATE/2
 POWER=1.0
-NORMALIZED=True
\ No newline at end of file
+NORMALIZED=True
+
+#CONFIG PACKED DATASET
+PACKED_DATA_DIR='data/packed'
+SHARD_SIZE=1024 #number of audio chunks (and spectrograms) per shard file
+
+#CONFIG DATA PREP PIPELINE
+PREP_WORKERS=4 #number of processes used by data_prep.py
+MEL_BATCH_SIZE=32 #number of chunks transformed to mel spectrograms at once
+AUDIO_EXTENSIONS=('.wav', '.mp3') #audio files read from source and chunk folders; other files in them are ignored
+
+#CONFIG FAST SAMPLING
+INFERENCE_SCHEDULE = [0.0001, 0.001, 0.01, 0.05, 0.2, 0.5] #betas of the reduced reverse process (fast sampling), mapped onto VARIANCE_SCHEDULE
+CONDITIONER_CACHE_MAX_BYTES = 256 * 2**20 #per block conditioner projections are kept over all sampling steps if they fit, otherwise recomputed in every step
+
+#CONFIG VARIABLE LENGTH SYNTHESIS
+SOURCE_SAMPLE_RATE=44100 #sample rate of the chunks the mel spectrograms are computed from (data_prep.py keeps the source sample rate)
+SAMPLES_PER_FRAME=SAMPLE_RATE*HOP_LENGTH/SOURCE_SAMPLE_RATE #waveform samples at SAMPLE_RATE per mel spectrogram frame
+SYNTHESIS_WINDOW_FRAMES=690 #spectrogram frames per window in chunked synthesis; 690 frames = 4 seconds, the length the conditioner is tuned for
+SYNTHESIS_BATCH_SIZE=2 #number of windows denoised together in chunked synthesis
+
+#CONFIG TRAINING PERFORMANCE
+PRECISION='fp32' #'fp32', 'bf16' (autocast on cpu and cuda) or 'fp16' (cuda only, with gradient scaling)
+GRAD_ACCUM_STEPS=1 #number of batches whose gradients are accumulated per optimizer step; effective batch size = BATCH_SIZE * GRAD_ACCUM_STEPS
+
+#CONFIG DATA LOADING AND DISTRIBUTED TRAINING
+NUM_WORKERS=4 #DataLoader worker processes per training process
+SEED=0 #seed of model initialization and distributed shuffling
+
+#CONFIG CHECKPOINTING
+CHECKPOINT_EVERY=500 #steps between full training checkpoints (model, optimizer, rng state) in output/models/checkpoints
+KEEP_CHECKPOINTS=3 #number of newest checkpoints that are kept; 0 keeps all of them
+
+#CONFIG METRICS LOGGING
+METRIC_BACKENDS=['jsonl'] #any of 'jsonl', 'csv' (written to output/) and 'wandb'
+LOG_EVERY=50 #steps between reading the loss back from the device and writing a metrics record
+WANDB_PROJECT='DiffWave'
+WANDB_ENTITY='daavidhauser'
+
+#CONFIG INFERENCE SERVER
+SERVER_MAX_BATCH=4 #maximum number of requests denoised together in one reverse diffusion pass
+SERVER_MAX_WAIT_MS=20 #how long the oldest request waits for others to join its batch
+SERVER_MAX_QUEUE=64 #requests waiting or in progress; further requests are rejected with 503
+
+#CONFIG FEATURE CACHE
+FEATURE_CACHE_DIR='data/feature_cache' #resampled waveforms and mel spectrograms keyed by audio content and transform params; None to disable
+FEATURE_CACHE_MAX_BYTES=10 * 2**30 #least recently used features are deleted beyond this size
+
+#CONFIG STREAMING DATASET
+STREAM_SHUFFLE_BUFFER=128 #random crops held per DataLoader worker to shuffle crops of different source files
+
+#CONFIG LENGTH BUCKETING
+BATCH_MAX_SAMPLES=None #if set, clips of a chunk folder are batched by length up to this many (padded) waveform samples per batch instead of BATCH_SIZE clips, e.g. 6 * SAMPLE_RATE * SAMPLE_LENGTH_SECONDS
+
+#CONFIG ACTIVATION CHECKPOINTING
+CHECKPOINT_BLOCKS=0 #residual blocks per activation checkpointing segment in training (their activations are recomputed in backward); 0 keeps all activations
+
+#CONFIG EMA AND VALIDATION
+EMA_DECAY=0.999 #decay of the exponential moving average of the weights, updated every optimizer step; None disables EMA
+VALIDATION_EVERY=2000 #steps between validations of the EMA weights in a background process; 0 disables validation
+VALIDATION_SAMPLES=8 #items held out from the end of the dataset for validation
+VALIDATION_THREADS=1 #cpu threads of the validation process
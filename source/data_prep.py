@@ -1,16 +1,58 @@
 import os
 import sys
-from pydub import AudioSegment
-from config import MAX_SAMPLES, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, WINDOW_LENGTH, HOP_LENGTH, N_FFT, N_MELS, FMIN, FMAX, POWER, NORMALIZED, N_FFT, N_MELS, FMIN, FMAX, POWER, NORMALIZED, FMIN, FMAX, POWER, NORMALIZED
+import json
+import argparse
+import multiprocessing
+from config import MAX_SAMPLES, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, WINDOW_LENGTH, HOP_LENGTH, N_FFT, N_MELS, FMIN, FMAX, POWER, NORMALIZED, PREP_WORKERS, MEL_BATCH_SIZE, FEATURE_CACHE_DIR, AUDIO_EXTENSIONS
+from feature_cache import FeatureCache, mel_params, params_hash, content_hash, file_hash
+from features import MelFrontend
 import torchaudio
 import numpy as np
 import torch
-#Note: ffmpeg package required for pydub
+from tqdm import tqdm
+#Note: ffmpeg (or sox) backend required by torchaudio to decode .mp3 files
+
+#the manifest lives next to the chunk folder (e.g. data/chunked_audio.manifest.json), so it never becomes a training item
+MANIFEST_SUFFIX = '.manifest.json'
+LEGACY_MANIFEST_FILE = 'manifest.json' #inside the chunk folder, as written by earlier versions
+
+_mel_transforms = {}
+
+#build the MelSpectrogram transform once per process and parameter set
+def get_mel_transform(
+    sample_rate = SAMPLE_RATE,
+    win_length= WINDOW_LENGTH,
+    hop_length= HOP_LENGTH,
+    n_fft=N_FFT,
+    f_min=FMIN,
+    f_max = FMAX,
+    n_mels = N_MELS,
+    power = POWER,
+    normalized = NORMALIZED,
+):
+    key = (sample_rate, win_length, hop_length, n_fft, f_min, f_max, n_mels, power, normalized)
+    if key not in _mel_transforms:
+        _mel_transforms[key] = torchaudio.transforms.MelSpectrogram(
+            sample_rate=sample_rate,
+            win_length=win_length,
+            hop_length=hop_length,
+            n_fft=n_fft,
+            f_min=f_min,
+            f_max=f_max,
+            n_mels=n_mels,
+            power=power,
+            normalized=normalized)
+    return _mel_transforms[key]
+
+#log compression and normalization of a (batch of) mel spectrograms to [0, 1]
+def compress_spectrogram(mel_spectrogram):
+    mel_spectrogram = 20 * torch.log10(torch.clamp(mel_spectrogram, min=1e-5)) - 20
+    return torch.clamp((mel_spectrogram + 100) / 100, 0.0, 1.0)
 
 def transform_to_spectrogram(
-    audio_path: str, 
-    out_path='data/mel_spectrograms', 
-    sample_rate = SAMPLE_RATE, 
+    audio_path: str,
+    out_path='data/mel_spectrograms',
+    sample_rate = SAMPLE_RATE,
     win_length= WINDOW_LENGTH,
     hop_length= HOP_LENGTH,
     n_fft=N_FFT,
@@ -19,84 +61,156 @@ def transform_to_spectrogram(
     n_mels = N_MELS,
     power = POWER,
     normalized = NORMALIZED,
+    cache=None,
 ):
     if not os.path.exists(out_path):
-        raise 'out_dir does not exist'
+        raise ValueError('out_dir does not exist')
     if not os.path.isfile(audio_path):
-        raise 'given wav_path is not a file'
+        raise ValueError('given wav_path is not a file')
 
     filename = os.path.basename(audio_path)
 
-    audio = torchaudio.load(audio_path)[0]
-    mel_spectrogram = torchaudio.transforms.MelSpectrogram(
-        sample_rate=sample_rate,
-        win_length=win_length,
-        hop_length=hop_length,
-        n_fft=n_fft,
-        f_min=f_min,
-        f_max=f_max,
-        n_mels=n_mels,
-        power=power,
-        normalized=normalized)(audio)
-    mel_spectrogram = 20 * torch.log10(torch.clamp(mel_spectrogram, min=1e-5)) - 20
-    mel_spectrogram = torch.clamp((mel_spectrogram + 100) / 100, 0.0, 1.0)
-    np.save(os.path.join(out_path, f'{filename}.spec.npy'), mel_spectrogram.cpu().numpy())
+    def compute():
+        audio = torchaudio.load(audio_path)[0]
+        mel_spectrogram = get_mel_transform(sample_rate, win_length, hop_length, n_fft, f_min, f_max, n_mels, power, normalized)(audio)
+        return compress_spectrogram(mel_spectrogram).cpu().numpy()
 
+    if cache is not None:
+        params = mel_params(sample_rate, win_length, hop_length, n_fft, f_min, f_max, n_mels, power, normalized)
+        mel_spectrogram = cache.get_or_compute(params, file_hash(audio_path), compute)
+    else:
+        mel_spectrogram = compute()
+    np.save(os.path.join(out_path, f'{filename}.spec.npy'), mel_spectrogram)
 
 
-#load data of one wav and split it into chunks
-def chop_wav(song_id: str, audio_path: str, out_dir: str, length: int):
+#state of a pool worker, set once by _init_worker
+_worker = {}
 
-    print('audio_path: ', audio_path)
-    #check if out_dir exists
-    if not os.path.exists(out_dir):
-        raise 'out_dir does not exist'
-    if not os.path.isfile(audio_path):
-        raise 'given wav_path is not a file'
-
-    #load audio
-    if audio_path.endswith('.wav'):
-        audio = AudioSegment.from_wav(audio_path)
-        file_ending = '.wav'
-    elif audio_path.endswith('.mp3'):
-        audio = AudioSegment.from_mp3(audio_path)
-        file_ending = '.mp3'
-    else:
-        raise 'wav_path must be a .wav or .mp3 file'
+def _init_worker(counter, max_samples, audio_out_dir, mel_out_dir, length, batch_size, cache_dir):
+    torch.set_num_threads(1) #parallelism comes from the process pool
+    cache = FeatureCache(cache_dir) if cache_dir is not None else None
+    _worker.update(counter=counter, max_samples=max_samples, audio_out_dir=audio_out_dir, mel_out_dir=mel_out_dir, length=length, batch_size=batch_size, cache=cache,
+                   frontend=MelFrontend())
+
+#reserve up to n chunks from the shared sample counter; returns the number of chunks that may be written
+def _reserve(counter, max_samples, n):
+    with counter.get_lock():
+        if max_samples is not None:
+            n = max(0, min(n, max_samples - counter.value))
+        counter.value += n
+    return n
+
+#decode one source file, chop it in memory and write chunks with their mel spectrograms; returns the chunk names and
+#the number of chunks the source has (more than were written if max_samples was reached)
+def process_file(audio_path):
+    waveform, sample_rate = torchaudio.load(audio_path) # channels, length
+    chunk_size = sample_rate * _worker['length'] // 1000
+    available = waveform.shape[1] // chunk_size
+    n_chunks = _reserve(_worker['counter'], _worker['max_samples'], available)
+
+    #channels, n_chunks * chunk_size -> n_chunks, channels, chunk_size
+    chunks = waveform[:, :n_chunks * chunk_size].reshape(waveform.shape[0], n_chunks, chunk_size).transpose(0, 1)
 
-    start = 0
-    end = length
-    n_iters = int(len(audio)) // (SAMPLE_LENGTH_SECONDS * 1000)
+    song_id = os.path.splitext(os.path.basename(audio_path))[0]
+    frontend = _worker['frontend']
+    cache, params = _worker['cache'], mel_params()
+    names = []
+    for batch_start in range(0, n_chunks, _worker['batch_size']):
+        batch = chunks[batch_start:batch_start + _worker['batch_size']]
+        if cache is not None:
+            #chunks are keyed by their samples, so only chunks that are new or were made with other mel params are transformed
+            keys = [content_hash(chunk.numpy().tobytes()) for chunk in batch]
+            mel_spectrograms = [cache.get(params, key) for key in keys]
+            missing = [i for i, mel_spectrogram in enumerate(mel_spectrograms) if mel_spectrogram is None]
+            if len(missing) > 0:
+                computed = frontend(batch[missing]).numpy()
+                for i, mel_spectrogram in zip(missing, computed):
+                    cache.put(params, keys[i], mel_spectrogram)
+                    mel_spectrograms[i] = mel_spectrogram
+        else:
+            mel_spectrograms = frontend(batch).numpy() # batch, channels, n_mels, frames
+        for i in range(batch.shape[0]):
+            start = (batch_start + i) * _worker['length']
+            name = '{}_{}.wav'.format(song_id, start)
+            torchaudio.save(os.path.join(_worker['audio_out_dir'], name), batch[i], sample_rate)
+            np.save(os.path.join(_worker['mel_out_dir'], f'{name}.spec.npy'), mel_spectrograms[i])
+            names.append(name)
+    return audio_path, names, available
 
+def manifest_path(out_dir):
+    return os.path.normpath(out_dir) + MANIFEST_SUFFIX
 
-    for i in range(n_iters):
-        #break if max samples reached
-        if len(os.listdir(chopped_audio_out_path)) >= (MAX_SAMPLES):
-            break
-        newAudio = audio[start:end]
-        newAudio.export(os.path.join(out_dir, '{}_{}{}'.format(song_id, start, file_ending)), format="wav")
-        start += length
-        end += length
+def load_manifest(out_dir):
+    for path in [manifest_path(out_dir), os.path.join(out_dir, LEGACY_MANIFEST_FILE)]:
+        if os.path.isfile(path):
+            with open(path) as f:
+                return json.load(f)
+    return {}
+
+#writes the manifest next to out_dir and removes a manifest of an earlier version from inside it
+def save_manifest(out_dir, manifest):
+    path = manifest_path(out_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    legacy_path = os.path.join(out_dir, LEGACY_MANIFEST_FILE)
+    if os.path.isfile(legacy_path):
+        os.remove(legacy_path)
+
+#size and mtime of a source, and the mel params its spectrograms are made with
+def _source_stamp(audio_path):
+    stat = os.stat(audio_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'features': params_hash(mel_params())}
+
+#chop all files in in_path and compute their spectrograms; sources recorded in the manifest with the current mel params are skipped,
+#unless max_samples stopped them before all their chunks were written (a later run with a larger max_samples continues them)
+def prepare(in_path, audio_out_dir, mel_out_dir, length, max_samples=MAX_SAMPLES, workers=PREP_WORKERS, batch_size=MEL_BATCH_SIZE, cache_dir=FEATURE_CACHE_DIR):
+    for out_dir in [audio_out_dir, mel_out_dir]:
+        if not os.path.exists(out_dir):
+            raise ValueError(f'{out_dir} does not exist')
+
+    manifest = load_manifest(audio_out_dir)
+    sources = []
+    song_ids = {}
+    for file in sorted(os.listdir(in_path)):
+        audio_path = os.path.join(in_path, file)
+        if not file.endswith(AUDIO_EXTENSIONS) or not os.path.isfile(audio_path):
+            continue
+        #chunks are named after the file name without extension, so e.g. a.wav and a.mp3 would write the same chunks
+        song_id = os.path.splitext(file)[0]
+        if song_id in song_ids:
+            raise ValueError(f'{song_ids[song_id]} and {file} in {in_path} would write the same chunk files; rename one of them')
+        song_ids[song_id] = file
+        entry = manifest.get(audio_path)
+        stamp = _source_stamp(audio_path)
+        if entry is not None and entry.get('complete', False) and all(entry.get(key) == value for key, value in stamp.items()):
+            continue
+        sources.append(audio_path)
+
+    #chunks of already processed sources count towards max_samples; stale and incomplete sources are processed again
+    counter = multiprocessing.Value('i', sum(len(entry['chunks']) for audio_path, entry in manifest.items() if audio_path not in sources))
+    if max_samples is not None and counter.value >= max_samples:
+        print('max samples reached, nothing to do')
+        return manifest
+
+    print(f'Processing {len(sources)} files ({len(manifest)} already done) with {workers} workers')
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(counter, max_samples, audio_out_dir, mel_out_dir, length, batch_size, cache_dir)) as pool:
+        for audio_path, names, available in tqdm(pool.imap_unordered(process_file, sources), total=len(sources)):
+            manifest[audio_path] = {**_source_stamp(audio_path), 'chunks': names, 'complete': len(names) == available}
+            save_manifest(audio_out_dir, manifest)
+    return manifest
 
 if __name__ == '__main__':
-    in_path=os.path.join('raw_samples')
-    chopped_audio_out_path=os.path.join('data/chunked_audio')
-    sample_length = SAMPLE_LENGTH_SECONDS * 1000 #milliseconds
-
-    if len(sys.argv) > 1:
-        in_path = sys.argv[1]
-    if len(sys.argv) > 2:
-        chopped_audio_out_path = sys.argv[2]
-    if len(sys.argv) > 3:
-        sample_length = int(sys.argv[3])
-
-    #loop over files in audio_folder_path
-    for i, file in enumerate(os.listdir(in_path)):
-        #break if max samples reached
-        if len(os.listdir(chopped_audio_out_path)) >= (MAX_SAMPLES):
-            break
-        chop_wav(i, os.path.join(in_path, file), chopped_audio_out_path, sample_length)
-
-    #generate mel spectrograms from chopped audio
-    for i, file in enumerate(os.listdir(chopped_audio_out_path)):
-        transform_to_spectrogram(os.path.join(chopped_audio_out_path, file), out_path='data/mel_spectrograms')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='chop audio files into fixed length chunks and compute their mel spectrograms')
+    parser.add_argument('in_path', nargs='?', default=os.path.join('raw_samples'))
+    parser.add_argument('chopped_audio_out_path', nargs='?', default=os.path.join('data/chunked_audio'))
+    parser.add_argument('sample_length', nargs='?', type=int, default=SAMPLE_LENGTH_SECONDS * 1000, help='chunk length in milliseconds')
+    parser.add_argument('--mel-out', default=os.path.join('data/mel_spectrograms'))
+    parser.add_argument('--workers', type=int, default=PREP_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=MEL_BATCH_SIZE, help='number of chunks per mel spectrogram batch')
+    parser.add_argument('--cache-dir', default=FEATURE_CACHE_DIR, help='feature cache of feature_cache.py')
+    parser.add_argument('--no-cache', action='store_true', help='compute all spectrograms without the feature cache')
+    args = parser.parse_args()
+
+    prepare(args.in_path, args.chopped_audio_out_path, args.mel_out, args.sample_length, workers=args.workers, batch_size=args.batch_size,
+            cache_dir=None if args.no_cache else args.cache_dir)
@@ -1,47 +1,358 @@
 import os
 import sys
+import json
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, DistributedSampler, get_worker_info
 import torchaudio
-from config import SAMPLE_RATE
+from config import SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, HOP_LENGTH, SOURCE_SAMPLE_RATE, SAMPLES_PER_FRAME, STREAM_SHUFFLE_BUFFER, FEATURE_CACHE_DIR, AUDIO_EXTENSIONS
+from feature_cache import FeatureCache, waveform_params, mel_params, file_hash
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class ChunkedData(Dataset):
 
-    def __init__(self, audio_dir, conditional_dir=None, max_samples=None) -> None:
+    def __init__(self, audio_dir, conditional_dir=None, max_samples=None, cache=None) -> None:
         self.audio_dir = audio_dir
         self.conditional_dir = conditional_dir
         self.max_samples = max_samples
-        count = 0
-        # Iterate directory to find total number of samples in training data
-        for path in os.listdir(self.audio_dir):
-            if os.path.isfile(os.path.join(self.audio_dir, path)):
-                count += 1
-        self.length = count
+        #optional FeatureCache of feature_cache.py; resampled waveforms are then computed once instead of on every fetch
+        self.cache = cache
+        # list directory once; sorted, so the order is stable across workers and runs; only audio files are items
+        self.audio_files = sorted(path for path in os.listdir(self.audio_dir) if path.endswith(AUDIO_EXTENSIONS) and os.path.isfile(os.path.join(self.audio_dir, path)))
+        self.length = len(self.audio_files)
 
 
     def __len__(self):
         return self.length if self.max_samples is None or self.max_samples > self.length else self.max_samples
 
-    def __getitem__(self, index):
-        audio_file = os.listdir(self.audio_dir)[index]
+    def _load_waveform(self, path):
         #load audio file
-        waveform, sample_rate = torchaudio.load(os.path.join(self.audio_dir, audio_file))
+        waveform, sample_rate = torchaudio.load(path)
 
         #resample if sample rate is higher than SAMPLE_RATE from config.py
         if sample_rate != SAMPLE_RATE:
             waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=SAMPLE_RATE)
-        waveform = waveform[0:1,:] #get single channel waveform from waveform with two channels; slicing [0:1] to preserve dimensions
-        
+        return waveform[0:1,:] #get single channel waveform from waveform with two channels; slicing [0:1] to preserve dimensions
+
+    def __getitem__(self, index):
+        audio_file = self.audio_files[index]
+        path = os.path.join(self.audio_dir, audio_file)
+        if self.cache is not None:
+            waveform = torch.from_numpy(self.cache.get_or_compute(waveform_params(), file_hash(path), lambda: self._load_waveform(path).numpy()))
+        else:
+            waveform = self._load_waveform(path)
+
         #load conditioning variable (spectrogram) from .npy numpy file
         conditioning_var = None
         if self.conditional_dir is not None:
-            conditional_file = os.listdir(self.conditional_dir)[index]
+            # spectrogram of a chunk is stored as '<chunk file name>.spec.npy' by data_prep.py
+            conditional_file = f'{audio_file}.spec.npy'
             conditioning_var = torch.from_numpy(np.load(os.path.join(self.conditional_dir, conditional_file)))
             conditioning_var = conditioning_var[0:1,:, :] #get single channel spectrogram slicing [0:1] to preserve dimensions
             return waveform, SAMPLE_RATE, conditioning_var
         else:
-            return waveform, SAMPLE_RATE
\ No newline at end of file
+            return waveform, SAMPLE_RATE
+
+    #waveform length (samples at SAMPLE_RATE) of every item, for length bucketing; estimated from the spectrogram
+    #headers if there are spectrograms, so no audio has to be decoded
+    def lengths(self):
+        lengths = []
+        for index in range(len(self)):
+            if self.conditional_dir is not None:
+                frames = np.load(os.path.join(self.conditional_dir, f'{self.audio_files[index]}.spec.npy'), mmap_mode='r').shape[-1]
+                lengths.append(round((frames - 1) * SAMPLES_PER_FRAME))
+            else:
+                lengths.append(self[index][0].shape[-1])
+        return lengths
+
+#dataset backed by the sharded store written by pack_data.py; items are zero-copy views into memory mapped shards
+class PackedData(Dataset):
+
+    def __init__(self, store_dir, max_samples=None, with_conditioning=True) -> None:
+        self.store_dir = store_dir
+        self.max_samples = max_samples
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        self.with_conditioning = with_conditioning and self.index['mel_shape'] is not None
+        self.items = [(item['shard'], item['row']) for item in self.index['items']]
+        self.length = len(self.items)
+        #shards are mapped lazily, so every DataLoader worker opens its own memory maps
+        self.audio_shards = {}
+        self.mel_shards = {}
+
+    def __len__(self):
+        return self.length if self.max_samples is None or self.max_samples > self.length else self.max_samples
+
+    def _shard(self, shards, shard_id, key):
+        if shard_id not in shards:
+            # copy-on-write mapping: writable for torch.from_numpy, but nothing is written back to disk
+            shards[shard_id] = np.load(os.path.join(self.store_dir, self.index['shards'][shard_id][key]), mmap_mode='c')
+        return shards[shard_id]
+
+    def __getitem__(self, index):
+        shard_id, row = self.items[index]
+        waveform = torch.from_numpy(self._shard(self.audio_shards, shard_id, 'audio')[row]).unsqueeze(0)
+        if self.with_conditioning:
+            conditioning_var = torch.from_numpy(self._shard(self.mel_shards, shard_id, 'mel')[row]).unsqueeze(0)
+            return waveform, SAMPLE_RATE, conditioning_var
+        else:
+            return waveform, SAMPLE_RATE
+
+#sample rate and length of a decoded source file, stored in the feature cache next to its waveform and mel spectrogram
+def source_info_params():
+    return {'kind': 'source_info', 'version': 1}
+
+#mel spectrogram of a whole source file, computed from the source resampled to SOURCE_SAMPLE_RATE, so crops of sources
+#with any sample rate have the same number of frames (mels cached at the native rate have other params and are not reused)
+def source_mel_params():
+    return {**mel_params(), 'source_sample_rate': SOURCE_SAMPLE_RATE}
+
+#source info, mel spectrogram (channels, n_mels, frames) and resampled first channel (1, length) of a whole source file,
+#computed like ChunkedData and data_prep.py do for chunks, from one decode; keyed by the kind of their feature params
+def _decode_source_features(path):
+    from features import MelFrontend
+    waveform, sample_rate = torchaudio.load(path)
+    mel_waveform = waveform
+    if sample_rate != SOURCE_SAMPLE_RATE:
+        mel_waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=SOURCE_SAMPLE_RATE)
+    features = {'source_info': np.array([sample_rate, waveform.shape[1]], dtype=np.int64), 'mel': MelFrontend()(mel_waveform).numpy()}
+    if sample_rate != SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=SAMPLE_RATE)
+    features['waveform'] = waveform[0:1, :].numpy()
+    return features
+
+def _compute_source_features(cache, path, key):
+    features = _decode_source_features(path)
+    for params in (source_info_params(), source_mel_params(), waveform_params()):
+        cache.put(params, key, features[params['kind']])
+
+#random crops drawn on the fly from long source files (e.g. raw_samples) instead of pre-chopped chunks. Resampled waveform
+#and mel spectrogram of every source are computed once into the feature cache and memory mapped from there; waveform and
+#mel crops are aligned by spectrogram frame; the mel is computed at SOURCE_SAMPLE_RATE like data_prep.py's chunks, so all
+#crops have the same number of frames whatever the sample rate of their source. Without a cache (FEATURE_CACHE_DIR = None), every worker decodes its sources
+#and keeps their features in memory instead. Sources are split between ranks and DataLoader workers, and every worker
+#shuffles its crops through a bounded buffer. Items are (waveform, sample_rate[, spectrogram]) like ChunkedData's.
+class StreamingCropData(IterableDataset):
+
+    def __init__(self, source_dir, length_seconds=SAMPLE_LENGTH_SECONDS, with_conditioning=True, cache=None, crops_per_epoch=None,
+                 shuffle_buffer=STREAM_SHUFFLE_BUFFER, num_replicas=1, rank=0, seed=0) -> None:
+        self.source_dir = source_dir
+        self.length_seconds = length_seconds
+        self.crop_length = round(SAMPLE_RATE * length_seconds)
+        #mel frames of a crop: data_prep.py transforms chunks of length_seconds at SOURCE_SAMPLE_RATE
+        self.crop_frames = round(SOURCE_SAMPLE_RATE * length_seconds) // HOP_LENGTH + 1
+        self.with_conditioning = with_conditioning
+        self.cache = cache if cache is not None else (FeatureCache() if FEATURE_CACHE_DIR is not None else None)
+        self.decoded = (None, None) # path and features of the last source decoded without a cache
+        self.shuffle_buffer = shuffle_buffer
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        #epoch is set by the training loop; iterations counts the epochs of persistent workers, whose copy set_epoch does not reach
+        self.epoch = 0
+        self.iterations = 0
+
+        #decode every source once (a no-op when the cache is warm) and keep sources that are long enough for a crop
+        self.sources = []
+        for file in sorted(os.listdir(source_dir)):
+            path = os.path.join(source_dir, file)
+            if not file.endswith(AUDIO_EXTENSIONS) or not os.path.isfile(path):
+                continue
+            sample_rate, waveform_length, mel_frames = self._info(path)
+            if waveform_length >= self.crop_length and (not with_conditioning or mel_frames >= self.crop_frames):
+                self.sources.append({'path': path, 'sample_rate': sample_rate, 'length': waveform_length, 'frames': mel_frames})
+        if len(self.sources) == 0:
+            raise ValueError(f'no source files of at least {length_seconds} seconds in {source_dir}')
+
+        #by default an epoch has as many crops as the sources would have been chopped into
+        if crops_per_epoch is None:
+            crops_per_epoch = sum(source['length'] // self.crop_length for source in self.sources)
+        self.crops_per_epoch = crops_per_epoch
+        self.length = crops_per_epoch // num_replicas # same number of crops on every rank
+        self.features = {} # memory mapped features per source, opened lazily in every worker
+
+    def __len__(self):
+        return self.length
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.iterations = 0
+
+    def _load(self, path, params, mmap_mode=None):
+        if self.cache is None:
+            if self.decoded[0] != path:
+                self.decoded = (path, _decode_source_features(path))
+            return self.decoded[1][params['kind']]
+        key = file_hash(path)
+        array = self.cache.get(params, key, mmap_mode)
+        if array is None:
+            _compute_source_features(self.cache, path, key)
+            array = self.cache.get(params, key, mmap_mode)
+        return array
+
+    def _info(self, path):
+        sample_rate, _ = self._load(path, source_info_params())
+        waveform_length = self._load(path, waveform_params(), 'r').shape[-1]
+        mel_frames = self._load(path, source_mel_params(), 'r').shape[-1] if self.with_conditioning else None
+        return int(sample_rate), waveform_length, mel_frames
+
+    def _source_features(self, source):
+        path = source['path']
+        if path not in self.features:
+            mel = self._load(path, source_mel_params(), 'r') if self.with_conditioning else None
+            self.features[path] = (self._load(path, waveform_params(), 'r'), mel)
+        return self.features[path]
+
+    #crop of a source at a random position; the waveform crop starts at the first sample of the first mel frame
+    def _crop(self, source, rng):
+        waveform, mel = self._source_features(source)
+        if not self.with_conditioning:
+            start = int(rng.integers(0, source['length'] - self.crop_length + 1))
+            return (torch.from_numpy(np.array(waveform[:, start:start + self.crop_length])), SAMPLE_RATE)
+        last_frame = min(source['frames'] - self.crop_frames, int((source['length'] - self.crop_length) / SAMPLES_PER_FRAME))
+        frame = int(rng.integers(0, last_frame + 1))
+        start = round(frame * SAMPLES_PER_FRAME)
+        return (torch.from_numpy(np.array(waveform[:, start:start + self.crop_length])), SAMPLE_RATE,
+                torch.from_numpy(np.array(mel[0:1, :, frame:frame + self.crop_frames])))
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        shard, num_shards = self.rank * num_workers + worker_id, self.num_replicas * num_workers
+        rng = np.random.default_rng((self.seed, self.epoch + self.iterations, shard))
+        self.iterations += 1
+
+        #crops of this worker, so that all workers of the rank together yield len(self) crops
+        n_crops = self.length // num_workers + (1 if worker_id < self.length % num_workers else 0)
+        #every worker reads its own sources; with fewer sources than workers they are shared
+        sources = self.sources[shard::num_shards] if len(self.sources) >= num_shards else self.sources
+
+        buffer = []
+        produced = 0
+        while produced < n_crops:
+            #crops per visit proportional to the source length, so every second of audio is equally likely
+            for i in rng.permutation(len(sources)):
+                for _ in range(max(1, sources[i]['length'] // self.crop_length)):
+                    buffer.append(self._crop(sources[i], rng))
+                    if len(buffer) < self.shuffle_buffer:
+                        continue
+                    #emit a random item of the full buffer
+                    j = int(rng.integers(len(buffer)))
+                    buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                    yield buffer.pop()
+                    produced += 1
+                    if produced == n_crops:
+                        return
+            #short epochs end with the rest of the buffer
+            if produced + len(buffer) >= n_crops:
+                rng.shuffle(buffer)
+                for item in buffer[:n_crops - produced]:
+                    yield item
+                return
+
+#batches of clips of similar length: clips are sorted by length (in random order within buckets of bucket_width samples)
+#and packed greedily while batch size * longest clip stays within max_tokens samples, so short clips make large batches
+#and little is padded. Batches are shuffled per epoch and split between ranks (every rank gets the same number of batches).
+#Like ResumableSampler the order only depends on seed and epoch, so an interrupted epoch can be resumed.
+class BucketBatchSampler(Sampler):
+
+    def __init__(self, lengths, max_tokens, num_replicas=1, rank=0, shuffle=True, seed=0, bucket_width=SAMPLE_RATE // 10) -> None:
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_width = bucket_width
+        self.epoch = 0
+        self.start_index = 0
+        self.batches = None # batches of the current epoch, built on first use
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start_index = 0
+        self.batches = None
+
+    #skip the first start_index batches of the current epoch (of this rank)
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def _build(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        tie_break = rng.random(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = np.lexsort((tie_break, self.lengths // self.bucket_width)) # ascending length buckets
+
+        batches = []
+        batch = []
+        longest = 0
+        for index in order:
+            length = max(longest, int(self.lengths[index]))
+            #clips longer than max_tokens get a batch of their own
+            if len(batch) > 0 and (len(batch) + 1) * length > self.max_tokens:
+                batches.append(batch)
+                batch, length = [], int(self.lengths[index])
+            batch.append(int(index))
+            longest = length
+        if len(batch) > 0:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        #repeat batches from the start so every rank trains the same number of steps
+        padding = -len(batches) % self.num_replicas
+        batches += batches[:padding]
+        return batches[self.rank::self.num_replicas]
+
+    def _epoch_batches(self):
+        if self.batches is None:
+            self.batches = self._build()
+        return self.batches
+
+    def __iter__(self):
+        return iter(self._epoch_batches()[self.start_index:])
+
+    def __len__(self):
+        return len(self._epoch_batches()) - self.start_index
+
+#collate items of different lengths: waveforms (and spectrograms) are zero padded to the longest item, and a mask
+#(batch, 1, length) with 1 for real samples is appended: (waveform, sample_rate, [spectrogram,] mask)
+def pad_collate(batch):
+    length = max(item[0].shape[-1] for item in batch)
+    waveform = torch.zeros(len(batch), *batch[0][0].shape[:-1], length)
+    mask = torch.zeros(len(batch), 1, length)
+    for i, item in enumerate(batch):
+        waveform[i, ..., :item[0].shape[-1]] = item[0]
+        mask[i, :, :item[0].shape[-1]] = 1
+    sample_rate = torch.tensor([item[1] for item in batch])
+    if len(batch[0]) == 2:
+        return waveform, sample_rate, mask
+    frames = max(item[2].shape[-1] for item in batch)
+    conditioning_var = torch.zeros(len(batch), *batch[0][2].shape[:-1], frames)
+    for i, item in enumerate(batch):
+        conditioning_var[i, ..., :item[2].shape[-1]] = item[2]
+    return waveform, sample_rate, conditioning_var, mask
+
+
+#shuffling sampler whose order only depends on seed and epoch (like DistributedSampler, also for a single process),
+#so an interrupted epoch can be resumed by skipping the samples that were already seen
+class ResumableSampler(DistributedSampler):
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0) -> None:
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    #skip the first start_index samples of the current epoch (of this rank)
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start_index:])
+
+    def __len__(self):
+        return super().__len__() - self.start_index
@@ -0,0 +1,81 @@
+import math
+import torch
+
+NOISE_SCHEDULES = ('linear', 'cosine')
+
+#betas of a named variance schedule: 'linear' (DiffWave paper) from beta_start to beta_end, or 'cosine' (Nichol & Dhariwal,
+#improved DDPM) where alpha_cum follows a squared cosine; its betas are clipped to max_beta, as the last ones go towards 1
+def variance_schedule(name, timesteps, beta_start=1e-4, beta_end=0.05, max_beta=0.999, s=0.008):
+    if name == 'linear':
+        return torch.linspace(beta_start, beta_end, timesteps)
+    if name == 'cosine':
+        steps = torch.arange(timesteps + 1, dtype=torch.float64) / timesteps
+        alpha_cum = torch.cos((steps + s) / (1 + s) * math.pi / 2) ** 2
+        return torch.clamp(1 - alpha_cum[1:] / alpha_cum[:-1], max=max_beta).float()
+    raise ValueError(f'noise schedule must be one of {list(NOISE_SCHEDULES)}, got {name}')
+
+#diffusion coefficients of a variance schedule, precomputed once and kept as buffers on the model's device. Drives the
+#forward (noising) process in training and every sampler through sampling_tables, for the full schedule or a (fast)
+#inference schedule. The buffers are not part of the state dict (weight files stay loadable); training checkpoints store
+#the betas (state) instead.
+class NoiseSchedule(torch.nn.Module):
+    def __init__(self, variance_schedule):
+        super().__init__()
+        beta = torch.as_tensor(variance_schedule, dtype=torch.float64)
+        alpha_cum = torch.cumprod(1 - beta, dim=0)
+        self.register_buffer('beta', beta.float(), persistent=False)
+        self.register_buffer('alpha_cum', alpha_cum.float(), persistent=False)
+        self.register_buffer('sqrt_alpha_cum', torch.sqrt(alpha_cum).float(), persistent=False)
+        self.register_buffer('sqrt_one_minus_alpha_cum', torch.sqrt(1 - alpha_cum).float(), persistent=False)
+        self.tables = {} # sampling tables per (inference schedule, device)
+
+    def __len__(self):
+        return self.sqrt_alpha_cum.shape[0]
+
+    #draw an independent diffusion timestep for every example of a batch
+    def sample_timesteps(self, batch_size):
+        return torch.randint(0, len(self), (batch_size,), device=self.sqrt_alpha_cum.device)
+
+    #noisy version x_t of a batch of waveforms x_0 at per example timesteps t: sqrt(alpha_cum[t]) * x_0 + sqrt(1 - alpha_cum[t]) * noise
+    def add_noise(self, x_0, t, noise):
+        shape = (-1,) + (1,) * (x_0.dim() - 1) # batch size, 1, ..., 1 to broadcast over the remaining dimensions
+        return torch.addcmul(self.sqrt_one_minus_alpha_cum[t].view(shape) * noise, self.sqrt_alpha_cum[t].view(shape), x_0)
+
+    #betas, for training checkpoints; a checkpoint only resumes into a model with the same schedule (see matches)
+    def state(self):
+        return {'variance_schedule': self.beta.tolist()}
+
+    def matches(self, variance_schedule):
+        return torch.allclose(self.beta.cpu(), torch.as_tensor(variance_schedule, dtype=torch.float32).cpu(), rtol=1e-6, atol=0.0)
+
+    #(fractional) training time step of every noise level alpha_cum: between the training steps t and t+1 with
+    #alpha_cum[t+1] <= a <= alpha_cum[t], interpolated linearly in sqrt(alpha_cum); levels outside of the training schedule
+    #are clamped to its first/last step
+    def fractional_timesteps(self, alpha_cum):
+        talpha_cum = torch.cumprod(1 - self.beta.double().cpu(), dim=0)
+        steps = len(talpha_cum)
+        #number of training steps with a higher alpha_cum (talpha_cum is decreasing, so it is searched in reverse)
+        above = steps - torch.searchsorted(talpha_cum.flip(0).contiguous(), alpha_cum, right=True)
+        t = torch.clamp(above - 1, 0, max(steps - 2, 0))
+        twiddle = (talpha_cum[t].sqrt() - alpha_cum.sqrt()) / (talpha_cum[t].sqrt() - talpha_cum[torch.clamp(t + 1, max=steps - 1)].sqrt())
+        T = torch.where(above == 0, 0.0, torch.where(above == steps, float(steps - 1), t + twiddle))
+        return T.float()
+
+    #per step n of the reverse process: time step for the model (long for the full schedule, fractional float for an
+    #inference schedule) and the coefficients of x_{n-1} = c1[n] * (x_n - c2[n] * noise_prediction) + sigma[n] * z.
+    #Computed once per inference schedule and device, in float64, as tensors on the device of the buffers.
+    def sampling_tables(self, inference_schedule=None):
+        key = (tuple(float(b) for b in inference_schedule) if inference_schedule is not None else None, self.beta.device)
+        if key not in self.tables:
+            device = self.beta.device
+            beta = self.beta.double().cpu() if inference_schedule is None else torch.as_tensor(inference_schedule, dtype=torch.float64)
+            alpha_cum = torch.cumprod(1 - beta, dim=0)
+            if inference_schedule is None:
+                timesteps = torch.arange(len(beta), device=device)
+            else:
+                timesteps = self.fractional_timesteps(alpha_cum).to(device)
+            c1 = 1 / torch.sqrt(1 - beta)
+            c2 = beta / torch.sqrt(1 - alpha_cum)
+            sigma = torch.cat([torch.zeros(1, dtype=torch.float64), torch.sqrt((1 - alpha_cum[:-1]) / (1 - alpha_cum[1:]) * beta[1:])])
+            self.tables[key] = (timesteps, c1.float().to(device), c2.float().to(device), sigma.float().to(device))
+        return self.tables[key]
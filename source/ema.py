@@ -0,0 +1,170 @@
+import os
+import time
+import queue
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from config import EMA_DECAY, INFERENCE_SCHEDULE, VALIDATION_THREADS
+
+#exponential moving average of the model parameters (shadow weights), updated after every optimizer step with one
+#fused multi-tensor lerp. The decay is ramped up at the start, so the average does not stick to the initial weights.
+class EMA:
+
+    def __init__(self, model, decay=EMA_DECAY) -> None:
+        self.model = model
+        self.decay = decay
+        self.num_updates = 0
+        self.names = [name for name, _ in model.named_parameters()]
+        self.params = [param for _, param in model.named_parameters()]
+        self.shadow = [param.detach().clone() for param in self.params]
+
+    @torch.no_grad()
+    def update(self):
+        self.num_updates += 1
+        decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
+        #shadow += (1 - decay) * (param - shadow) for all parameters at once
+        torch._foreach_lerp_(self.shadow, self.params, 1 - decay)
+
+    #state dict of the model with the shadow weights; loads into DiffWave like a normal model file
+    def state_dict(self):
+        state = self.model.state_dict()
+        state.update(zip(self.names, self.shadow))
+        return state
+
+    #shadow weights and update count, for training checkpoints
+    def checkpoint_state(self):
+        return {'shadow': dict(zip(self.names, self.shadow)), 'num_updates': self.num_updates}
+
+    @torch.no_grad()
+    def load_checkpoint_state(self, state):
+        for name, shadow in zip(self.names, self.shadow):
+            shadow.copy_(state['shadow'][name])
+        self.num_updates = state['num_updates']
+
+#normalized log mel spectrogram L1 distance of two waveform batches at SAMPLE_RATE
+def mel_l1(frontend, a, b):
+    return torch.mean(torch.abs(frontend(a) - frontend(b))).item()
+
+#mean mel L1 distance of the items sampled with a state dict
+def _validate(model, engine, frontend, items, state, inference_schedule):
+    model.load_state_dict(state)
+    distances = []
+    for i, (waveform, conditioning_var) in enumerate(items):
+        #the same noise for an item in every validation, so results of different steps are comparable
+        generator = torch.Generator().manual_seed(i)
+        noise = torch.randn(waveform.shape, generator=generator).unsqueeze(0)
+        torch.manual_seed(i)
+        generated = engine.sample(noise, conditioning_var=conditioning_var.unsqueeze(0) if conditioning_var is not None else None, inference_schedule=inference_schedule)
+        distances.append(mel_l1(frontend, generated[0], waveform))
+    return float(np.mean(distances))
+
+#results are (step, metrics, None), or (step, None, traceback) if a validation failed; the worker keeps serving jobs after
+#a failed one. If setting up the model fails, the error is reported with step None and the worker exits.
+def _validation_worker(jobs, results, items, hparams, inference_schedule, threads):
+    try:
+        from model import build_model
+        from inference import InferenceEngine
+        from features import MelFrontend
+
+        torch.set_num_threads(threads)
+        model = build_model(hparams)
+        model.eval()
+        engine = InferenceEngine(model)
+        frontend = MelFrontend()
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        step, state = job
+        start = time.perf_counter()
+        try:
+            mel_l1_distance = _validate(model, engine, frontend, items, state, inference_schedule)
+        except Exception:
+            results.put((step, None, traceback.format_exc()))
+            continue
+        finally:
+            del state
+        results.put((step, {'mel_l1': mel_l1_distance, 'seconds': time.perf_counter() - start}, None))
+
+#validates (EMA) weights in a separate process: sampling (InferenceEngine, same results as DiffWave.sample) on a fixed
+#set of held out (waveform, spectrogram) items and the mel L1 distance of the generated audio to the real audio. submit() never blocks the training loop; if the
+#worker is still busy with the previous job, the new one is skipped. Results are collected with poll(). Failed validations
+#are reported as warnings; if the worker process dies, validation is switched off (alive is False) instead of blocking training.
+class Validator:
+
+    def __init__(self, items, hparams, inference_schedule=INFERENCE_SCHEDULE, threads=VALIDATION_THREADS) -> None:
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue(maxsize=1)
+        self.results = context.Queue()
+        #waveform (1, length) and spectrogram (1, n_mels, frames) or None per item
+        items = [(item[0].float().clone(), item[2].float().clone() if len(item) > 2 else None) for item in items]
+        self.process = context.Process(target=_validation_worker, args=(self.jobs, self.results, items, hparams, inference_schedule, threads), daemon=True)
+        #no sampling progress bars in the training output; the spawned interpreter reads TQDM_DISABLE when tqdm is imported
+        disable = os.environ.get('TQDM_DISABLE')
+        os.environ['TQDM_DISABLE'] = '1'
+        try:
+            self.process.start()
+        finally:
+            if disable is None:
+                del os.environ['TQDM_DISABLE']
+            else:
+                os.environ['TQDM_DISABLE'] = disable
+        self.pending = {} # state dicts of submitted steps, until their result arrives
+        self.skipped = 0
+        self.alive = True
+        self.last_submitted = None # step of the last accepted job
+
+    #queue a validation of a state dict; returns False if the worker is busy or dead
+    def submit(self, step, state_dict):
+        if not self._check_alive():
+            return False
+        if len(self.pending) > 0:
+            self.skipped += 1
+            return False
+        state = {name: tensor.detach().to('cpu', copy=True) for name, tensor in state_dict.items()}
+        self.pending[step] = state
+        self.jobs.put((step, state))
+        self.last_submitted = step
+        return True
+
+    #a dead worker never answers its pending jobs; they are dropped and no further jobs are accepted
+    def _check_alive(self):
+        if self.alive and not self.process.is_alive() and self.results.empty():
+            self.alive = False
+            self.pending.clear()
+            print(f'warning: validation worker exited (exit code {self.process.exitcode}); validation is disabled, best_model.pt is not updated anymore')
+        return self.alive
+
+    #finished validations as (step, metrics, state dict) without waiting; wait=True blocks until all submitted jobs are done
+    def poll(self, wait=False):
+        finished = []
+        while len(self.pending) > 0:
+            try:
+                step, metrics, error = self.results.get(block=wait, timeout=1.0 if wait else None)
+            except queue.Empty:
+                if wait and self._check_alive():
+                    continue
+                self._check_alive()
+                break
+            if error is not None:
+                print(f'warning: validation of step {step} failed:\n{error}' if step is not None else f'warning: validation worker failed to start:\n{error}')
+                self.pending.pop(step, None)
+                continue
+            finished.append((step, metrics, self.pending.pop(step)))
+        return finished
+
+    #stops the worker; a worker that does not take the stop signal within timeout seconds is terminated
+    def close(self, timeout=10.0):
+        if self.process.is_alive():
+            try:
+                self.jobs.put(None, timeout=timeout)
+                self.process.join(timeout)
+            except queue.Full:
+                pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
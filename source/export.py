@@ -0,0 +1,234 @@
+import argparse
+import copy
+import json
+import math
+import time
+from typing import List, Optional, Tuple
+import torch
+import torch.nn.functional as F
+
+#residual block of the exported model. The 1/sqrt(2) of every residual connection is folded into the weights: block k
+#works on z = x * sqrt(2)**k, so the residual update becomes an in place "z += r" and the copy of the input is gone.
+#Only the residual half of conv_out is kept, the skip half is not used for the output of DiffWave.
+class FusedBlock(torch.nn.Module):
+
+    def __init__(self, block, scale) -> None:
+        super().__init__()
+        channels = block.residual_channels
+        conv = block.conv_dilated
+        dilation = conv.dilation[0]
+        #numeric padding instead of padding='same'; kernel size 3 keeps the length with padding = dilation
+        self.conv_dilated = torch.nn.Conv1d(channels, 2 * channels, conv.kernel_size[0], dilation=dilation, padding=dilation * (conv.kernel_size[0] - 1) // 2)
+        self.conv_out = torch.nn.Conv1d(channels, channels, 1)
+        with torch.no_grad():
+            self.conv_dilated.weight.copy_(conv.weight / scale)
+            self.conv_dilated.bias.copy_(conv.bias)
+            self.conv_out.weight.copy_(block.conv_out.weight[:channels] * scale)
+            self.conv_out.bias.copy_(block.conv_out.bias[:channels] * scale)
+
+    #z is updated in place; t_bias and conditioner are already scaled and projected for this block
+    def forward(self, z, t_bias, conditioner: Optional[torch.Tensor]):
+        x = self.conv_dilated(z + t_bias)
+        if conditioner is not None:
+            x += conditioner
+        x_tanh, x_sigmoid = x.chunk(2, dim=1)
+        x = torch.tanh(x_tanh) * torch.sigmoid(x_sigmoid)
+        return z.add_(self.conv_out(x))
+
+#inference only version of a trained DiffWave with the reverse process built in. It does not import config.py or model.py,
+#so a scripted FusedDiffWave can be loaded with torch.jit.load alone. The timestep projections and the conditioner
+#projections of all blocks are stacked into one layer each, which run once per sampling run.
+class FusedDiffWave(torch.nn.Module):
+    full_timesteps: List[float]
+    full_c1: List[float]
+    full_c2: List[float]
+    full_sigma: List[float]
+    fast_timesteps: List[float]
+    fast_c1: List[float]
+    fast_c2: List[float]
+    fast_sigma: List[float]
+
+    def __init__(self, model, inference_schedule=None) -> None:
+        super().__init__()
+        model = copy.deepcopy(model).cpu().float().eval()
+        num_blocks = len(model.blocks)
+        channels = model.blocks[0].residual_channels
+        self.num_blocks = num_blocks
+        self.residual_channels = channels
+        self.with_conditioner = model.with_conditioner
+        scales = [math.sqrt(2.0)**k for k in range(num_blocks + 1)]
+
+        #timestep embedding
+        self.register_buffer('embedding', model.timestep_in.embedding.clone())
+        self.projection1 = model.timestep_in.projection1
+        self.projection2 = model.timestep_in.projection2
+        self.fc_timestep = torch.nn.Linear(model.layer_width, num_blocks * channels)
+        with torch.no_grad():
+            self.fc_timestep.weight.copy_(torch.cat([block.fc_timestep.weight * scale for block, scale in zip(model.blocks, scales)]))
+            self.fc_timestep.bias.copy_(torch.cat([block.fc_timestep.bias * scale for block, scale in zip(model.blocks, scales)]))
+
+        #spectrogram conditioner
+        n_mels = model.n_mels
+        self.conditioner_conv1 = model.conditioner_block.conv1 if model.with_conditioner else torch.nn.Identity()
+        self.conditioner_conv2 = model.conditioner_block.conv2 if model.with_conditioner else torch.nn.Identity()
+        self.min_frames = model.conditioner_block.min_frames if model.with_conditioner else 1
+        self.conv_conditioner = torch.nn.Conv1d(n_mels, num_blocks * 2 * channels, 1)
+        if model.with_conditioner:
+            with torch.no_grad():
+                self.conv_conditioner.weight.copy_(torch.cat([block.conv_conditioner.weight for block in model.blocks]))
+                self.conv_conditioner.bias.copy_(torch.cat([block.conv_conditioner.bias for block in model.blocks]))
+
+        self.waveform_in = model.waveform_in
+        self.blocks = torch.nn.ModuleList([FusedBlock(block, scale) for block, scale in zip(model.blocks, scales)])
+        self.out = model.out
+        with torch.no_grad():
+            self.out[0].weight /= scales[num_blocks]
+
+        self.full_timesteps, self.full_c1, self.full_c2, self.full_sigma = self._coefficients(model, None)
+        self.fast_timesteps, self.fast_c1, self.fast_c2, self.fast_sigma = self._coefficients(model, inference_schedule) if inference_schedule is not None else ([], [], [], [])
+
+    #per step of the reverse process: (fractional) training time step and the coefficients of the update in DiffWave.sample
+    def _coefficients(self, model, inference_schedule):
+        timesteps, c1, c2, sigma = model.noise_schedule.sampling_tables(inference_schedule)
+        return [float(t) for t in timesteps], c1.tolist(), c2.tolist(), sigma.tolist()
+
+    #embedding of (fractional) time steps, linearly interpolated between the integer steps
+    def embed(self, t):
+        low = torch.floor(t)
+        high = torch.ceil(t)
+        low_embedding = self.embedding[low.long()]
+        x = low_embedding + (self.embedding[high.long()] - low_embedding) * (t - low).unsqueeze(-1)
+        x = F.silu(self.projection1(x))
+        return F.silu(self.projection2(x))
+
+    #timestep bias of every block for every step (steps, blocks, channels, 1) and projected conditioner of every block (blocks, batch, 2 * channels, length)
+    @torch.jit.export
+    def prepare(self, timesteps, conditioning_var: Optional[torch.Tensor], length: int) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        t_biases = self.fc_timestep(self.embed(timesteps)).view(timesteps.shape[0], self.num_blocks, self.residual_channels, 1)
+        conditioners: Optional[torch.Tensor] = None
+        if conditioning_var is not None:
+            #same padding of short spectrograms as SpectrogramConditioner
+            frames = conditioning_var.shape[-1]
+            padding = max(self.min_frames - frames, 0)
+            if padding > 0:
+                conditioning_var = F.pad(conditioning_var, (0, padding, 0, 0), mode='replicate')
+            spectrogram = F.leaky_relu(self.conditioner_conv1(conditioning_var), 0.4)
+            spectrogram = F.leaky_relu(self.conditioner_conv2(spectrogram), 0.4).squeeze(1)
+            padded_length = length if padding == 0 else int(round(length * (frames + padding) / frames))
+            if spectrogram.shape[-1] != padded_length:
+                spectrogram = F.interpolate(spectrogram, size=padded_length, mode='linear', align_corners=False)
+            spectrogram = spectrogram[..., :length]
+            projected = self.conv_conditioner(spectrogram)
+            conditioners = projected.view(projected.shape[0], self.num_blocks, 2 * self.residual_channels, length).transpose(0, 1)
+        return t_biases, conditioners
+
+    #predicted noise with prepared timestep biases t_bias (batch or 1, blocks, channels, 1); the step is a tensor, not an index,
+    #so torch.compile does not specialize on it
+    @torch.jit.export
+    def denoise(self, x, t_bias, conditioners: Optional[torch.Tensor]):
+        z = self.waveform_in(x)
+        for i, block in enumerate(self.blocks):
+            conditioner: Optional[torch.Tensor] = None
+            if conditioners is not None:
+                conditioner = conditioners[i]
+            z = block(z, t_bias[:, i], conditioner)
+        return self.out(z)
+
+    #same as DiffWave.forward for one time step t per sample
+    def forward(self, x, t, conditioning_var: Optional[torch.Tensor] = None):
+        t_biases, conditioners = self.prepare(t.float(), conditioning_var, x.shape[-1])
+        return self.denoise(x, t_biases, conditioners)
+
+    #reverse process from noise x_t, with the training schedule or (fast=True) the inference schedule given at export
+    @torch.jit.export
+    def sample(self, x_t, conditioning_var: Optional[torch.Tensor] = None, fast: bool = False):
+        timesteps, c1, c2, sigma = self.full_timesteps, self.full_c1, self.full_c2, self.full_sigma
+        if fast:
+            if len(self.fast_timesteps) == 0:
+                raise RuntimeError('model was exported without an inference schedule')
+            timesteps, c1, c2, sigma = self.fast_timesteps, self.fast_c1, self.fast_c2, self.fast_sigma
+        with torch.no_grad():
+            t_biases, conditioners = self.prepare(torch.tensor(timesteps, device=x_t.device), conditioning_var, x_t.shape[-1])
+            x_t = x_t.clone()
+            for n in range(len(timesteps) - 1, -1, -1):
+                x_t.sub_(self.denoise(x_t, t_biases[n:n + 1], conditioners), alpha=c2[n]).mul_(c1[n])
+                if n > 0:
+                    x_t.add_(torch.randn_like(x_t), alpha=sigma[n])
+                x_t.clamp_(-1.0, 1.0)
+        return x_t
+
+#TorchScript file with the hyperparameters needed to use it (sample rate, spectrogram size, ...) stored alongside
+def export(model, path, inference_schedule=None, hparams=None):
+    scripted = torch.jit.script(FusedDiffWave(model, inference_schedule))
+    torch.jit.save(scripted, path, _extra_files={'hparams.json': json.dumps(hparams or {})})
+    return scripted
+
+#load an exported model; only needs torch
+def load_exported(path, map_location='cpu'):
+    extra_files = {'hparams.json': ''}
+    scripted = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    return scripted, json.loads(extra_files['hparams.json'])
+
+#torch.compile'd denoiser for use in the same process; gated activation and residual arithmetic are fused by inductor
+def compile_model(model, inference_schedule=None, **compile_kwargs):
+    fused = FusedDiffWave(model, inference_schedule)
+    fused.denoise = torch.compile(fused.denoise, **compile_kwargs)
+    return fused
+
+def _median_seconds(fn, iters):
+    fn() #warmup, includes compilation
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+#example: python source/export.py output/models/best_model.pt output/models/diffwave.ts --compare
+if __name__ == '__main__':
+    from model import DiffWave
+    from inference import InferenceEngine
+    from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, WITH_CONDITIONING, INFERENCE_SCHEDULE, HOP_LENGTH, SOURCE_SAMPLE_RATE, SAMPLES_PER_FRAME
+
+    parser = argparse.ArgumentParser(description='export a trained DiffWave as a fused TorchScript model that runs without the source folder')
+    parser.add_argument('model_path')
+    parser.add_argument('out_path')
+    parser.add_argument('--compare', action='store_true', help='compare cpu sampling latency and output of eager, scripted and compiled models')
+    parser.add_argument('--compile', action='store_true', help='include torch.compile in the comparison (needs a c++ compiler)')
+    parser.add_argument('--length', type=int, default=SAMPLE_RATE, help='samples generated in the comparison')
+    parser.add_argument('--iters', type=int, default=3)
+    args = parser.parse_args()
+
+    model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+    hparams = {'sample_rate': SAMPLE_RATE, 'n_mels': N_MELS, 'hop_length': HOP_LENGTH, 'source_sample_rate': SOURCE_SAMPLE_RATE,
+               'with_conditioning': WITH_CONDITIONING, 'time_steps': TIME_STEPS, 'inference_schedule': INFERENCE_SCHEDULE,
+               'sample_length_seconds': SAMPLE_LENGTH_SECONDS}
+    export(model, args.out_path, INFERENCE_SCHEDULE, hparams)
+    print(f'Saved TorchScript model to {args.out_path}')
+
+    if args.compare:
+        scripted, _ = load_exported(args.out_path)
+        conditioning_var = torch.rand(1, 1, N_MELS, max(1, round(args.length / SAMPLES_PER_FRAME))) if WITH_CONDITIONING else None
+        noise = torch.randn(1, 1, args.length)
+        engine = InferenceEngine(model)
+        candidates = {
+            'DiffWave.sample (eager)': lambda fast: model.sample(noise, conditioning_var, INFERENCE_SCHEDULE if fast else None),
+            'InferenceEngine (eager)': lambda fast: engine.sample(noise, conditioning_var, INFERENCE_SCHEDULE if fast else None),
+            'FusedDiffWave (TorchScript)': lambda fast: scripted.sample(noise, conditioning_var, fast),
+        }
+        if args.compile:
+            compiled = compile_model(model, INFERENCE_SCHEDULE)
+            candidates['FusedDiffWave (torch.compile)'] = lambda fast: compiled.sample(noise, conditioning_var, fast)
+
+        print(f'{"model":<32} {"schedule":>8} {"seconds":>10} {"speedup":>8} {"max abs diff":>13}')
+        for fast in (False, True):
+            reference, reference_seconds = None, None
+            for name, fn in candidates.items():
+                seconds = _median_seconds(lambda: fn(fast), args.iters)
+                torch.manual_seed(0)
+                y = fn(fast)
+                if reference is None:
+                    reference, reference_seconds = y, seconds
+                print(f'{name:<32} {"fast" if fast else "full":>8} {seconds:>10.3f} {reference_seconds / seconds:>8.2f} {(y - reference).abs().max().item():>13.2e}')
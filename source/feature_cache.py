@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from config import SAMPLE_RATE, WINDOW_LENGTH, HOP_LENGTH, N_FFT, N_MELS, FMIN, FMAX, POWER, NORMALIZED, FEATURE_CACHE_DIR, FEATURE_CACHE_MAX_BYTES
+
+#bump when the way features are computed changes, so old entries are not used anymore
+FEATURE_VERSION = 1
+
+PARAMS_FILE = 'params.json'
+
+#every option of the mel transform of data_prep.py; features are cached per set of these
+def mel_params(sample_rate=SAMPLE_RATE, win_length=WINDOW_LENGTH, hop_length=HOP_LENGTH, n_fft=N_FFT, f_min=FMIN, f_max=FMAX, n_mels=N_MELS, power=POWER, normalized=NORMALIZED):
+    return {'kind': 'mel', 'version': FEATURE_VERSION, 'sample_rate': sample_rate, 'win_length': win_length, 'hop_length': hop_length,
+            'n_fft': n_fft, 'f_min': f_min, 'f_max': f_max, 'n_mels': n_mels, 'power': power, 'normalized': normalized}
+
+#first channel of an audio file, resampled to sample_rate (as returned by ChunkedData)
+def waveform_params(sample_rate=SAMPLE_RATE):
+    return {'kind': 'waveform', 'version': FEATURE_VERSION, 'sample_rate': sample_rate, 'channels': 1}
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+#content hash of a file; remembered per (path, size, mtime), so a file is read for hashing only once per process
+_file_hashes = {}
+
+def file_hash(path):
+    stat = os.stat(path)
+    stamp = (path, stat.st_size, stat.st_mtime_ns)
+    if stamp not in _file_hashes:
+        with open(path, 'rb') as f:
+            _file_hashes[stamp] = content_hash(f.read())
+    return _file_hashes[stamp]
+
+#content addressed store of computed features: <cache_dir>/<hash of transform params>/<content hash>.npy, with the
+#params written next to the entries. A change of the audio or of any transform option gives a new key, so stale
+#features are never returned. The least recently used entries are deleted when the cache grows beyond max_bytes.
+#Safe to share between processes: entries are written to a temporary file and renamed into place.
+class FeatureCache:
+
+    def __init__(self, cache_dir=FEATURE_CACHE_DIR, max_bytes=FEATURE_CACHE_MAX_BYTES) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.known_params = set()
+        self.size = None # bytes of all entries, counted on the first write
+
+    def _path(self, params, key):
+        directory = os.path.join(self.cache_dir, params_hash(params))
+        if directory not in self.known_params:
+            os.makedirs(directory, exist_ok=True)
+            if not os.path.isfile(os.path.join(directory, PARAMS_FILE)):
+                with open(os.path.join(directory, PARAMS_FILE), 'w') as f:
+                    json.dump(params, f, indent=2)
+            self.known_params.add(directory)
+        return os.path.join(directory, f'{key}.npy')
+
+    #mmap_mode='r' memory maps the entry instead of reading it
+    def get(self, params, key, mmap_mode=None):
+        path = self._path(params, key)
+        try:
+            array = np.load(path, mmap_mode=mmap_mode)
+        except (FileNotFoundError, ValueError, EOFError):
+            #missing, evicted by another process or truncated
+            self.misses += 1
+            return None
+        #access time for the LRU order; mtime is used, as atime is often not updated by the file system
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return array
+
+    def put(self, params, key, array):
+        path = self._path(params, key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        #an overwritten entry no longer counts towards the size
+        replaced = os.path.getsize(path) if os.path.isfile(path) else 0
+        os.replace(tmp_path, path)
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += os.path.getsize(path) - replaced
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.evict()
+
+    #cached features, or compute() if they are missing (and cache its result)
+    def get_or_compute(self, params, key, compute):
+        array = self.get(params, key)
+        if array is None:
+            array = compute()
+            self.put(params, key, array)
+        return array
+
+    def entries(self):
+        entries = []
+        for params_dir in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, params_dir)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.npy'):
+                    try:
+                        stat = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+        return entries
+
+    def total_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    #delete least recently used entries until the cache is at 90% of max_bytes
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries())
+        size = sum(size for _, size, _ in entries)
+        target = 0.9 * max_bytes
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size = size
+
+    def stats(self):
+        per_params = {}
+        for _, size, path in self.entries():
+            directory = os.path.dirname(path)
+            count, total = per_params.get(directory, (0, 0))
+            per_params[directory] = (count + 1, total + size)
+        return per_params
+
+#example: python source/feature_cache.py --stats
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inspect or shrink the feature cache')
+    parser.add_argument('cache_dir', nargs='?', default=FEATURE_CACHE_DIR)
+    parser.add_argument('--stats', action='store_true', help='entries and size per set of transform params')
+    parser.add_argument('--evict', type=float, default=None, metavar='GB', help='delete least recently used entries down to this size')
+    args = parser.parse_args()
+
+    cache = FeatureCache(args.cache_dir)
+    if args.evict is not None:
+        start = time.perf_counter()
+        cache.evict(args.evict * 2**30 / 0.9)
+        print(f'Evicted down to {cache.size / 2**20:.1f} MB in {time.perf_counter() - start:.1f}s')
+    if args.stats or args.evict is None:
+        for directory, (count, size) in sorted(cache.stats().items()):
+            with open(os.path.join(directory, PARAMS_FILE)) as f:
+                params = json.load(f)
+            print(f'{os.path.basename(directory)} | {count} entries | {size / 2**20:.1f} MB | {json.dumps(params)}')
@@ -0,0 +1,73 @@
+import torch
+import torchaudio
+from torch.utils.data import default_collate
+from config import SAMPLE_RATE, WINDOW_LENGTH, HOP_LENGTH, N_FFT, N_MELS, FMIN, FMAX, POWER, NORMALIZED
+
+#batched mel spectrogram front end, numerically the same as compress_spectrogram(get_mel_transform()(waveform)) of
+#data_prep.py. Window and mel filterbank are built once (the window normalization is folded into the filterbank), a whole
+#batch of equal length waveforms is transformed in one STFT call, and log compression and normalization to [0, 1] are
+#done in place. Works on cpu and cuda; on cpu, batches are transformed cpu_batch waveforms at a time, as the stft of a
+#large batch does not fit into the cpu caches and gets slower per waveform.
+class MelFrontend:
+
+    def __init__(self, sample_rate=SAMPLE_RATE, win_length=WINDOW_LENGTH, hop_length=HOP_LENGTH, n_fft=N_FFT, f_min=FMIN, f_max=FMAX,
+                 n_mels=N_MELS, power=POWER, normalized=NORMALIZED, device=None, cpu_batch=4) -> None:
+        self.n_fft = n_fft
+        self.cpu_batch = cpu_batch
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.power = power
+        self.n_mels = n_mels
+        self.window = torch.hann_window(win_length, device=device)
+        filterbank = torchaudio.functional.melscale_fbanks(n_fft // 2 + 1, f_min, f_max, n_mels, sample_rate) # n_freqs, n_mels
+        if normalized:
+            #torchaudio divides the stft by the window norm before the power is applied
+            filterbank = filterbank / self.window.cpu().pow(2).sum().sqrt() ** power
+        self.filterbank = filterbank.T.contiguous().to(device) # n_mels, n_freqs
+
+    def to(self, device):
+        self.window = self.window.to(device)
+        self.filterbank = self.filterbank.to(device)
+        return self
+
+    def frames(self, length):
+        return length // self.hop_length + 1
+
+    def _transform(self, waveform):
+        spectrogram = torch.stft(waveform, self.n_fft, self.hop_length, self.win_length, self.window, center=True, pad_mode='reflect',
+                                 return_complex=True).abs() # batch, n_freqs, frames
+        if self.power != 1.0:
+            spectrogram.pow_(self.power)
+        mel_spectrogram = torch.matmul(self.filterbank, spectrogram)
+        #(20 * log10(x) - 20 + 100) / 100 of compress_spectrogram, clamped to [0, 1]
+        return mel_spectrogram.clamp_(min=1e-5).log10_().mul_(0.2).add_(0.8).clamp_(0.0, 1.0)
+
+    #waveform (..., length) -> normalized log mel spectrogram (..., n_mels, frames); written into out if given,
+    #e.g. a tensor view of a memory mapped shard
+    @torch.no_grad()
+    def __call__(self, waveform, out=None):
+        shape = waveform.shape
+        waveform = waveform.reshape(-1, shape[-1]).to(self.window.device, torch.float32)
+        out_shape = (*shape[:-1], self.n_mels, self.frames(shape[-1]))
+        if self.window.device.type != 'cpu' or waveform.shape[0] <= self.cpu_batch:
+            mel_spectrogram = self._transform(waveform).reshape(out_shape)
+            return mel_spectrogram if out is None else out.copy_(mel_spectrogram)
+        if out is None:
+            out = torch.empty(out_shape)
+        flat_out = out.view(-1, self.n_mels, out_shape[-1])
+        for start in range(0, waveform.shape[0], self.cpu_batch):
+            flat_out[start:start + self.cpu_batch] = self._transform(waveform[start:start + self.cpu_batch])
+        return out
+
+#collate function that computes the spectrograms of a batch on the fly: (waveform, sample_rate) items become
+#(waveform, sample_rate, spectrogram) batches, with one frontend call for the whole batch. The frontend has to be built
+#for the sample rate of the waveforms the dataset returns.
+class MelCollate:
+
+    def __init__(self, frontend, collate_fn=default_collate) -> None:
+        self.frontend = frontend
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        waveform, sample_rate = self.collate_fn([item[:2] for item in batch])[:2]
+        return waveform, sample_rate, self.frontend(waveform).to(waveform.device)
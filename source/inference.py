@@ -0,0 +1,61 @@
+import torch
+from tqdm import tqdm
+from profiler import Profiler
+from config import CONDITIONER_CACHE_MAX_BYTES
+
+#sampling engine around a DiffWave model; everything that does not depend on x_t is computed once per sampling run.
+#The upsampled spectrogram is always cached; its projections by every block (blocks x 2 * channels per waveform sample)
+#only if they fit into conditioner_cache_bytes, otherwise every block projects it again in every step.
+class InferenceEngine:
+
+    def __init__(self, model, profiler=None, conditioner_cache_bytes=CONDITIONER_CACHE_MAX_BYTES) -> None:
+        self.model = model
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
+        self.conditioner_cache_bytes = conditioner_cache_bytes
+
+    #upsampled spectrogram, its projection by every block (None if it is not cached) and timestep bias of every block for every step of the schedule
+    def prepare(self, timesteps, conditioning_var=None, length=None):
+        model = self.model
+        conditioners = None
+        if conditioning_var is not None:
+            conditioning_var = model.conditioner_block(conditioning_var, length)
+            channels = sum(block.conv_conditioner.out_channels for block in model.blocks)
+            if conditioning_var.shape[0] * channels * conditioning_var.shape[-1] * conditioning_var.element_size() <= self.conditioner_cache_bytes:
+                conditioners = [block.conv_conditioner(conditioning_var) for block in model.blocks]
+
+        t = model.timestep_in(timesteps) # steps, layer_width
+        t_biases = [block.fc_timestep(t).unsqueeze(-1) for block in model.blocks] # per block: steps, channels, 1
+        return conditioning_var, conditioners, t_biases
+
+    #predict noise at step n of the schedule with cached conditioner and timestep biases; only the dilated conv stack
+    #(and the conditioner projections, if they are not cached) runs
+    def denoise(self, x, n, conditioning_var, conditioners, t_biases):
+        model = self.model
+        x = model.waveform_in(x)
+        for i, (block, t_bias) in enumerate(zip(model.blocks, t_biases)):
+            #blocks are not called through __call__ here, so module hooks of the profiler do not see them
+            with self.profiler.phase(f'module/blocks.{i}'):
+                if conditioners is not None:
+                    conditioner = conditioners[i]
+                else:
+                    conditioner = block.conv_conditioner(conditioning_var) if conditioning_var is not None else None
+                x, _ = block.forward_with_bias(x, t_bias[n], conditioner)
+        #DiffWave.forward does not use the skip connections for its output, so they are not summed up here
+        return model.out(x)
+
+    #same reverse process as DiffWave.sample
+    def sample(self, x_t, conditioning_var=None, inference_schedule=None):
+        with torch.no_grad():
+            timesteps, c1, c2, sigma = self.model.noise_schedule.sampling_tables(inference_schedule)
+            with self.profiler.phase('sampling_prepare'):
+                conditioning_var, conditioners, t_biases = self.prepare(timesteps, conditioning_var, x_t.shape[-1])
+
+            for n in tqdm(range(len(timesteps) - 1, -1, -1)):
+                with self.profiler.phase('sampling_step'):
+                    x_t = c1[n] * (x_t - c2[n] * self.denoise(x_t, n, conditioning_var, conditioners, t_biases))
+                    if n > 0:
+                        noise = torch.randn_like(x_t)
+                        x_t += sigma[n] * noise
+                    x_t = torch.clamp(x_t, -1.0, 1.0)
+                self.profiler.step()
+        return x_t
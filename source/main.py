@@ -1,64 +1,197 @@
 import os
 import sys
+import json
+import argparse
+import itertools
 import torch
-import torch.nn.functional as F
-from torch.utils.data import Dataset
-import wandb
-from model import DiffWave
-from dataset import ChunkedData
-from train import train
-from config import EPOCHS, BATCH_SIZE, LEARNING_RATE, NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, MAX_SAMPLES, WITH_CONDITIONING, N_MELS
-
-#start with empty cache
-torch.cuda.empty_cache()
-
-#default data location
-data_path = os.path.join('data/chunked_audio')
-conditional_path = os.path.join('data/mel_spectrograms') if WITH_CONDITIONING else None
-
-#example: python main.py path/to/data
-if len(sys.argv) > 1:
-    data_path = sys.argv[1]
-
-if len(sys.argv) > 2:
-    conditional_path = sys.argv[2]
-
-#initialize wandb
-wandb.init(
-    project="DiffWave", 
-    entity="daavidhauser",
-    config = {
-    "learning_rate": LEARNING_RATE,
-    "epochs": EPOCHS,
-    "batch_size": BATCH_SIZE,
-    "num_blocks": NUM_BLOCKS,
-    "res_channels": RES_CHANNELS,
-    "time_steps": TIME_STEPS,
-    "variance_schedule": VARIANCE_SCHEDULE,
-    "timestep_layer_width": TIMESTEP_LAYER_WIDTH,
-    "sample_rate": SAMPLE_RATE,
-    "sample_length_seconds": SAMPLE_LENGTH_SECONDS,
-    "max_samples": MAX_SAMPLES,
-    "with_conditional": WITH_CONDITIONING
-    }
-)
-
-#initialize dataset
-chunked_data = ChunkedData(audio_dir=data_path, conditional_dir=conditional_path, max_samples=MAX_SAMPLES)
-
-#initialize dataloader
-trainloader = torch.utils.data.DataLoader(
-    chunked_data,
-    batch_size=BATCH_SIZE,
-    shuffle=True,
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import config
+from diffusion import variance_schedule
+
+#options of config.py that are derived from others; recomputed unless they are set explicitly
+def _derived(values):
+    derived = {}
+    if 'VARIANCE_SCHEDULE' not in values and ('TIME_STEPS' in values or 'NOISE_SCHEDULE' in values):
+        derived['VARIANCE_SCHEDULE'] = variance_schedule(values.get('NOISE_SCHEDULE', config.NOISE_SCHEDULE), values.get('TIME_STEPS', config.TIME_STEPS))
+    if 'FMAX' not in values and 'SAMPLE_RATE' in values:
+        derived['FMAX'] = values['SAMPLE_RATE'] / 2
+    if 'SAMPLES_PER_FRAME' not in values and ('SAMPLE_RATE' in values or 'HOP_LENGTH' in values or 'SOURCE_SAMPLE_RATE' in values):
+        derived['SAMPLES_PER_FRAME'] = values.get('SAMPLE_RATE', config.SAMPLE_RATE) * values.get('HOP_LENGTH', config.HOP_LENGTH) / values.get('SOURCE_SAMPLE_RATE', config.SOURCE_SAMPLE_RATE)
+    return derived
+
+#override options of config.py; must run before model, dataset and train are imported, as they import options by name
+def apply_config(values):
+    for key, value in values.items():
+        if not hasattr(config, key) or not key.isupper():
+            raise ValueError(f'unknown config option {key}')
+        if key == 'VARIANCE_SCHEDULE':
+            value = torch.tensor(value, dtype=torch.float32)
+        setattr(config, key, value)
+    for key, value in _derived(values).items():
+        setattr(config, key, value)
+
+#config options from a json file, overridden by "--set KEY=VALUE" arguments (values are parsed as json)
+def load_config(path=None, overrides=()):
+    values = {}
+    if path is not None:
+        with open(path) as f:
+            values.update(json.load(f))
+    for override in overrides:
+        key, value = override.split('=', 1)
+        try:
+            values[key] = json.loads(value)
+        except json.JSONDecodeError:
+            values[key] = value
+    return values
+
+#train on one process; with world_size > 1 this is one rank of a DistributedDataParallel run
+def run(rank, world_size, values, data_path, conditional_path, backend, resume=False, profile=None, stream=False):
+    apply_config(values)
+    from model import DiffWave
+    from dataset import ChunkedData, PackedData, StreamingCropData, ResumableSampler, BucketBatchSampler, pad_collate
+    from train import train
+    from metrics import create_logger
+    from profiler import Profiler
+    from feature_cache import FeatureCache
+    from ema import EMA, Validator
+    from config import FEATURE_CACHE_DIR, BATCH_MAX_SAMPLES, CHECKPOINT_BLOCKS, EMA_DECAY, VALIDATION_EVERY, VALIDATION_SAMPLES, EPOCHS, BATCH_SIZE, LEARNING_RATE, NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, MAX_SAMPLES, WITH_CONDITIONING, N_MELS, NUM_WORKERS, SEED, METRIC_BACKENDS, LOG_EVERY, WANDB_PROJECT, WANDB_ENTITY
+
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+        #share the cores of the host between the ranks
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    device = torch.device(f'cuda:{rank % torch.cuda.device_count()}' if torch.cuda.is_available() else 'cpu')
+    is_main_process = rank == 0
+
+    #same initial weights on every rank
+    torch.manual_seed(SEED)
+
+    #start with empty cache
+    torch.cuda.empty_cache()
+
+    #initialize metrics logging (local files and/or wandb) on rank 0 only
+    metrics = create_logger(METRIC_BACKENDS if is_main_process else [], 'output', log_every=LOG_EVERY, device=device,
+        wandb_project=WANDB_PROJECT, wandb_entity=WANDB_ENTITY,
+        config = {
+        "learning_rate": LEARNING_RATE,
+        "epochs": EPOCHS,
+        "batch_size": BATCH_SIZE,
+        "num_blocks": NUM_BLOCKS,
+        "res_channels": RES_CHANNELS,
+        "time_steps": TIME_STEPS,
+        "variance_schedule": VARIANCE_SCHEDULE.tolist(),
+        "timestep_layer_width": TIMESTEP_LAYER_WIDTH,
+        "sample_rate": SAMPLE_RATE,
+        "sample_length_seconds": SAMPLE_LENGTH_SECONDS,
+        "max_samples": MAX_SAMPLES,
+        "with_conditional": WITH_CONDITIONING,
+        "world_size": world_size,
+        }
     )
 
-#initialize model
-model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
-optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    #initialize dataset; a folder written by pack_data.py is read through its index instead of loading single files,
+    #with stream=True random crops are drawn from the full length files in data_path
+    if stream:
+        chunked_data = StreamingCropData(data_path, with_conditioning=WITH_CONDITIONING, num_replicas=world_size, rank=rank, seed=SEED)
+    elif os.path.isfile(os.path.join(data_path, 'index.json')):
+        chunked_data = PackedData(store_dir=data_path, max_samples=MAX_SAMPLES, with_conditioning=WITH_CONDITIONING)
+    else:
+        cache = FeatureCache() if FEATURE_CACHE_DIR is not None else None
+        chunked_data = ChunkedData(audio_dir=data_path, conditional_dir=conditional_path if WITH_CONDITIONING else None, max_samples=MAX_SAMPLES, cache=cache)
+
+    #the last VALIDATION_SAMPLES items are held out of training on every rank and validated on by rank 0;
+    #with stream=True there is nothing to hold out, validation crops are drawn from the training sources with another seed
+    validation_items = []
+    if VALIDATION_EVERY > 0 and stream:
+        if is_main_process:
+            validation_data = StreamingCropData(data_path, with_conditioning=WITH_CONDITIONING, shuffle_buffer=1, seed=SEED + 1)
+            validation_items = list(itertools.islice(iter(validation_data), VALIDATION_SAMPLES))
+    elif VALIDATION_EVERY > 0 and len(chunked_data) > VALIDATION_SAMPLES:
+        train_size = len(chunked_data) - VALIDATION_SAMPLES
+        if is_main_process:
+            validation_items = [chunked_data[i] for i in range(train_size, len(chunked_data))]
+        chunked_data.max_samples = train_size
+
+    #initialize dataloader; every rank gets its own shard of the (shuffled) dataset, in an order that can be resumed mid epoch
+    #with BATCH_MAX_SAMPLES, clips of different lengths are batched by length and padded, and the loss ignores the padding
+    if BATCH_MAX_SAMPLES is not None and isinstance(chunked_data, ChunkedData):
+        batch_sampler = BucketBatchSampler(chunked_data.lengths(), BATCH_MAX_SAMPLES, num_replicas=world_size, rank=rank, shuffle=True, seed=SEED)
+        batching = {'batch_sampler': batch_sampler, 'collate_fn': pad_collate}
+    else:
+        sampler = ResumableSampler(chunked_data, num_replicas=world_size, rank=rank, shuffle=True, seed=SEED) if not stream else None
+        batching = {'batch_size': BATCH_SIZE, 'sampler': sampler}
+    trainloader = torch.utils.data.DataLoader(
+        chunked_data,
+        **batching,
+        num_workers=NUM_WORKERS,
+        pin_memory=device.type == 'cuda',
+        persistent_workers=NUM_WORKERS > 0,
+        )
+
+    #initialize model
+    model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH, checkpoint_blocks=CHECKPOINT_BLOCKS)
+    model.to(device)
+    if distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+
+    #exponential moving average of the weights and background validation, on rank 0 only
+    raw_model = model.module if distributed else model
+    ema = EMA(raw_model) if EMA_DECAY is not None and is_main_process else None
+    validator = Validator(validation_items, raw_model.hparams()) if len(validation_items) > 0 else None
+
+    #opt-in profiling of rank 0: per phase/module timing table and an optional torch.profiler trace
+    profiler = Profiler(enabled=profile is not None and is_main_process, device=device,
+                        trace_dir=profile['trace_dir'] if profile is not None else None, trace_steps=profile['steps'] if profile is not None else (10, 20))
+
+    #train model
+    train(model, optimizer, trainloader, EPOCHS, TIME_STEPS, VARIANCE_SCHEDULE, device=device, resume=resume, metrics=metrics, profiler=profiler,
+          ema=ema, validator=validator)
+    if validator is not None:
+        validator.close()
+    metrics.close()
+    if profiler.enabled:
+        print(profiler.summary())
+
+    if distributed:
+        dist.destroy_process_group()
+
+#example: python source/main.py data/chunked_audio data/mel_spectrograms --config run.json --nprocs 4
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='train DiffWave')
+    parser.add_argument('data_path', nargs='?', default=os.path.join('data/chunked_audio'), help='chunked audio folder or packed folder')
+    parser.add_argument('conditional_path', nargs='?', default=os.path.join('data/mel_spectrograms'), help='spectrogram folder')
+    parser.add_argument('--config', default=None, help='json file with options of config.py to override, e.g. {"BATCH_SIZE": 16}')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a single option of config.py')
+    parser.add_argument('--metrics', nargs='+', default=None, choices=['jsonl', 'csv', 'wandb'], help='metrics backends; defaults to METRIC_BACKENDS of config.py')
+    parser.add_argument('--nprocs', type=int, default=1, help='number of data parallel training processes')
+    parser.add_argument('--backend', default='gloo', help='torch.distributed backend; gloo works on cpu only hosts')
+    parser.add_argument('--master-port', default='29500')
+    parser.add_argument('--resume', action='store_true', help='continue from the newest checkpoint in output/models/checkpoints')
+    parser.add_argument('--profile', action='store_true', help='record time and memory per phase and module and print a summary table')
+    parser.add_argument('--profile-trace-dir', default=None, help='also export a torch.profiler trace to this folder (implies --profile)')
+    parser.add_argument('--profile-steps', type=int, nargs=2, default=[10, 20], metavar=('START', 'END'), help='steps traced with torch.profiler')
+    parser.add_argument('--stream', action='store_true', help='data_path holds full length audio files (e.g. raw_samples); train on random crops of them')
+    parser.add_argument('--no-sample', action='store_true', help='do not generate a sample after training')
+    args = parser.parse_args()
 
-#train model
-train(model, optimizer,trainloader, EPOCHS, TIME_STEPS, VARIANCE_SCHEDULE)
+    values = load_config(args.config, args.set)
+    profile = None
+    if args.profile or args.profile_trace_dir is not None:
+        profile = {'trace_dir': args.profile_trace_dir, 'steps': tuple(args.profile_steps)}
+    if args.metrics is not None:
+        values['METRIC_BACKENDS'] = args.metrics
+    if args.nprocs > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', args.master_port)
+        mp.spawn(run, args=(args.nprocs, values, args.data_path, args.conditional_path, args.backend, args.resume, profile, args.stream), nprocs=args.nprocs)
+    else:
+        run(0, 1, values, args.data_path, args.conditional_path, args.backend, args.resume, profile, args.stream)
 
-#generate a sample directly after training
-import sample as sample
\ No newline at end of file
+    #generate a sample directly after training
+    if not args.no_sample:
+        apply_config(values)
+        sys.argv = [sys.argv[0], os.path.join('output/models', 'best_model.pt')]
+        import sample as sample
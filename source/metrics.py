@@ -0,0 +1,169 @@
+import os
+import csv
+import json
+import time
+import queue
+import threading
+import contextlib
+import torch
+from config import LOG_EVERY
+
+#appends every record as one json line
+class JsonlBackend:
+
+    def __init__(self, path) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+#one csv file per record kind (e.g. metrics_interval.csv, metrics_epoch.csv), as kinds have different columns
+class CsvBackend:
+
+    def __init__(self, directory, prefix='metrics') -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.files = {}
+
+    def write(self, record):
+        kind = record.get('kind', 'metrics')
+        if kind not in self.files:
+            path = os.path.join(self.directory, f'{self.prefix}_{kind}.csv')
+            new_file = not os.path.isfile(path)
+            f = open(path, 'a', newline='')
+            writer = csv.DictWriter(f, fieldnames=list(record.keys()), extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            self.files[kind] = (f, writer)
+        f, writer = self.files[kind]
+        writer.writerow(record)
+        f.flush()
+
+    def close(self):
+        for f, _ in self.files.values():
+            f.close()
+
+#logs to weights & biases; wandb is only imported if this backend is used
+class WandbBackend:
+
+    def __init__(self, project, entity=None, config=None) -> None:
+        import wandb
+        self.wandb = wandb
+        if wandb.run is None:
+            wandb.init(project=project, entity=entity, config=config)
+
+    def write(self, record):
+        record = dict(record)
+        kind = record.pop('kind', None)
+        step = record.pop('step', None)
+        self.wandb.log({f'{kind}/{key}' if kind is not None else key: value for key, value in record.items()}, step=step)
+
+    def save_file(self, path):
+        self.wandb.save(path)
+
+    def close(self):
+        pass
+
+#buffers training metrics on the device and hands them to the backends every log_every steps on a background thread;
+#steps count from start_step (the restored step of a resumed run, see set_step)
+class MetricsLogger:
+
+    def __init__(self, backends=(), log_every=LOG_EVERY, device='cpu', start_step=0) -> None:
+        self.backends = list(backends)
+        self.log_every = log_every
+        self.loss_sum = torch.zeros((), device=device)
+        self.steps = start_step
+        self.interval_steps = 0
+        self.interval_start = time.perf_counter()
+        self.times = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    #continue counting from step, e.g. after a checkpoint restore; the current interval starts over
+    def set_step(self, step):
+        self.loss_sum.zero_()
+        self.steps = step
+        self.interval_steps = 0
+        self.times = {}
+        self.interval_start = time.perf_counter()
+
+    #accumulate wall time of a phase (e.g. 'data_wait', 'forward', 'backward') for the current interval;
+    #on cuda the time of asynchronous kernels is attributed to the phase that waits for them
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        yield
+        self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    #add the loss of one step; it stays on the device until the interval is logged
+    def log_loss(self, loss):
+        self.loss_sum += loss.detach()
+        self.steps += 1
+        self.interval_steps += 1
+        if self.steps % self.log_every == 0:
+            self.flush_interval()
+
+    def flush_interval(self):
+        if self.interval_steps == 0:
+            return
+        elapsed = time.perf_counter() - self.interval_start
+        record = {'kind': 'interval', 'step': self.steps, 'loss': self.loss_sum.item() / self.interval_steps,
+                  'steps_per_sec': self.interval_steps / elapsed}
+        for phase, seconds in self.times.items():
+            record[f'{phase}_sec'] = seconds / self.interval_steps
+        self.queue.put(record)
+        self.loss_sum.zero_()
+        self.interval_steps = 0
+        self.times = {}
+        self.interval_start = time.perf_counter()
+
+    #log a record of host values immediately, e.g. epoch loss
+    def log(self, kind, values):
+        self.queue.put({'kind': kind, 'step': self.steps, **values})
+
+    #upload a file with backends that support it (wandb)
+    def save_file(self, path):
+        self.queue.put(('save_file', path))
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for backend in self.backends:
+                if isinstance(record, tuple):
+                    if hasattr(backend, 'save_file'):
+                        backend.save_file(record[1])
+                else:
+                    backend.write(record)
+
+    def close(self):
+        self.flush_interval()
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            backend.close()
+
+#metrics logger with the backends given by name ('jsonl', 'csv', 'wandb')
+def create_logger(names, out_dir, log_every=LOG_EVERY, device='cpu', wandb_project='DiffWave', wandb_entity=None, config=None, start_step=0):
+    backends = []
+    for name in names:
+        if name == 'jsonl':
+            backends.append(JsonlBackend(os.path.join(out_dir, 'metrics.jsonl')))
+        elif name == 'csv':
+            backends.append(CsvBackend(out_dir))
+        elif name == 'wandb':
+            backends.append(WandbBackend(wandb_project, wandb_entity, config))
+        else:
+            raise ValueError(f'unknown metrics backend {name}')
+    return MetricsLogger(backends, log_every, device, start_step)
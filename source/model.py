@@ -1,10 +1,12 @@
 import math
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from tqdm import tqdm
 import torchaudio
 import numpy as np
-from config import VARIANCE_SCHEDULE, N_MELS, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS
+from diffusion import NoiseSchedule
+from config import N_MELS
 
 def Conv1d(*args, **kwargs):
   layer = torch.nn.Conv1d(*args, **kwargs)
@@ -38,7 +40,7 @@ class DiffusionEmbedding(torch.nn.Module):
         high_idx = torch.ceil(t).long()
         low = self.embedding[low_idx]
         high = self.embedding[high_idx]
-        return low + (high - low) * (t - low_idx)
+        return low + (high - low) * (t - low_idx).unsqueeze(-1)
 
     def _build_embedding(self, max_steps):
         steps = torch.arange(max_steps).unsqueeze(1)  # [T,1]
@@ -57,18 +59,45 @@ class SpectrogramConditioner(torch.nn.Module):
         # self.conv2 = torch.nn.ConvTranspose2d(1, 1, kernel_size=(3,12), stride=(1, 15), padding=(1, 229), output_padding=(0, 1)) #transpose conv shapes for speech samples
         self.conv2 = torch.nn.ConvTranspose2d(1, 1, kernel_size=(3,12), stride=(1, 7), padding=(1, 29))
         self.acivation2 = torch.nn.LeakyReLU(0.4)
-
-    #project spectrogram into latent space
-    def forward(self, spectrogram):
+        #the padding of the transpose convs crops the output, so shorter spectrograms would have no (or negative) output width
+        self.min_frames = 1
+        while min(self._widths(self.min_frames)) < 1:
+            self.min_frames += 1
+
+    #output widths of conv1 and conv2 for a spectrogram of the given number of frames
+    def _widths(self, frames):
+        widths = []
+        for conv in (self.conv1, self.conv2):
+            frames = (frames - 1) * conv.stride[1] - 2 * conv.padding[1] + conv.dilation[1] * (conv.kernel_size[1] - 1) + conv.output_padding[1] + 1
+            widths.append(frames)
+        return widths
+
+    #project spectrogram into latent space; if length is given, the upsampled spectrogram is resampled to exactly that many samples.
+    #Spectrograms shorter than min_frames are padded with their last frame, and the output of the padding is cropped off again.
+    def forward(self, spectrogram, length=None):
+        frames = spectrogram.shape[-1]
+        padding = max(self.min_frames - frames, 0)
+        if padding > 0:
+            spectrogram = F.pad(spectrogram, (0, padding, 0, 0), mode='replicate')
         spectrogram = self.conv1(spectrogram)
         spectrogram = self.acivation1(spectrogram)
         spectrogram = self.conv2(spectrogram)
         spectrogram = self.acivation2(spectrogram)
-        return torch.squeeze(spectrogram, 1)
+        spectrogram = torch.squeeze(spectrogram, 1)
+
+        #transpose conv shapes are tuned for 4 second spectrograms; other lengths are linearly interpolated to the waveform length
+        if padding > 0:
+            #keep the share of the output that belongs to the real frames, resampled to length samples if given
+            kept = length if length is not None else max(round(spectrogram.shape[-1] * frames / (frames + padding)), 1)
+            spectrogram = F.interpolate(spectrogram, size=round(kept * (frames + padding) / frames), mode='linear', align_corners=False)
+            return spectrogram[..., :kept]
+        if length is not None and spectrogram.shape[-1] != length:
+            spectrogram = F.interpolate(spectrogram, size=length, mode='linear', align_corners=False)
+        return spectrogram
 
 #DiffWave residual block
 class DiffWaveBlock(torch.nn.Module):
-    def __init__(self, layer_index, residual_channles, layer_width, dilation_mod, with_conditioning: bool) -> None:
+    def __init__(self, layer_index, residual_channles, layer_width, dilation_mod, with_conditioning: bool, n_mels=N_MELS) -> None:
         super().__init__()
         self.layer_index = layer_index
         self.residual_channels = residual_channles
@@ -78,7 +107,7 @@ class DiffWaveBlock(torch.nn.Module):
         self.with_conditioner = with_conditioning
 
         if with_conditioning:
-            self.conv_conditioner = Conv1d(N_MELS, 2*residual_channles, 1)
+            self.conv_conditioner = Conv1d(n_mels, 2*residual_channles, 1)
 
         # linear layer that processes diffusion timestep
         self.fc_timestep = torch.nn.Linear(layer_width, residual_channles)
@@ -91,16 +120,20 @@ class DiffWaveBlock(torch.nn.Module):
 
     #forward pass, according to architecture in DiffWave paper
     def forward(self, x, t, conditioning_var=None):
-        input = x.clone()
         t = self.fc_timestep(t)
-        t = t.unsqueeze(-1) # add another dimension at the end
-        t = t.expand(1, 64, SAMPLE_RATE * SAMPLE_LENGTH_SECONDS) # expand the last dimension to match x; 22500 * 5 = 110250
-        x = x + t #broadcast addition
+        t = t.unsqueeze(-1) # add another dimension at the end; (batch size,) channels, 1
+        conditioner = self.conv_conditioner(conditioning_var) if conditioning_var is not None else None
+        return self.forward_with_bias(x, t, conditioner)
+
+    #forward pass with already projected timestep bias and conditioner; these do not depend on x and can be cached during sampling
+    def forward_with_bias(self, x, t, conditioner=None):
+        input = x #not modified in place below, so no copy is needed
+        x = x + t #broadcast addition over the length (and batch) dimension
         x = self.conv_dilated(x)
 
         #if conditionin variable is used, add it as bias to input x
-        if conditioning_var is not None:
-            x = x + self.conv_conditioner(conditioning_var)
+        if conditioner is not None:
+            x = x + conditioner
         x_tanh, x_sigmoid = x.chunk(2, dim=1)
         x_tanh = torch.tanh(x_tanh)
         x_sigmoid = torch.sigmoid(x_sigmoid)
@@ -111,8 +144,11 @@ class DiffWaveBlock(torch.nn.Module):
 
 
 class DiffWave(torch.nn.Module):
-    def __init__(self, residual_channels, num_blocks, timesteps, variance_schedule, with_conditioning, n_mels, layer_width=512, dilation_mod=12, ) -> None:
+    def __init__(self, residual_channels, num_blocks, timesteps, variance_schedule, with_conditioning, n_mels, layer_width=512, dilation_mod=12, checkpoint_blocks=0) -> None:
         super().__init__()
+        #activation checkpointing: in training, only the inputs of every segment of checkpoint_blocks blocks are kept,
+        #and the activations inside a segment are recomputed during backward; 0 keeps all activations
+        self.checkpoint_blocks = checkpoint_blocks
         self.timesteps = timesteps
         self.variance_schedule = variance_schedule
         self.num_blocks = num_blocks
@@ -124,8 +160,11 @@ class DiffWave(torch.nn.Module):
         if with_conditioning:
             self.conditioner_block = SpectrogramConditioner()
 
+        #diffusion coefficients of the training schedule and of inference schedules, on the model's device
+        self.noise_schedule = NoiseSchedule(variance_schedule)
+
         #layer that projects diffusion timestep into latent space
-        self.timestep_in = DiffusionEmbedding(len(VARIANCE_SCHEDULE))
+        self.timestep_in = DiffusionEmbedding(len(variance_schedule))
 
         #input layer before DiffWave blocks
         self.waveform_in = torch.nn.Sequential(
@@ -136,7 +175,7 @@ class DiffWave(torch.nn.Module):
         #DiffWave blocks
         self.blocks = torch.nn.ModuleList()
         for i in range(num_blocks):
-            self.blocks.append(DiffWaveBlock(i, residual_channels, layer_width, dilation_mod=dilation_mod, with_conditioning=with_conditioning))
+            self.blocks.append(DiffWaveBlock(i, residual_channels, layer_width, dilation_mod=dilation_mod, with_conditioning=with_conditioning, n_mels=n_mels))
 
         #outgoing layers
         self.out = torch.nn.Sequential(
@@ -148,7 +187,7 @@ class DiffWave(torch.nn.Module):
     def forward(self, x, t, conditioning_var=None):
         #conditioning variable (spectrogram) input
         if conditioning_var is not None:
-            conditioning_var = self.conditioner_block(conditioning_var)
+            conditioning_var = self.conditioner_block(conditioning_var, x.shape[-1])
 
         #waveform input
         x = self.waveform_in(x)
@@ -158,46 +197,52 @@ class DiffWave(torch.nn.Module):
 
         #blocks
         skip = None
-        for block in self.blocks:
-            x, skip_connection = block.forward(x, t, conditioning_var=conditioning_var)
-            skip = skip_connection if skip is None else skip_connection + skip
+        if self.checkpoint_blocks > 0 and self.training and torch.is_grad_enabled():
+            for start in range(0, len(self.blocks), self.checkpoint_blocks):
+                x, skip = checkpoint(self._run_blocks, start, start + self.checkpoint_blocks, x, t, conditioning_var, skip, use_reentrant=False)
+        else:
+            x, skip = self._run_blocks(0, len(self.blocks), x, t, conditioning_var, skip)
         skip = skip / np.sqrt(len(self.blocks)) #divide by sqrt of number of blocks as in paper Github code
         
         #out
         x = self.out(x)
         return x
 
-    #generate a sample from noise input
-    def sample(self, x_t, conditioning_var=None):
+    #constructor arguments, to rebuild the model in another process or from a saved file (see build_model)
+    def hparams(self):
+        return {
+            'residual_channels': self.blocks[0].residual_channels,
+            'num_blocks': self.num_blocks,
+            'timesteps': self.timesteps,
+            'variance_schedule': torch.as_tensor(self.variance_schedule).tolist(),
+            'with_conditioning': self.with_conditioner,
+            'n_mels': self.n_mels,
+            'layer_width': self.layer_width,
+        }
+
+    #blocks[start:end], adding their skip connections to skip
+    def _run_blocks(self, start, end, x, t, conditioning_var, skip):
+        for block in self.blocks[start:end]:
+            x, skip_connection = block.forward(x, t, conditioning_var=conditioning_var)
+            skip = skip_connection if skip is None else skip_connection + skip
+        return x, skip
+
+    #generate a sample from noise input; if an inference_schedule (list of betas) is given, only its steps are denoised (fast sampling)
+    def sample(self, x_t, conditioning_var=None, inference_schedule=None):
         with torch.no_grad():
+            timesteps, c1, c2, sigma = self.noise_schedule.sampling_tables(inference_schedule)
 
-            talpha = 1 - self.variance_schedule
-            talpha_cum = np.cumprod(talpha)
-
-            beta = self.variance_schedule
-            alpha = 1 - beta
-            alpha_cum = np.cumprod(alpha)
-
-            #code below calculates the time steps for the diffusion process; relevant for FAST sampling
-            T = []
-            for s in range(len(self.variance_schedule)):
-                for t in range(len(self.variance_schedule) - 1):
-                    if talpha_cum[t+1] <= alpha_cum[s] <= talpha_cum[t]:
-                        twiddle = (talpha_cum[t]**0.5 - alpha_cum[s]**0.5) / (talpha_cum[t]**0.5 - talpha_cum[t+1]**0.5)
-                        T.append(t + twiddle)
-                        break
-            T = np.array(T, dtype=np.float32)
-
-            #the code below is the actual sampling process
-            for n in tqdm(range(len(alpha) - 1, -1, -1)):
-                c1 = 1 / alpha[n]**0.5
-                c2 = beta[n] / (1 - alpha_cum[n])**0.5
-                x_t = c1 * (x_t - c2 * self.forward(x_t, torch.tensor(n), conditioning_var).squeeze(1))
+            #the code below is the actual sampling process; every sample in the batch gets its own timestep entry
+            for n in tqdm(range(len(timesteps) - 1, -1, -1)):
+                t = timesteps[n].expand(x_t.shape[0])
+                x_t = c1[n] * (x_t - c2[n] * self.forward(x_t, t, conditioning_var))
                 if n > 0:
                     noise = torch.randn_like(x_t)
-                    sigma = ((1.0 - alpha_cum[n-1]) / (1.0 - alpha_cum[n]) * beta[n])**0.5
-                    x_t += sigma * noise
+                    x_t += sigma[n] * noise
                 x_t = torch.clamp(x_t, -1.0, 1.0)
         return x_t 
 
-
+#DiffWave with the constructor arguments returned by DiffWave.hparams
+def build_model(hparams):
+    return DiffWave(hparams['residual_channels'], hparams['num_blocks'], hparams['timesteps'], torch.tensor(hparams['variance_schedule']),
+                    hparams['with_conditioning'], hparams['n_mels'], layer_width=hparams['layer_width'])
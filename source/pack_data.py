@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import numpy as np
+import torch
+import torchaudio
+from tqdm import tqdm
+from config import SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, PACKED_DATA_DIR, SHARD_SIZE, MEL_BATCH_SIZE, AUDIO_EXTENSIONS
+
+INDEX_FILE = 'index.json'
+
+#load a single chunk as mono waveform of fixed length at SAMPLE_RATE
+def load_chunk(audio_path, length=SAMPLE_RATE * SAMPLE_LENGTH_SECONDS):
+    return fit_chunk(*torchaudio.load(audio_path), length)
+
+def fit_chunk(waveform, sample_rate, length=SAMPLE_RATE * SAMPLE_LENGTH_SECONDS):
+    if sample_rate != SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=SAMPLE_RATE)
+    waveform = waveform[0]
+
+    #pad or crop to the fixed training length, so all chunks fit into one array
+    if waveform.shape[0] < length:
+        waveform = torch.nn.functional.pad(waveform, (0, length - waveform.shape[0]))
+    return waveform[:length].numpy().astype(np.float32)
+
+#pair every audio chunk with its spectrogram by file name (data_prep writes '<chunk file name>.spec.npy')
+def pair_files(audio_dir, conditional_dir=None):
+    pairs = []
+    for audio_file in sorted(os.listdir(audio_dir)):
+        if not audio_file.endswith(AUDIO_EXTENSIONS) or not os.path.isfile(os.path.join(audio_dir, audio_file)):
+            continue
+        conditional_file = None
+        if conditional_dir is not None:
+            conditional_file = f'{audio_file}.spec.npy'
+            if not os.path.isfile(os.path.join(conditional_dir, conditional_file)):
+                print(f'No spectrogram found for {audio_file}, skipping')
+                continue
+        pairs.append((audio_file, conditional_file))
+    return pairs
+
+#pack chunked audio and mel spectrograms into sharded .npy files that can be memory mapped; with a frontend (MelFrontend
+#of features.py) the spectrograms are computed from the chunks in batches and written directly into the shards
+def pack(audio_dir, conditional_dir=None, out_dir=PACKED_DATA_DIR, shard_size=SHARD_SIZE, max_samples=None, frontend=None, batch_size=MEL_BATCH_SIZE):
+    if not os.path.isdir(audio_dir):
+        raise ValueError(f'audio_dir {audio_dir} does not exist')
+    os.makedirs(out_dir, exist_ok=True)
+
+    pairs = pair_files(audio_dir, conditional_dir if frontend is None else None)
+    if max_samples is not None:
+        pairs = pairs[:max_samples]
+    if len(pairs) == 0:
+        raise ValueError(f'no samples found in {audio_dir}')
+
+    length = SAMPLE_RATE * SAMPLE_LENGTH_SECONDS
+    mel_shape = None
+    if frontend is not None:
+        #spectrograms are computed from the first channel at the source sample rate, like data_prep.py does
+        mel_shape = (frontend.n_mels, frontend.frames(torchaudio.load(os.path.join(audio_dir, pairs[0][0]))[0].shape[1]))
+    elif conditional_dir is not None:
+        mel_shape = np.load(os.path.join(conditional_dir, pairs[0][1]), mmap_mode='r')[0].shape
+
+    index = {
+        'sample_rate': SAMPLE_RATE,
+        'audio_length': length,
+        'mel_shape': list(mel_shape) if mel_shape is not None else None,
+        'shards': [],
+        'items': [],
+    }
+
+    for shard_id, shard_start in enumerate(range(0, len(pairs), shard_size)):
+        shard_pairs = pairs[shard_start:shard_start + shard_size]
+        audio_name = f'shard_{shard_id:05d}_audio.npy'
+        audio_out = np.lib.format.open_memmap(os.path.join(out_dir, audio_name), mode='w+', dtype=np.float32, shape=(len(shard_pairs), length))
+        mel_name = None
+        if mel_shape is not None:
+            mel_name = f'shard_{shard_id:05d}_mel.npy'
+            mel_out = np.lib.format.open_memmap(os.path.join(out_dir, mel_name), mode='w+', dtype=np.float32, shape=(len(shard_pairs), *mel_shape))
+
+        batch = []
+        for row, (audio_file, conditional_file) in enumerate(tqdm(shard_pairs, desc=f'shard {shard_id}')):
+            if frontend is not None:
+                waveform, sample_rate = torchaudio.load(os.path.join(audio_dir, audio_file))
+                audio_out[row] = fit_chunk(waveform, sample_rate, length)
+                if frontend.frames(waveform.shape[1]) != mel_shape[1]:
+                    raise ValueError(f'spectrogram of {audio_file} would have {frontend.frames(waveform.shape[1])} frames, expected {mel_shape[1]}')
+                batch.append(waveform[0])
+                #transform a batch of chunks at once, straight into the memory mapped shard
+                if len(batch) == batch_size or row == len(shard_pairs) - 1:
+                    frontend(torch.stack(batch), out=torch.from_numpy(mel_out[row + 1 - len(batch):row + 1]))
+                    batch = []
+            else:
+                audio_out[row] = load_chunk(os.path.join(audio_dir, audio_file), length)
+                if mel_shape is not None:
+                    mel = np.load(os.path.join(conditional_dir, conditional_file))[0]
+                    if mel.shape != mel_shape:
+                        raise ValueError(f'spectrogram {conditional_file} has shape {mel.shape}, expected {mel_shape}')
+                    mel_out[row] = mel
+            index['items'].append({'shard': shard_id, 'row': row, 'audio': audio_file, 'mel': conditional_file})
+
+        audio_out.flush()
+        del audio_out
+        if mel_shape is not None:
+            mel_out.flush()
+            del mel_out
+        index['shards'].append({'audio': audio_name, 'mel': mel_name, 'count': len(shard_pairs)})
+
+    #index is written last, so an interrupted build never leaves a store that looks complete
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    print(f'Packed {len(pairs)} samples into {len(index["shards"])} shards in {out_dir}')
+    return index
+
+#example: python source/pack_data.py data/chunked_audio data/mel_spectrograms data/packed
+if __name__ == '__main__':
+    audio_dir = os.path.join('data/chunked_audio')
+    conditional_dir = os.path.join('data/mel_spectrograms')
+    out_dir = PACKED_DATA_DIR
+
+    if len(sys.argv) > 1:
+        audio_dir = sys.argv[1]
+    if len(sys.argv) > 2:
+        conditional_dir = sys.argv[2] if sys.argv[2] != 'none' else None
+    if len(sys.argv) > 3:
+        out_dir = sys.argv[3]
+
+    #'compute' instead of a spectrogram folder computes the spectrograms from the chunks while packing
+    if conditional_dir == 'compute':
+        from features import MelFrontend
+        pack(audio_dir, None, out_dir, frontend=MelFrontend())
+    else:
+        pack(audio_dir, conditional_dir, out_dir)
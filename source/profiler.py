@@ -0,0 +1,117 @@
+import os
+import time
+import contextlib
+import torch
+
+#currently allocated memory in bytes: allocated tensors on cuda, resident set size of the process on cpu
+def memory_allocated(device):
+    if device.type == 'cuda':
+        return torch.cuda.memory_allocated(device)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+#opt-in instrumentation: wall time and memory per training/sampling phase and per DiffWave module,
+#plus a torch.profiler trace for a window of steps. When disabled, every method is a cheap no-op.
+class Profiler:
+
+    def __init__(self, enabled=False, device=torch.device('cpu'), trace_dir=None, trace_steps=(10, 20)) -> None:
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        self.stats = {} # name -> [calls, seconds, memory delta bytes, peak memory bytes]
+        self.hooks = []
+        self.step_count = 0
+        self.trace = None
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def add(self, name, seconds, memory=0, peak=0):
+        if not self.enabled:
+            return
+        stat = self.stats.setdefault(name, [0, 0.0, 0, 0])
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] += memory
+        stat[3] = max(stat[3], peak)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        memory_start = memory_allocated(self.device)
+        start = time.perf_counter()
+        yield
+        self._sync()
+        memory_end = memory_allocated(self.device)
+        self.add(name, time.perf_counter() - start, memory_end - memory_start, memory_end)
+
+    #time the forward pass of the conditioner, timestep embedding, input/output layers and every block of a DiffWave model
+    def attach(self, model):
+        if not self.enabled:
+            return
+        model = model.module if hasattr(model, 'module') else model
+        modules = {'waveform_in': model.waveform_in, 'timestep_in': model.timestep_in, 'out': model.out}
+        if hasattr(model, 'conditioner_block'):
+            modules['conditioner_block'] = model.conditioner_block
+        for i, block in enumerate(model.blocks):
+            modules[f'blocks.{i}'] = block
+        for name, module in modules.items():
+            self.hooks.append(module.register_forward_pre_hook(self._pre_hook))
+            self.hooks.append(module.register_forward_hook(self._make_post_hook(f'module/{name}')))
+
+    def _pre_hook(self, module, inputs):
+        self._sync()
+        module._profiler_start = (time.perf_counter(), memory_allocated(self.device))
+
+    def _make_post_hook(self, name):
+        def hook(module, inputs, outputs):
+            self._sync()
+            start, memory_start = module._profiler_start
+            memory_end = memory_allocated(self.device)
+            self.add(name, time.perf_counter() - start, memory_end - memory_start, memory_end)
+        return hook
+
+    def detach(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    #call once per training/sampling step; records a torch.profiler trace for steps trace_steps[0] to trace_steps[1]
+    def step(self):
+        if not self.enabled:
+            return
+        self.step_count += 1
+        if self.trace_dir is None:
+            return
+        if self.step_count == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.__enter__()
+        elif self.step_count == self.trace_steps[1] and self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, f'trace_steps_{self.trace_steps[0]}_{self.trace_steps[1]}.json')
+            self.trace.export_chrome_trace(path)
+            print(f'Saved profiler trace to {path} (open in chrome://tracing or https://ui.perfetto.dev)')
+            self.trace = None
+
+    #table of all phases and modules, most expensive first
+    def summary(self):
+        if not self.enabled or len(self.stats) == 0:
+            return ''
+        total = sum(stat[1] for name, stat in self.stats.items() if not name.startswith('module/'))
+        lines = [f'{"name":<24} {"calls":>8} {"total s":>10} {"mean ms":>10} {"% time":>8} {"mean mem MB":>12} {"peak mem MB":>12}']
+        for name, (calls, seconds, memory, peak) in sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True):
+            share = 100 * seconds / total if total > 0 else 0.0
+            lines.append(f'{name:<24} {calls:>8} {seconds:>10.3f} {1000 * seconds / calls:>10.3f} {share:>8.1f} {memory / calls / 2**20:>12.2f} {peak / 2**20:>12.1f}')
+        return '\n'.join(lines)
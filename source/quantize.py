@@ -0,0 +1,257 @@
+import io
+import os
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.ao.quantization as quantization
+from tqdm import tqdm
+from model import DiffWave, build_model
+from inference import InferenceEngine
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, N_MELS, WITH_CONDITIONING, INFERENCE_SCHEDULE, SAMPLES_PER_FRAME
+
+#int8 kernels of the cpu: x86 (fbgemm) on intel/amd, qnnpack on arm
+ENGINE = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+
+OBSERVERS = {
+    'minmax': quantization.MinMaxObserver,
+    'histogram': quantization.HistogramObserver,
+}
+
+def _qconfig(observer):
+    #reduce_range avoids overflow of the 16 bit accumulation of fbgemm
+    return quantization.QConfig(activation=OBSERVERS[observer].with_args(reduce_range=ENGINE == 'x86'),
+                                weight=quantization.default_per_channel_weight_observer)
+
+def _linear(weight, bias):
+    linear = torch.nn.Linear(weight.shape[1], weight.shape[0])
+    with torch.no_grad():
+        linear.weight.copy_(weight)
+        linear.bias.copy_(bias)
+    return linear
+
+#Conv1d as a linear layer over kernel_size shifted copies of a time major (batch, length, channels) input. Quantized
+#Conv1d works in a channels last layout internally, and converting to and from it costs more than int8 saves;
+#quantized linear layers on time major activations need no layout changes.
+class DilatedLinear(torch.nn.Module):
+
+    def __init__(self, conv) -> None:
+        super().__init__()
+        self.kernel_size = conv.kernel_size[0]
+        self.dilation = conv.dilation[0]
+        #tap k of the kernel reads the input shifted by (k - kernel_size // 2) * dilation, as with padding='same'
+        self.linear = _linear(conv.weight.permute(0, 2, 1).reshape(conv.out_channels, -1), conv.bias)
+
+    #columns is an optional (batch, length, kernel_size * channels) buffer that is reused between calls;
+    #allocating it anew for every block costs more than the copies into it
+    def forward(self, x, columns=None):
+        batch_size, length, channels = x.shape
+        if columns is None:
+            columns = x.new_empty(batch_size, length, self.kernel_size * channels)
+        for k in range(self.kernel_size):
+            shift = (k - self.kernel_size // 2) * self.dilation
+            column = columns[:, :, k * channels:(k + 1) * channels]
+            edge = min(abs(shift), length)
+            if shift < 0:
+                column[:, :edge] = 0.0
+                column[:, edge:] = x[:, :length - edge]
+            elif shift > 0:
+                column[:, length - edge:] = 0.0
+                column[:, :length - edge] = x[:, edge:]
+            else:
+                column.copy_(x)
+        return self.linear(columns)
+
+#DiffWaveBlock on time major activations; only the residual half of conv_out is kept, DiffWave does not use the skip output
+class TimeMajorBlock(torch.nn.Module):
+
+    def __init__(self, block) -> None:
+        super().__init__()
+        channels = block.residual_channels
+        self.dilated = DilatedLinear(block.conv_dilated)
+        self.residual = _linear(block.conv_out.weight[:channels, :, 0], block.conv_out.bias[:channels])
+
+    #x is updated in place; t_bias (batch or 1, 1, channels) and conditioner (batch, length, 2 * channels) are already projected
+    def forward(self, x, t_bias, conditioner=None, columns=None):
+        h = self.dilated(x + t_bias, columns)
+        if conditioner is not None:
+            h += conditioner
+        h_tanh, h_sigmoid = h.chunk(2, dim=-1)
+        #h is a fresh tensor, so the activations can be applied in place
+        h = h_tanh.tanh_() * h_sigmoid.sigmoid_()
+        return x.add_(self.residual(h)).mul_(1 / np.sqrt(2.0))
+
+#inference only DiffWave with every convolution as a linear layer over (batch, length, channels) activations, so it can be
+#quantized to int8. Has the sample method of InferenceEngine: conditioner and timestep projections are computed once per run.
+class QuantizableDiffWave(torch.nn.Module):
+
+    def __init__(self, model) -> None:
+        super().__init__()
+        model = copy.deepcopy(model).cpu().float().eval()
+        self.num_blocks = len(model.blocks)
+        self.residual_channels = model.blocks[0].residual_channels
+        self.with_conditioner = model.with_conditioner
+        self.noise_schedule = model.noise_schedule
+
+        self.timestep_in = model.timestep_in
+        self.fc_timestep = _linear(torch.cat([block.fc_timestep.weight for block in model.blocks]), torch.cat([block.fc_timestep.bias for block in model.blocks]))
+        if model.with_conditioner:
+            self.conditioner_block = model.conditioner_block
+            self.conv_conditioner = _linear(torch.cat([block.conv_conditioner.weight[:, :, 0] for block in model.blocks]),
+                                            torch.cat([block.conv_conditioner.bias for block in model.blocks]))
+        self.waveform_in = _linear(model.waveform_in[0].weight[:, :, 0], model.waveform_in[0].bias)
+        self.blocks = torch.nn.ModuleList([TimeMajorBlock(block) for block in model.blocks])
+        self.out1 = _linear(model.out[0].weight[:, :, 0], model.out[0].bias)
+        self.out2 = _linear(model.out[2].weight[:, :, 0], model.out[2].bias)
+        self.columns = None
+
+    #timestep bias of every block for every step (steps, blocks, 1, channels) and projected conditioner (batch, length, blocks * 2 * channels)
+    def prepare(self, timesteps, conditioning_var=None, length=None):
+        t_biases = self.fc_timestep(self.timestep_in(timesteps)).view(len(timesteps), self.num_blocks, 1, self.residual_channels)
+        conditioners = None
+        if conditioning_var is not None:
+            conditioners = self.conv_conditioner(self.conditioner_block(conditioning_var, length).transpose(1, 2))
+        return t_biases, conditioners
+
+    #predicted noise (batch, 1, length) at step n of the prepared steps
+    def denoise(self, x, n, t_biases, conditioners):
+        x = torch.relu(self.waveform_in(x.transpose(1, 2)))
+        width = 2 * self.residual_channels
+        #shared by the dilated layers of all blocks; kept while the length stays the same, i.e. over all steps of a run
+        shape = (x.shape[0], x.shape[1], self.blocks[0].dilated.kernel_size * self.residual_channels)
+        if self.columns is None or self.columns.shape != shape:
+            self.columns = x.new_empty(shape)
+        for i, block in enumerate(self.blocks):
+            conditioner = conditioners[:, :, i * width:(i + 1) * width] if conditioners is not None else None
+            x = block(x, t_biases[n, i], conditioner, self.columns)
+        return self.out2(torch.relu(self.out1(x))).transpose(1, 2)
+
+    #same reverse process as InferenceEngine.sample
+    def sample(self, x_t, conditioning_var=None, inference_schedule=None):
+        with torch.no_grad():
+            timesteps, c1, c2, sigma = self.noise_schedule.sampling_tables(inference_schedule)
+            t_biases, conditioners = self.prepare(timesteps, conditioning_var, x_t.shape[-1])
+            for n in tqdm(range(len(timesteps) - 1, -1, -1)):
+                x_t = c1[n] * (x_t - c2[n] * self.denoise(x_t, n, t_biases, conditioners))
+                if n > 0:
+                    noise = torch.randn_like(x_t)
+                    x_t += sigma[n] * noise
+                x_t = torch.clamp(x_t, -1.0, 1.0)
+        self.columns = None
+        return x_t
+
+#static: linear layers of the blocks and the output in int8 with activation ranges from a calibration pass over spectrograms;
+#dynamic: all linear layers in int8 with activation ranges measured on every call. Layers that run once per sampling run
+#(timestep and conditioner projections) are always quantized dynamically.
+def quantize(model, mode='static', calibration=None, observer='minmax', inference_schedule=None):
+    torch.backends.quantized.engine = ENGINE
+    model = QuantizableDiffWave(model)
+    if mode == 'static':
+        qconfig = _qconfig(observer)
+        for block in model.blocks:
+            block.dilated.linear = quantization.QuantWrapper(block.dilated.linear)
+            block.residual = quantization.QuantWrapper(block.residual)
+        model.out1 = quantization.QuantWrapper(model.out1)
+        model.out2 = quantization.QuantWrapper(model.out2)
+        for module in model.modules():
+            if isinstance(module, quantization.QuantWrapper):
+                module.qconfig = qconfig
+        quantization.prepare(model, inplace=True)
+        #observers record activation ranges while sampling, so the ranges of all noise levels are covered
+        for conditioning_var, length in calibration or []:
+            noise = torch.randn(conditioning_var.shape[0] if conditioning_var is not None else 1, 1, length)
+            model.sample(noise, conditioning_var=conditioning_var, inference_schedule=inference_schedule)
+        quantization.convert(model, inplace=True)
+    elif mode != 'dynamic':
+        raise ValueError(f'unknown quantization mode {mode}')
+    quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+#hyperparameters needed to rebuild the model structure, so a quantized model can be loaded without matching config.py
+#quantized is the output of quantize(model, ...)
+def save_quantized(quantized, model, path, mode, observer='minmax'):
+    torch.save({'quantization': {'mode': mode, 'observer': observer, 'engine': ENGINE}, 'hparams': model.hparams(), 'state_dict': quantized.state_dict()}, path)
+
+#rebuild the quantized structure (with empty observers) and load the int8 weights and quantization parameters into it; cpu only.
+#The result is used like an InferenceEngine: model.sample(noise, conditioning_var, inference_schedule)
+def load_quantized(path):
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    model = build_model(state['hparams'])
+    model = quantize(model, state['quantization']['mode'], observer=state['quantization']['observer'])
+    model.load_state_dict(state['state_dict'])
+    model.eval()
+    return model
+
+#calibration batches (spectrograms, waveform length) from the first n spectrogram files of a folder
+def calibration_batches(spectrogram_dir, n, batch_size, frames=None):
+    paths = sorted(os.path.join(spectrogram_dir, f) for f in os.listdir(spectrogram_dir) if f.endswith('.npy'))[:n]
+    for start in range(0, len(paths), batch_size):
+        spectrograms = torch.stack([torch.from_numpy(np.load(path))[0:1] for path in paths[start:start + batch_size]])
+        if frames is not None:
+            spectrograms = spectrograms[..., :frames]
+        yield spectrograms, round(spectrograms.shape[-1] * SAMPLES_PER_FRAME)
+
+#bytes of the saved state dict
+def file_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+#latency of one sampling run and the error of its output against the fp32 model with the same noise
+def evaluate(model, reference, conditioning_var, length, inference_schedule, seed=0):
+    torch.manual_seed(seed)
+    noise = torch.randn(conditioning_var.shape[0] if conditioning_var is not None else 1, 1, length)
+    start = time.perf_counter()
+    torch.manual_seed(seed + 1)
+    engine = model if isinstance(model, QuantizableDiffWave) else InferenceEngine(model)
+    y = engine.sample(noise, conditioning_var=conditioning_var, inference_schedule=inference_schedule)
+    seconds = time.perf_counter() - start
+    if reference is None:
+        return seconds, y, {}
+    error = y - reference
+    snr = 10 * torch.log10(reference.pow(2).mean() / error.pow(2).mean().clamp_min(1e-12)).item()
+    return seconds, y, {'max abs error': error.abs().max().item(), 'mean abs error': error.abs().mean().item(), 'snr dB': snr}
+
+#example: python source/quantize.py output/models/best_model.pt output/models/best_model.int8.pt --spectrograms data/mel_spectrograms
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='post-training int8 quantization of a trained DiffWave for cpu inference')
+    parser.add_argument('model_path')
+    parser.add_argument('out_path')
+    parser.add_argument('--mode', default='static', choices=['static', 'dynamic'], help='static: int8 convs and linear layers, dynamic: int8 linear layers only')
+    parser.add_argument('--spectrograms', default='data/mel_spectrograms', help='folder of .spec.npy files used for calibration and evaluation')
+    parser.add_argument('--calibration-samples', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--calibration-frames', type=int, default=None, help='only use the first frames of every calibration spectrogram, to calibrate faster')
+    parser.add_argument('--observer', default='minmax', choices=list(OBSERVERS))
+    parser.add_argument('--fast', action='store_true', help='calibrate and evaluate with INFERENCE_SCHEDULE instead of the full schedule')
+    args = parser.parse_args()
+
+    model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+    inference_schedule = INFERENCE_SCHEDULE if args.fast else None
+
+    calibration = None
+    if args.mode == 'static':
+        if WITH_CONDITIONING:
+            calibration = calibration_batches(args.spectrograms, args.calibration_samples, args.batch_size, args.calibration_frames)
+        else:
+            calibration = [(None, SAMPLE_RATE)] * args.calibration_samples
+    start = time.perf_counter()
+    quantized = quantize(model, args.mode, calibration, args.observer, inference_schedule)
+    print(f'Quantized ({args.mode}) in {time.perf_counter() - start:.1f}s')
+    save_quantized(quantized, model, args.out_path, args.mode, args.observer)
+    print(f'Saved quantized model to {args.out_path}')
+
+    #report on a spectrogram that was not used for calibration, if there is one
+    conditioning_var, length = None, SAMPLE_RATE
+    if WITH_CONDITIONING:
+        batches = list(calibration_batches(args.spectrograms, args.calibration_samples + 1, 1))
+        conditioning_var, length = batches[-1]
+    fp32_seconds, reference, _ = evaluate(model, None, conditioning_var, length, inference_schedule)
+    int8_seconds, _, errors = evaluate(load_quantized(args.out_path), reference, conditioning_var, length, inference_schedule)
+    print(f'{"model":<6} {"latency s":>10} {"size MB":>8}')
+    print(f'{"fp32":<6} {fp32_seconds:>10.3f} {file_size(model) / 2**20:>8.2f}')
+    print(f'{"int8":<6} {int8_seconds:>10.3f} {os.path.getsize(args.out_path) / 2**20:>8.2f}')
+    print(f'speedup: {fp32_seconds / int8_seconds:.2f}x | ' + ' | '.join(f'{name}: {value:.4g}' for name, value in errors.items()))
@@ -3,9 +3,13 @@ import sys
 import numpy as np
 import torch
 import torchaudio
-import wandb
+try:
+    import wandb
+except ImportError:
+    wandb = None
 from model import DiffWave
-from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, WITH_CONDITIONING
+from inference import InferenceEngine
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, SAMPLE_LENGTH_SECONDS, N_MELS, WITH_CONDITIONING, INFERENCE_SCHEDULE
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -24,11 +28,22 @@ if len(sys.argv) > 1:
 if len(sys.argv) > 2:
     conditioner_file_name = sys.argv[2]
 
+#use fast sampling with the reduced INFERENCE_SCHEDULE, if "fast" is given as third argument
+inference_schedule = None
+if len(sys.argv) > 3 and sys.argv[3] == 'fast':
+    inference_schedule = INFERENCE_SCHEDULE
 
-#load trained model
-model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS,)
-model.load_state_dict(torch.load(model_path, map_location=device))
-model.eval()
+#load trained model; a model written by quantize.py is loaded as int8 model, which runs on the cpu and samples by itself
+state = torch.load(model_path, map_location='cpu', weights_only=False)
+if 'quantization' in state:
+    from quantize import load_quantized
+    model = load_quantized(model_path)
+    engine = model
+else:
+    model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, WITH_CONDITIONING, N_MELS,)
+    model.load_state_dict(state)
+    model.eval()
+    engine = InferenceEngine(model)
 
 #load conditioning variable (spectrogram)
 conditioning_var=None
@@ -40,7 +55,7 @@ if WITH_CONDITIONING:
 noise = torch.randn(1, 1, SAMPLE_RATE*SAMPLE_LENGTH_SECONDS) # batch_size, n_channels, sample length e.g. 16KHz * 4000 milliseconds = 4 seconds of noise
 
 #get denoised sample
-y = model.sample(noise, conditioning_var=conditioning_var if model.with_conditioner else None)
+y = engine.sample(noise, conditioning_var=conditioning_var if model.with_conditioner else None, inference_schedule=inference_schedule)
 
 #save audio for each generated sample in batch
 for i in range(y.shape[0]):
@@ -51,7 +66,7 @@ for i in range(y.shape[0]):
     torchaudio.save(path, y[i], SAMPLE_RATE)
 
     #save audio to wandb, if wandb is initialized
-    if wandb.run is not None:
+    if wandb is not None and wandb.run is not None:
         wandb.save(path)
 
     print('Saved sample to', path)
\ No newline at end of file
@@ -0,0 +1,252 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import torch
+from model import DiffWave
+from inference import InferenceEngine
+from synthesize import write_wav_stream
+from batch_sample import load_model
+from config import SAMPLE_RATE, N_MELS, INFERENCE_SCHEDULE, SAMPLES_PER_FRAME, SYNTHESIS_WINDOW_FRAMES, SERVER_MAX_BATCH, SERVER_MAX_WAIT_MS, SERVER_MAX_QUEUE
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class QueueFull(Exception):
+    pass
+
+class SynthesisRequest:
+
+    def __init__(self, spectrogram, fast, future) -> None:
+        self.spectrogram = spectrogram # n_mels, frames
+        self.fast = fast
+        self.future = future
+        self.arrival = time.perf_counter()
+        #requests can only be batched with others of the same length and schedule
+        self.key = (spectrogram.shape[-1], fast)
+
+#rolling latency samples and counters, reported by GET /metrics
+class ServerMetrics:
+
+    def __init__(self, window=1000) -> None:
+        self.latencies = {'total': collections.deque(maxlen=window), 'queue_wait': collections.deque(maxlen=window), 'compute': collections.deque(maxlen=window)}
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+
+    def add(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def report(self, queue_depth, in_progress):
+        report = {
+            'uptime_sec': time.perf_counter() - self.started,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'queue_depth': queue_depth,
+            'in_progress': in_progress,
+            'batches': len(self.batch_sizes),
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.0,
+        }
+        for name, values in self.latencies.items():
+            if len(values) > 0:
+                for p in (50, 90, 99):
+                    report[f'{name}_p{p}_ms'] = float(np.percentile(values, p)) * 1000
+        return report
+
+#collects concurrent requests into batches: a batch is started when max_batch requests with the same length are waiting
+#or the oldest waiting request has waited max_wait seconds. Batches run one at a time on a worker thread, so the event
+#loop keeps accepting requests meanwhile.
+class Batcher:
+
+    def __init__(self, model, device, max_batch=SERVER_MAX_BATCH, max_wait=SERVER_MAX_WAIT_MS / 1000, max_queue=SERVER_MAX_QUEUE, metrics=None) -> None:
+        #int8 models of quantize.py sample by themselves
+        self.engine = InferenceEngine(model) if isinstance(model, DiffWave) else model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.pending = []
+        self.in_progress = 0
+        self.condition = asyncio.Condition()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, spectrogram, fast=False):
+        if len(self.pending) + self.in_progress >= self.max_queue:
+            self.metrics.rejected += 1
+            raise QueueFull()
+        request = SynthesisRequest(spectrogram, fast, asyncio.get_running_loop().create_future())
+        async with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        self.metrics.requests += 1
+        return await request.future
+
+    def _matching(self, first):
+        return [request for request in self.pending if request.key == first.key]
+
+    async def _next_batch(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: len(self.pending) > 0)
+            first = self.pending[0]
+            while len(self._matching(first)) < self.max_batch:
+                timeout = first.arrival + self.max_wait - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = self._matching(first)[:self.max_batch]
+            for request in batch:
+                self.pending.remove(request)
+            self.in_progress += len(batch)
+        return batch
+
+    def _synthesize(self, spectrograms, fast):
+        conditioning_var = spectrograms.unsqueeze(1).to(self.device)
+        noise = torch.randn(spectrograms.shape[0], 1, round(spectrograms.shape[-1] * SAMPLES_PER_FRAME), device=self.device)
+        return self.engine.sample(noise, conditioning_var=conditioning_var, inference_schedule=INFERENCE_SCHEDULE if fast else None)[:, 0].cpu()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            start = time.perf_counter()
+            try:
+                audio = await loop.run_in_executor(self.executor, self._synthesize, torch.stack([request.spectrogram for request in batch]), batch[0].fast)
+            except Exception as e:
+                self.metrics.errors += len(batch)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            finally:
+                self.in_progress -= len(batch)
+            end = time.perf_counter()
+            self.metrics.batch_sizes.append(len(batch))
+            for request, waveform in zip(batch, audio):
+                self.metrics.add('queue_wait', start - request.arrival)
+                self.metrics.add('compute', end - start)
+                self.metrics.add('total', end - request.arrival)
+                if not request.future.done():
+                    request.future.set_result(waveform)
+
+#spectrogram of a request body: an .npy file of shape ([channels,] n_mels, frames); the first channel is used
+def parse_spectrogram(body, max_frames, min_frames=1):
+    spectrogram = torch.from_numpy(np.load(io.BytesIO(body), allow_pickle=False)).float()
+    if spectrogram.dim() == 3:
+        spectrogram = spectrogram[0]
+    if spectrogram.dim() != 2 or spectrogram.shape[0] != N_MELS:
+        raise ValueError(f'expected a spectrogram of shape (n_mels={N_MELS}, frames), got {tuple(spectrogram.shape)}')
+    if spectrogram.shape[1] < min_frames:
+        raise ValueError(f'{spectrogram.shape[1]} frames is less than the minimum of {min_frames} frames of the model')
+    if spectrogram.shape[1] > max_frames:
+        raise OverflowError(f'{spectrogram.shape[1]} frames is more than the maximum of {max_frames}; use synthesize.py for long spectrograms')
+    return spectrogram
+
+def wav_bytes(waveform, sample_rate=SAMPLE_RATE):
+    buffer = io.BytesIO()
+    write_wav_stream(buffer, [waveform], sample_rate)
+    return buffer.getvalue()
+
+#minimal HTTP/1.1 server with keep-alive:
+#POST /synthesize[?fast=1] (body: .npy spectrogram) -> audio/wav, GET /metrics -> json, GET /health
+class VocoderServer:
+
+    def __init__(self, batcher, max_frames=SYNTHESIS_WINDOW_FRAMES, min_frames=1) -> None:
+        self.batcher = batcher
+        self.max_frames = max_frames
+        self.min_frames = min_frames
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, 'application/json', b'{"status": "ok"}'
+        if url.path == '/metrics':
+            report = self.batcher.metrics.report(len(self.batcher.pending), self.batcher.in_progress)
+            return 200, 'application/json', json.dumps(report).encode()
+        if url.path != '/synthesize':
+            return 404, 'text/plain', b'not found'
+        if method != 'POST':
+            return 405, 'text/plain', b'use POST'
+        try:
+            spectrogram = parse_spectrogram(body, self.max_frames, self.min_frames)
+        except OverflowError as e:
+            return 413, 'text/plain', str(e).encode()
+        except Exception as e:
+            return 400, 'text/plain', f'could not read spectrogram: {e}'.encode()
+        fast = parse_qs(url.query).get('fast', ['0'])[0] in ('1', 'true')
+        try:
+            waveform = await self.batcher.submit(spectrogram, fast)
+        except QueueFull:
+            return 503, 'text/plain', b'queue is full'
+        except Exception as e:
+            return 500, 'text/plain', str(e).encode()
+        return 200, 'audio/wav', wav_bytes(waveform)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content_type, payload = await self.route(method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(model_path, host='127.0.0.1', port=8000, unix_socket=None, max_batch=SERVER_MAX_BATCH, max_wait_ms=SERVER_MAX_WAIT_MS, max_queue=SERVER_MAX_QUEUE, max_frames=SYNTHESIS_WINDOW_FRAMES):
+    model, device = load_model(model_path)
+    batcher = Batcher(model, device, max_batch, max_wait_ms / 1000, max_queue)
+    #shortest spectrogram the transpose convs of the conditioner are made for (shorter ones would only be padding)
+    min_frames = model.conditioner_block.min_frames if hasattr(model, 'conditioner_block') else 1
+    server = VocoderServer(batcher, max_frames, min_frames)
+    if unix_socket is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=unix_socket)
+        print(f'Serving {model_path} on {unix_socket}', flush=True)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        print(f'Serving {model_path} on http://{host}:{port}', flush=True)
+    batcher_task = asyncio.create_task(batcher.run())
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), batcher_task)
+
+#example: python source/server.py output/models/best_model.pt --port 8000
+#         curl --data-binary @data/mel_spectrograms/0_0.wav.spec.npy "http://127.0.0.1:8000/synthesize?fast=1" -o sample.wav
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='vocoder server that batches concurrent requests into one reverse diffusion pass')
+    parser.add_argument('model_path', nargs='?', default='output/models/best_model.pt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None, help='listen on this unix socket instead of host:port')
+    parser.add_argument('--max-batch', type=int, default=SERVER_MAX_BATCH)
+    parser.add_argument('--max-wait-ms', type=float, default=SERVER_MAX_WAIT_MS)
+    parser.add_argument('--max-queue', type=int, default=SERVER_MAX_QUEUE)
+    parser.add_argument('--max-frames', type=int, default=SYNTHESIS_WINDOW_FRAMES, help='longest spectrogram accepted per request')
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.model_path, args.host, args.port, args.unix, args.max_batch, args.max_wait_ms, args.max_queue, args.max_frames))
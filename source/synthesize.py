@@ -0,0 +1,102 @@
+import os
+import sys
+import math
+import wave
+import argparse
+import numpy as np
+import torch
+from model import DiffWave
+from inference import InferenceEngine
+from config import NUM_BLOCKS, RES_CHANNELS, TIME_STEPS, VARIANCE_SCHEDULE, TIMESTEP_LAYER_WIDTH, SAMPLE_RATE, N_MELS, INFERENCE_SCHEDULE, SAMPLES_PER_FRAME, SYNTHESIS_WINDOW_FRAMES, SYNTHESIS_BATCH_SIZE
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+#number of waveform samples that influence one output sample in a single pass through the dilated conv stack
+def receptive_field(model):
+    return 1 + sum((block.conv_dilated.kernel_size[0] - 1) * block.conv_dilated.dilation[0] for block in model.blocks)
+
+#start frame of every window; all windows have the same length, the last one is moved back to end at the last frame
+def window_starts(n_frames, window_frames, overlap_frames):
+    if n_frames <= window_frames:
+        return [0]
+    hop = window_frames - overlap_frames
+    starts = list(range(0, n_frames - window_frames, hop))
+    starts.append(n_frames - window_frames)
+    return starts
+
+#synthesize audio for a spectrogram of any length (n_mels, frames) in overlapping windows, that are crossfaded;
+#yields consecutive audio segments of shape (samples,), so memory is bounded by batch_size windows, not by the input length
+def stream_synthesis(model, spectrogram, window_frames=SYNTHESIS_WINDOW_FRAMES, overlap_frames=None, batch_size=SYNTHESIS_BATCH_SIZE, samples_per_frame=SAMPLES_PER_FRAME, inference_schedule=None):
+    n_frames = spectrogram.shape[-1]
+    if overlap_frames is None:
+        overlap_frames = math.ceil(receptive_field(model) / samples_per_frame)
+    window_frames = min(window_frames, n_frames)
+    if n_frames > window_frames and overlap_frames >= window_frames:
+        raise ValueError(f'overlap of {overlap_frames} frames does not fit into windows of {window_frames} frames')
+
+    total_length = round(n_frames * samples_per_frame)
+    window_length = round(window_frames * samples_per_frame)
+    starts = window_starts(n_frames, window_frames, overlap_frames)
+    #first sample of every window; the last window ends exactly at the last sample
+    sample_starts = [min(round(start * samples_per_frame), total_length - window_length) for start in starts]
+
+    engine = InferenceEngine(model)
+    tail = None # part of the previous window that overlaps with the current one
+    for batch_start in range(0, len(starts), batch_size):
+        batch_starts = starts[batch_start:batch_start + batch_size]
+        conditioning_var = torch.stack([spectrogram[:, start:start + window_frames] for start in batch_starts]).unsqueeze(1).to(device)
+        noise = torch.randn(len(batch_starts), 1, window_length, device=device)
+        audio = engine.sample(noise, conditioning_var=conditioning_var, inference_schedule=inference_schedule)[:, 0].cpu()
+
+        for i in range(len(batch_starts)):
+            index = batch_start + i
+            window = audio[i]
+            if tail is not None:
+                overlap = tail.shape[0]
+                fade = torch.linspace(0.0, 1.0, overlap)
+                window = window.clone()
+                window[:overlap] = tail * (1 - fade) + window[:overlap] * fade
+            if index + 1 < len(starts):
+                #keep the samples that the next window overlaps for the crossfade
+                end = sample_starts[index + 1] - sample_starts[index]
+                tail = window[end:]
+                yield window[:end]
+            else:
+                yield window
+
+#write a stream of float segments in [-1, 1] to a 16 bit wav file without holding the whole waveform in memory
+def write_wav_stream(path, segments, sample_rate=SAMPLE_RATE):
+    n_samples = 0
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for segment in segments:
+            f.writeframes((segment.clamp(-1.0, 1.0) * 32767).to(torch.int16).numpy().tobytes())
+            n_samples += segment.shape[0]
+    return n_samples
+
+#example: python source/synthesize.py output/models/best_model.pt long_spectrogram.spec.npy output/samples/long.wav --fast
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='synthesize audio for a mel spectrogram of any length in overlapping windows')
+    parser.add_argument('model_path')
+    parser.add_argument('spectrogram', help='.npy file of shape (channels,) n_mels, frames')
+    parser.add_argument('out_path')
+    parser.add_argument('--window-frames', type=int, default=SYNTHESIS_WINDOW_FRAMES)
+    parser.add_argument('--overlap-frames', type=int, default=None, help='defaults to the receptive field of the model')
+    parser.add_argument('--batch-size', type=int, default=SYNTHESIS_BATCH_SIZE)
+    parser.add_argument('--fast', action='store_true', help='denoise only the steps of INFERENCE_SCHEDULE from config.py')
+    args = parser.parse_args()
+
+    model = DiffWave(RES_CHANNELS, NUM_BLOCKS, TIME_STEPS, VARIANCE_SCHEDULE, True, N_MELS, layer_width=TIMESTEP_LAYER_WIDTH)
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    model.to(device)
+    model.eval()
+
+    spectrogram = torch.from_numpy(np.load(args.spectrogram))
+    if spectrogram.dim() == 3:
+        spectrogram = spectrogram[0] #first channel
+    segments = stream_synthesis(model, spectrogram, args.window_frames, args.overlap_frames, args.batch_size,
+                                inference_schedule=INFERENCE_SCHEDULE if args.fast else None)
+    n_samples = write_wav_stream(args.out_path, segments)
+    print(f'Saved {n_samples / SAMPLE_RATE:.2f} seconds of audio to {args.out_path}')
@@ -1,100 +1,279 @@
+import os
+import time
+import contextlib
 import torch
+import torch.distributed as dist
 import numpy as np
 from tqdm import tqdm
 from model import DiffWave
-import wandb
-from config import WITH_CONDITIONING
+from checkpoint import CheckpointManager
+from metrics import create_logger
+from profiler import Profiler
+from config import WITH_CONDITIONING, PRECISION, GRAD_ACCUM_STEPS, CHECKPOINT_EVERY, VALIDATION_EVERY
 
-def train(model, optimizer, trainloader, epochs, timesteps, variance_schedule, lr=1e-4, with_conditioning=WITH_CONDITIONING):
+#autocast dtype for each precision mode; None trains in full fp32
+AMP_DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def train(model, optimizer, trainloader, epochs, timesteps, variance_schedule, lr=1e-4, with_conditioning=WITH_CONDITIONING, precision=PRECISION, grad_accum_steps=GRAD_ACCUM_STEPS, out_dir='output/models', device=None, scheduler=None, resume=False, checkpoint_every=CHECKPOINT_EVERY, metrics=None, profiler=None, ema=None, validator=None, validate_every=VALIDATION_EVERY):
 
     #check if cuda is availableand set as device
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f'Using device: {device}')
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    #in distributed (DDP) training only rank 0 logs and saves models; losses are averaged over all ranks
+    distributed = dist.is_available() and dist.is_initialized()
+    is_main_process = not distributed or dist.get_rank() == 0
+    raw_model = model.module if hasattr(model, 'module') else model # unwrapped model, whose state_dict is saved
 
     #get and print number of parameters
     model_parameters = filter(lambda p: p.requires_grad, model.parameters())
     params = sum([np.prod(p.size()) for p in model_parameters])
-    print(f'Total number of parameters: {params}') #print number of parameters
+    if is_main_process:
+        print(f'Using device: {device}')
+        print(f'Total number of parameters: {params}') #print number of parameters
 
 
     model.train()
     model.to(device)
 
     loss_func = torch.nn.MSELoss()
+    #the model's noise schedule drives the forward (noising) process
+    noise_schedule = raw_model.noise_schedule
+    if not noise_schedule.matches(variance_schedule):
+        raise ValueError('variance_schedule differs from the noise schedule of the model')
+
+    #mixed precision: bf16 autocast works on cpu and cuda, fp16 (cuda only) needs a gradient scaler against underflow
+    if precision not in AMP_DTYPES:
+        raise ValueError(f'precision must be one of {list(AMP_DTYPES)}')
+    amp_dtype = AMP_DTYPES[precision]
+    scaler = torch.amp.GradScaler(device.type, enabled=precision == 'fp16' and device.type == 'cuda')
+
+    #metrics are buffered on the device and written by a background thread; default: metrics.jsonl in out_dir (rank 0 only)
+    close_metrics = metrics is None
+    if is_main_process:
+        os.makedirs(out_dir, exist_ok=True)
+    if metrics is None:
+        metrics = create_logger(['jsonl'] if is_main_process else [], out_dir, device=device)
+
+    #opt-in per phase and per module timing; disabled profiler does nothing
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    profiler.attach(model)
+
+    #full training state is checkpointed in the background to out_dir/checkpoints (rank 0 writes, every rank can resume)
+    checkpoint_manager = CheckpointManager(os.path.join(out_dir, 'checkpoints'))
 
     step_count = 0
     n_step_loss = 0
     best_step_loss = 999999999999
     best_loss = 999999999999
-    for epoch in range(epochs):
-        epoch_loss = 0
-        for batch in tqdm(trainloader):
+    best_validation = float('inf')
+    start_epoch = 0
+    epoch_step = 0 # batches of the current epoch that are already trained on
+    epoch_loss = torch.zeros((), device=device)
+    if resume and checkpoint_manager.latest() is not None:
+        state = checkpoint_manager.load(checkpoint_manager.latest(), raw_model, optimizer, scheduler, ema=ema)
+        step_count, best_step_loss, best_loss = state['step_count'], state['best_step_loss'], state['best_loss']
+        best_validation = state.get('best_validation', best_validation)
+        start_epoch, epoch_step = state['epoch'], state['epoch_step']
+        epoch_loss += state['epoch_loss']
+        n_step_loss = state['n_step_loss']
+        metrics.set_step(step_count) #logged steps continue from the restored step
+        if distributed:
+            #restored rng state is the one of rank 0; give every rank its own noise again
+            torch.manual_seed(step_count * dist.get_world_size() + dist.get_rank())
+        if is_main_process:
+            print(f'Resuming from {checkpoint_manager.latest()} at epoch {start_epoch}, step {step_count}')
+
+    last_checkpoint_step = step_count # step of the last interval checkpoint (or of the restored one)
+
+    optimizer.zero_grad()
+    for epoch in range(start_epoch, epochs):
+        #distributed sampler (or the length bucketing batch sampler) shuffles differently in every epoch
+        if hasattr(trainloader.sampler, 'set_epoch'):
+            trainloader.sampler.set_epoch(epoch)
+        if hasattr(trainloader.batch_sampler, 'set_epoch'):
+            trainloader.batch_sampler.set_epoch(epoch)
+        #iterable datasets (StreamingCropData) draw their crops per epoch themselves
+        if hasattr(trainloader.dataset, 'set_epoch'):
+            trainloader.dataset.set_epoch(epoch)
+
+        #skip the batches of a resumed epoch that were trained on before the checkpoint
+        skip_batches = 0
+        if epoch_step > 0:
+            if hasattr(trainloader.batch_sampler, 'set_start_index'):
+                trainloader.batch_sampler.set_start_index(epoch_step)
+            elif hasattr(trainloader.sampler, 'set_start_index'):
+                trainloader.sampler.set_start_index(epoch_step * trainloader.batch_size)
+            else:
+                skip_batches = epoch_step
+
+        data_start = time.perf_counter()
+        for batch in tqdm(trainloader, disable=not is_main_process):
+            if skip_batches > 0:
+                skip_batches -= 1
+                data_start = time.perf_counter()
+                continue
+            metrics.add_time('data_wait', time.perf_counter() - data_start)
+            profiler.add('data', time.perf_counter() - data_start)
             step_count += 1
-            optimizer.zero_grad()
-
-            #get waveform from (waveform, sample_rate) tuple;
-            waveform = batch[0] # batch size, channels, length 
-
-            #generate noise
-            noise = torch.randn(waveform.shape) 
-
-            #generate random integer between 1 and number of diffusion timesteps
-            t = torch.randint(1, timesteps, (1,))
-
-            #define scaling factors for original waveform and noise
-            beta = variance_schedule
-            alpha = 1-beta
-            alpha_t = np.cumprod(alpha)
-
-            #create noisy version of original waveform
-            waveform = torch.sqrt(alpha_t[t])*waveform + torch.sqrt(1-alpha_t[t])*noise
-
-            waveform = waveform.to(device)
-            t = t.to(device)
-            noise = noise.to(device)
-
-            conditioning_var = None
-            if with_conditioning:
-                # get conditioning_var (spectrogram) from (waveform, sample_rate, spectrogram) tuple;
-                conditioning_var = batch[2] # batch size, channels, length
-                conditioning_var = conditioning_var.to(device)
-
-            # predict noise at diffusion timestep t
-            y_pred = model.forward(waveform, t, conditioning_var)
-            del waveform
-            del t
-
-            #calculate loss, barward pass and optimizer step
-            batch_loss = loss_func(y_pred, noise)
-            del y_pred
-            del noise
-            batch_loss.backward()
-            optimizer.step()
-            epoch_loss += float(batch_loss.item())
-            n_step_loss += float(batch_loss.item())
-            wandb.log({"batch_loss": batch_loss})
+            epoch_step += 1
+
+            with profiler.phase('noising'):
+                #get waveform from (waveform, sample_rate) tuple;
+                waveform = batch[0].to(device, non_blocking=True) # batch size, channels, length
+
+                #generate noise on the device
+                noise = torch.randn_like(waveform)
+
+                #draw an independent diffusion timestep for every example in the batch
+                t = noise_schedule.sample_timesteps(waveform.shape[0])
+
+                #create noisy version of original waveform
+                waveform = noise_schedule.add_noise(waveform, t, noise)
+
+                conditioning_var = None
+                if with_conditioning:
+                    # get conditioning_var (spectrogram) from (waveform, sample_rate, spectrogram) tuple;
+                    conditioning_var = batch[2] # batch size, channels, length
+                    conditioning_var = conditioning_var.to(device)
+
+                #padded batches (pad_collate of dataset.py) end with a mask of the real samples
+                mask = batch[-1].to(device, non_blocking=True) if len(batch) > (3 if with_conditioning else 2) else None
+
+            #with DDP, gradients are only all-reduced in the backward of the last batch of an accumulation
+            sync_context = model.no_sync() if distributed and step_count % grad_accum_steps != 0 else contextlib.nullcontext()
+            with sync_context:
+                # predict noise at diffusion timestep t
+                with metrics.timer('forward'), profiler.phase('forward'):
+                    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                        y_pred = model.forward(waveform, t, conditioning_var)
+                    del waveform
+                    del t
+
+                    #calculate loss (in fp32); mean over the real samples only if the batch is padded
+                    if mask is None:
+                        batch_loss = loss_func(y_pred.float(), noise)
+                    else:
+                        batch_loss = ((y_pred.float() - noise) ** 2 * mask).sum() / (mask.sum() * noise.shape[1])
+                        del mask
+                    del y_pred
+                    del noise
+
+                #backward pass and optimizer step every grad_accum_steps batches
+                with metrics.timer('backward'), profiler.phase('backward'):
+                    scaler.scale(batch_loss / grad_accum_steps).backward()
+            if step_count % grad_accum_steps == 0:
+                with metrics.timer('optimizer'), profiler.phase('optimizer'):
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad()
+                    if ema is not None:
+                        ema.update()
+            batch_loss = batch_loss.detach()
+            epoch_loss += batch_loss
+            n_step_loss += batch_loss
+            metrics.log_loss(batch_loss)
+            profiler.step()
 
             #step loss is logged and model saved every 500 steps, so runs with batch size 1 and many, many epochs can be monitored better
             if step_count % 500 == 0:
-                wandb.log({"500_step_loss": n_step_loss/500})
-                if best_step_loss > n_step_loss/500:
-                    best_step_loss = n_step_loss/500
-                    torch.save(model.state_dict(), 'output/models/best_500_step_model.pt')
+                step_loss = _mean_over_ranks(n_step_loss, distributed).item()/500
+                if is_main_process:
+                    metrics.log('500_step', {'loss': step_loss})
+                    if best_step_loss > step_loss:
+                        best_step_loss = step_loss
+                        checkpoint_manager.save_weights(raw_model, os.path.join(out_dir, 'best_500_step_model.pt'))
                 n_step_loss = 0
 
-        # normalize epoch_loss by total number of samples
-        epoch_loss = epoch_loss/len(trainloader)
+            #validate the (EMA) weights in the background; the best validated weights become best_model.pt
+            if validator is not None:
+                if step_count % validate_every == 0:
+                    validator.submit(step_count, ema.state_dict() if ema is not None else raw_model.state_dict())
+                best_validation = _collect_validations(validator, metrics, checkpoint_manager, out_dir, best_validation)
+
+            #checkpoint the full training state every checkpoint_every steps; only between optimizer steps, so no accumulated
+            #gradients are lost: the checkpoint of an interval is written at the first optimizer step at or after its end
+            if step_count % grad_accum_steps == 0 and step_count // checkpoint_every > last_checkpoint_step // checkpoint_every:
+                last_checkpoint_step = step_count
+            if is_main_process and last_checkpoint_step == step_count:
+                checkpoint_manager.save(step_count, raw_model, optimizer, scheduler, ema, epoch=epoch, epoch_step=epoch_step, step_count=step_count,
+                                        epoch_loss=epoch_loss.item(), n_step_loss=float(n_step_loss), best_loss=best_loss, best_step_loss=best_step_loss,
+                                        best_validation=best_validation)
+            data_start = time.perf_counter()
+
+        # normalize epoch_loss by number of batches of the epoch (including those before a resume)
+        epoch_loss = _mean_over_ranks(epoch_loss, distributed).item()/max(epoch_step, 1)
+        epoch_step = 0
+
+        if scheduler is not None:
+            scheduler.step()
+
+        #save model if loss is new best loss; with a validator, best_model.pt is chosen by validation instead
+        if is_main_process:
+            if epoch_loss < best_loss:
+                best_loss = epoch_loss
+                if validator is None:
+                    checkpoint_manager.save_weights(raw_model, os.path.join(out_dir, 'best_model.pt'))
+            print(f'epoch: {epoch} | loss: {epoch_loss}')
+            metrics.log('epoch', {'epoch': epoch, 'loss': epoch_loss})
+        #like interval checkpoints, only between optimizer steps: gradients accumulated over the epoch end are not in a
+        #checkpoint, so a resume from the middle of an accumulation would step with fewer batches than grad_accum_steps
+        if is_main_process and step_count % grad_accum_steps == 0:
+            checkpoint_manager.save(step_count, raw_model, optimizer, scheduler, ema, epoch=epoch + 1, epoch_step=0, step_count=step_count,
+                                    epoch_loss=0.0, n_step_loss=float(n_step_loss), best_loss=best_loss, best_step_loss=best_step_loss,
+                                    best_validation=best_validation)
+        epoch_loss = torch.zeros((), device=device)
+
+    #apply gradients of an incomplete accumulation at the end of training
+    if step_count % grad_accum_steps != 0:
+        #these batches ran under no_sync, so their gradients are averaged over the ranks here
+        if distributed:
+            for param in model.parameters():
+                if param.grad is not None:
+                    dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+                    param.grad /= dist.get_world_size()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+        if ema is not None:
+            ema.update()
+
+    #wait for all outstanding validations and validate the final weights too, unless they were the last accepted job
+    #(a submit of the last interval step is skipped while the worker is busy)
+    if validator is not None:
+        best_validation = _collect_validations(validator, metrics, checkpoint_manager, out_dir, best_validation, wait=True)
+        if validator.last_submitted != step_count and validator.submit(step_count, ema.state_dict() if ema is not None else raw_model.state_dict()):
+            best_validation = _collect_validations(validator, metrics, checkpoint_manager, out_dir, best_validation, wait=True)
+
+    if is_main_process:
+        #save final model locally (and its EMA weights, which are usually the better model for sampling)
+        checkpoint_manager.save_weights(raw_model, os.path.join(out_dir, 'last_model.pt'))
+        if ema is not None:
+            checkpoint_manager.save_weights(ema, os.path.join(out_dir, 'ema_model.pt'))
+    checkpoint_manager.close()
 
-        #save model if loss is new best loss
-        if epoch_loss < best_loss:
-            best_loss = epoch_loss
-            torch.save(model.state_dict(), 'output/models/best_model.pt')
-        print(f'epoch: {epoch} | loss: {epoch_loss}')
-        wandb.log({"epoch_loss": epoch_loss})
+    if is_main_process:
+        #save best model (lowest validation mel L1 or epoch loss) to wandb (if it is a metrics backend)
+        metrics.save_file(os.path.join(out_dir, 'best_model.pt'))
+    if close_metrics:
+        metrics.close()
+    profiler.detach()
+    return model
 
-    #save final model locally
-    torch.save(model.state_dict(), 'output/models/last_model.pt')
+#log finished validations and save the validated weights as best_model.pt if they are the best so far; returns the best mel L1
+def _collect_validations(validator, metrics, checkpoint_manager, out_dir, best_validation, wait=False):
+    for step, values, state_dict in validator.poll(wait=wait):
+        metrics.log('validation', {'validated_step': step, **values})
+        if values['mel_l1'] < best_validation:
+            best_validation = values['mel_l1']
+            checkpoint_manager.save_state_dict(state_dict, os.path.join(out_dir, 'best_model.pt'))
+    return best_validation
 
-    #save model with lowest epoch loss to wandb
-    wandb.save('output/models/best_model.pt')
-    return model
\ No newline at end of file
+#average of a loss tensor over all ranks of a distributed run
+def _mean_over_ranks(loss, distributed):
+    if not distributed:
+        return loss
+    loss = loss.clone()
+    dist.all_reduce(loss, op=dist.ReduceOp.SUM)
+    return loss / dist.get_world_size()
\ No newline at end of file